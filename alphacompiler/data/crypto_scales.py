@@ -0,0 +1,94 @@
+"""
+Scale factors of the crypto bundle.  The bcolz daily bars store prices * 1000
+and volumes as uint32, so at ingest the prices of every coin are multiplied by
+a power of 2 (sub-cent tokens would round to 0 otherwise) and the volumes by
+another power of 2 (so they do not overflow).  The factors are saved per sid,
+dividing by them gives back the true prices and volumes.
+"""
+
+from zipline.pipeline.factors import CustomFactor
+from zipline.utils.paths import zipline_root
+
+import numpy as np
+
+
+ZIPLINE_DATA_DIR = zipline_root() + '/data/'
+SCALES_FILE = "crypto_scales.npy"
+
+UINT32_MAX = 4294967295
+MIN_SCALED_PRICE = 10.0  # prices are scaled up until the lowest low is at least this
+MAX_SCALED_PRICE = UINT32_MAX / 1000.0  # bcolz stores prices * 1000 as uint32
+MAX_SCALED_VOLUME = UINT32_MAX - 1
+
+
+def _pow2_exponent_up(value, target):
+    """Smallest k >= 0 with value * 2**k >= target."""
+    k = max(0, int(np.ceil(np.log2(target / value))))
+    # log2 can be off by one ulp around exact powers of 2
+    if value * 2.0 ** k < target:
+        k += 1
+    elif k > 0 and value * 2.0 ** (k - 1) >= target:
+        k -= 1
+    return k
+
+
+def _pow2_exponent_down(value, limit):
+    """Largest k (positive or negative) with value * 2**k <= limit."""
+    k = int(np.floor(np.log2(limit / value)))
+    # log2 can be off by one ulp around exact powers of 2
+    if value * 2.0 ** k > limit:
+        k -= 1
+    elif value * 2.0 ** (k + 1) <= limit:
+        k += 1
+    return k
+
+
+def uint32_scales(dfin):
+    """
+    Returns (price_scale, volume_scale), the powers of 2 the prices and
+    volume of dfin have to be multiplied by to fit in uint32.
+    Prices are doubled until the lowest positive low is at least
+    MIN_SCALED_PRICE, as long as the highest high stays below
+    MAX_SCALED_PRICE.  Volume gets its own scale, the largest power of 2
+    (up or down) that keeps the highest volume at most MAX_SCALED_VOLUME,
+    so small volumes keep as many digits as uint32 allows.
+    """
+    lows = dfin['low'].values
+    lows = lows[lows > 0]
+    price_exp = 0
+    if lows.size > 0:
+        price_exp = _pow2_exponent_up(lows.min(), MIN_SCALED_PRICE)
+        high = np.nanmax(dfin['high'].values)
+        if high > 0:
+            price_exp = min(price_exp, _pow2_exponent_up(high, MAX_SCALED_PRICE) - 1)
+            price_exp = max(price_exp, 0)
+
+    volume_exp = 0
+    volumes = dfin['volume'].values
+    volumes = volumes[np.isfinite(volumes) & (volumes > 0)]
+    if volumes.size > 0:
+        volume_exp = _pow2_exponent_down(volumes.max(), MAX_SCALED_VOLUME)
+    return 2.0 ** price_exp, 2.0 ** volume_exp
+
+
+def save_scales(price_scales, volume_scales, path=ZIPLINE_DATA_DIR + SCALES_FILE):
+    """Saves the scales, the arrays are indexed by sid."""
+    np.save(path, np.vstack([price_scales, volume_scales]))
+
+
+class CryptoScales(CustomFactor):
+    """Returns the price and volume scale factors of a sid in the crypto bundle,
+    divide USEquityPricing values by them to get the true prices and volumes.
+    Sids ingested after the scales were saved get NaN."""
+    inputs = []
+    window_length = 1
+    outputs = ['price', 'volume']
+
+    def __init__(self, *args, **kwargs):
+        self.data = np.load(ZIPLINE_DATA_DIR + SCALES_FILE)
+
+    def compute(self, today, assets, out):
+        known = assets < self.data.shape[1]
+        for row, field in enumerate(self.outputs):
+            out[field][:] = np.nan
+            out[field][known] = self.data[row, assets[known]]
@@ -1,5 +1,4 @@
 from alphacompiler.util.sparse_data import SparseDataFactor
-from alphacompiler.util.zipline_data_tools import get_ticker_sid_dict_from_bundle
 from zipline.utils.paths import zipline_root
 
 
@@ -9,6 +8,4 @@ class Fundamentals(SparseDataFactor):
 
     def __init__(self, *args, **kwargs):
         super(Fundamentals, self).__init__(*args, **kwargs)
-        self.N = len(get_ticker_sid_dict_from_bundle("iex")) + 1  # max(sid)+1 get this from the bundle
-
-        self.data_path = zipline_root() + '/data/4th.npy'
+        self.data_path = zipline_root() + '/data/4th'
@@ -3,7 +3,7 @@ Packs the fundamental data from a single 4th Quartile csv dump.
 """
 
 from alphacompiler.util.zipline_data_tools import get_ticker_sid_dict_from_bundle
-from alphacompiler.util.sparse_data import pack_sparse_data, clear_raw_folder
+from alphacompiler.util.sparse_data import pack_sparse_frame, export_raw_csv, clear_raw_folder
 import alphacompiler.util.load_extensions  # this simply loads the extensions
 from zipline.utils.paths import zipline_root
 
@@ -19,7 +19,7 @@ START_DATE = '2009-01-01'  # this is only used for getting data from the API
 END_DATE = datetime.datetime.today().strftime('%Y-%m-%d')
 
 ZIPLINE_DATA_DIR = zipline_root() + '/data/'
-FN = "4th.npy"  # the file name to be used when storing this in ~/.zipline/data
+FN = "4th"  # the folder name to be used when storing this in ~/.zipline/data
 
 # TODO: add this to a config file
 DUMP_FILE = '/Users/peter/Documents/Bitbucket/qlite-backend/fundamental/data/master.csv'
@@ -27,49 +27,42 @@ DUMP_FILE = '/Users/peter/Documents/Bitbucket/qlite-backend/fundamental/data/mas
 log = Logger('load_4thquartile_fund.py')
 
 
-def populate_raw_data_from_dump(tickers2sid, fields, raw_path):
+def read_dump(tickers2sid, fields, dump_file=DUMP_FILE):
     """
-    Populates the raw/ folder based on a single dump download.
+    Reads the dump and returns one DataFrame with a row per (sid, Date), the
+    columns are: sid, Date and fields.  Tickers without a sid are dropped.
 
     :param tickers2sid: a dict with the ticker string as the key and the SID
     as the value
     :param fields: a list of field names
-    :param raw_path: the path to the folder to write the files.
     """
+    fields = list(dict.fromkeys(fields))  # drop any redundant names
+    df = pd.read_csv(dump_file, usecols=['ticker', 'date'] + fields, parse_dates=['date'])
 
-    df = pd.read_csv(DUMP_FILE)  # open dump file
-    clear_raw_folder(RAW_FLDR)
-
-    df = df[['ticker', 'date'] + fields]  # remove columns not in fields
-    df = df.loc[:, ~df.columns.duplicated()]  # drop any columns with redundant names
+    sids = df['ticker'].str.upper().map(tickers2sid)
+    missing = df.loc[sids.isnull(), 'ticker'].unique()
+    if len(missing) > 0:
+        print('no sid found for {} tickers: {}'.format(len(missing), ', '.join(map(str, missing))))
 
-    for tkr, df_tkr in df.groupby('ticker'):
-        tkr = tkr.upper()
-        print('processing: ', tkr)
+    df = df.assign(sid=sids)[sids.notnull()]
+    df['sid'] = df['sid'].astype('int64')
+    return df.rename(columns={'date': 'Date'})[['sid', 'Date'] + fields]
 
-        sid = tickers2sid.get(tkr)
-        if sid is None:
-            print('no sid found for: {}'.format(tkr))
-            continue
-        print('sid: {}'.format(sid))
 
-        df_tkr = df_tkr.rename(columns={'date': 'Date'}).set_index('Date')
-
-        # loop over the fields and dimensions
-        series = []
-        for i, field in enumerate(fields):
-            print(i, field)
-            s = df_tkr[field]
-            #new_name = '{}_{}'.format(field, dimensions[i])
-            #s = s.rename(new_name)
-            series.append(s)
-        df_tkr = pd.concat(series, axis=1)
-        df_tkr.index.names = ['Date']  # ensure that the index is named Date
-        print("AFTER reorganizing")
-        print(df_tkr)
+def populate_raw_data_from_dump(tickers2sid, fields, raw_path):
+    """
+    Populates the raw/ folder based on a single dump download.
+    This is only needed to inspect the data, pack_sparse_frame() packs the
+    dump without these files.
 
-        # write raw file: raw/
-        df_tkr.to_csv(os.path.join(raw_path, "{}.csv".format(sid)))
+    :param tickers2sid: a dict with the ticker string as the key and the SID
+    as the value
+    :param fields: a list of field names
+    :param raw_path: the path to the folder to write the files.
+    """
+    df = read_dump(tickers2sid, fields, DUMP_FILE)
+    clear_raw_folder(raw_path)
+    export_raw_csv(df, df.columns[2:], raw_path)
 
 
 def all_tickers_for_bundle_from_dump(fields, bundle_name, raw_path=os.path.join(BASE, RAW_FLDR)):
@@ -93,10 +86,11 @@ if __name__ == '__main__':
     num_tickers = num_tkrs_in_bundle(BUNDLE_NAME)
     print('number of tickers: ', num_tickers)
 
-    all_tickers_for_bundle_from_dump(fields, BUNDLE_NAME)  # downloads the data to /raw
-    pack_sparse_data(num_tickers + 1,  # number of tickers in buldle + 1
-                    os.path.join(BASE, RAW_FLDR),
-                    fields,
-                    ZIPLINE_DATA_DIR + FN)  # write directly to the zipline data dir
+    df = read_dump(get_ticker_sid_dict_from_bundle(BUNDLE_NAME), fields)
+    pack_sparse_frame(df,
+                      num_tickers + 1,  # number of tickers in buldle + 1
+                      fields,
+                      ZIPLINE_DATA_DIR + FN)  # write directly to the zipline data dir
+    # all_tickers_for_bundle_from_dump(fields, BUNDLE_NAME)  # writes the data to /raw, for debugging
 
     print("this worked boss")
@@ -7,7 +7,7 @@
 import quandl
 
 from alphacompiler.util.zipline_data_tools import get_ticker_sid_dict_from_bundle
-from alphacompiler.util.sparse_data import pack_sparse_data
+from alphacompiler.util.sparse_data import pack_sparse_frame, export_raw_csv
 from alphacompiler.util import quandl_tools
 import alphacompiler.util.load_extensions  # this simply loads the extensions
 from zipline.utils.paths import zipline_root
@@ -25,9 +25,10 @@ START_DATE = '2009-01-01'  # this is only used for getting data from the API
 END_DATE = datetime.datetime.today().strftime('%Y-%m-%d')
 
 ZIPLINE_DATA_DIR = zipline_root() + '/data/'
-FN = "SF1.npy"  # the file name to be used when storing this in ~/.zipline/data
+FN = "SF1"  # the folder name to be used when storing this in ~/.zipline/data
 
 DUMP_FILE = '/Users/peterharrington/Downloads/SHARADAR_SF1_2daa4baaad2a300c166b5c0f7e546bd1.csv'
+DUMP_CHUNKSIZE = 250000  # number of rows read from the dump at a time
 
 log = Logger('load_quandl_sf1.py')
 
@@ -43,6 +44,8 @@ def clear_raw_folder(raw_folder_path):
 def populate_raw_data_from_dump(tickers2sid, fields, dimensions, raw_path):
     """
     Populates the raw/ folder based on a single dump download.
+    This is only needed to inspect the data, pack_data_from_dump() packs the
+    dump without these files.
 
     :param tickers2sid: a dict with the ticker string as the key and the SID
     as the value
@@ -52,41 +55,81 @@ def populate_raw_data_from_dump(tickers2sid, fields, dimensions, raw_path):
     """
     assert len(fields) == len(dimensions)
 
-    df = pd.read_csv(DUMP_FILE)  # open dump file
+    df = read_dump_chunked(tickers2sid, fields, dimensions, DUMP_FILE)
+    clear_raw_folder(raw_path)
+
+    fields_dimensions = ['{}_{}'.format(i, j) for i, j in zip(fields, dimensions)]
+    export_raw_csv(df, fields_dimensions, raw_path)
 
-    clear_raw_folder(RAW_FLDR)
 
-    df = df[['ticker', 'dimension', 'datekey'] + fields]  # remove columns not in fields
-    df = df.loc[:, ~df.columns.duplicated()]  # drop any columns with redundant names
+def read_dump_chunked(tickers2sid, fields, dimensions, dump_file=DUMP_FILE, chunksize=DUMP_CHUNKSIZE):
+    """
+    Streams the dump and returns one DataFrame with a row per (sid, Date), the
+    columns are: sid, Date and '{field}_{dimension}' for each field.
+    Only the needed columns are read, and each chunk is filtered and pivoted as
+    it is read, so memory is bounded by the output not by the size of the dump.
 
-    for tkr, df_tkr in df.groupby('ticker'):
-        print('processing: ', tkr)
+    :param tickers2sid: a dict with the ticker string as the key and the SID
+    as the value
+    :param fields: a list of field names
+    :param dimensions: a list with dimensions for each field in fields
+    """
+    assert len(fields) == len(dimensions)
 
-        sid = tickers2sid.get(tkr)
-        if sid is None:
-            print('no sid found for: {}'.format(tkr))
+    unique_fields = list(dict.fromkeys(fields))  # fields can be repeated with different dimensions
+    wanted = list(zip(fields, dimensions))
+    columns = ['{}_{}'.format(field, dim) for field, dim in wanted]
+    dtypes = {'ticker': 'str', 'dimension': 'category'}
+    dtypes.update((field, 'float64') for field in unique_fields)
+
+    dimension_fields = dict((dim, list(dict.fromkeys(f for f, d in wanted if d == dim))) for _, dim in wanted)
+
+    reader = pd.read_csv(dump_file, usecols=['ticker', 'dimension', 'datekey'] + unique_fields,
+                         dtype=dtypes, parse_dates=['datekey'], chunksize=chunksize)
+    parts = dict((dim, []) for dim in dimension_fields)  # dimension -> rows of each chunk
+    for chunk in reader:
+        chunk = chunk[chunk['dimension'].isin(dimensions)]
+        sids = chunk['ticker'].map(tickers2sid)  # NaN when the ticker is not in the bundle
+        chunk = chunk.assign(sid=sids)[sids.notnull()]
+        chunk = chunk.drop_duplicates(['sid', 'datekey', 'dimension'], keep='last')
+        if chunk.shape[0] == 0:
             continue
-        print('sid: {}'.format(sid))
 
-        df_tkr = df_tkr.rename(columns={'datekey': 'Date'}).set_index('Date')
+        for dim, rows in chunk.groupby('dimension', observed=True):
+            parts[dim].append(rows.set_index(['sid', 'datekey'])[dimension_fields[dim]])
+        print('read {} rows'.format(len(chunk)))
 
-        # loop over the fields and dimensions
-        series = []
-        for i, field in enumerate(fields):
-            print(i, field)
-            s = df_tkr[df_tkr.dimension == dimensions[i]][field]
-            new_name = '{}_{}'.format(field, dimensions[i])
-            s = s.rename(new_name)
-            series.append(s)
-        df_tkr = pd.concat(series, axis=1)
-        df_tkr.index.names = ['Date']  # ensure that the index is named Date
-        print("AFTER reorganizing")
-        print(df_tkr)
+    frames = []
+    for dim, dim_parts in parts.items():
+        if len(dim_parts) == 0:
+            continue
+        frame = pd.concat(dim_parts)
+        # a (sid, Date, dimension) can be in more than one chunk, the last row wins as within a chunk
+        frame = frame[~frame.index.duplicated(keep='last')]
+        frames.append(frame.rename(columns=lambda field: '{}_{}'.format(field, dim)))
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['sid', 'Date'] + columns)
 
-        # write raw file: raw/
-        df_tkr.to_csv(os.path.join(raw_path, "{}.csv".format(sid)))
+    # one column per (field, dimension) pair
+    df = pd.concat(frames, axis=1).sort_index().reindex(columns=columns)
+    df.index.names = ['sid', 'Date']
+    df = df.reset_index()
+    df['sid'] = df['sid'].astype('int64')
+    return df
 
 
+def pack_data_from_dump(tickers2sid, fields, dimensions, N, filename, dump_file=DUMP_FILE,
+                        chunksize=DUMP_CHUNKSIZE, raw_path=None):
+    """
+    Streams the dump and writes the packed sparse data directly to filename,
+    without writing the per sid files in raw/.  Pass raw_path to also write
+    them, for debugging.
+    """
+    df = read_dump_chunked(tickers2sid, fields, dimensions, dump_file, chunksize)
+    fields_dimensions = ['{}_{}'.format(i, j) for i, j in zip(fields, dimensions)]
+    pack_sparse_frame(df, N, fields_dimensions, filename, raw_path=raw_path)
+
 
 def populate_raw_data_from_api(tickers, fields, dimensions, raw_path):
     """tickers is a dict with the ticker string as the key and the SID
@@ -218,12 +261,10 @@ if __name__ == '__main__':
     num_tickers = num_tkrs_in_bundle(BUNDLE_NAME)
     print('number of tickers: ', num_tickers)
 
-    all_tickers_for_bundle_from_dump(fields, dimensions, 'sep')  # downloads the data to /raw
-    fields_dimensions = ['{}_{}'.format(i, j) for i, j in zip(fields, dimensions)]
-    pack_sparse_data(num_tickers + 1,  # number of tickers in buldle + 1
-                    os.path.join(BASE, RAW_FLDR),
-                    fields_dimensions,
-                    ZIPLINE_DATA_DIR + FN)  # write directly to the zipline data dir
-
+    # streams the dump, and writes directly to the zipline data dir
+    pack_data_from_dump(get_ticker_sid_dict_from_bundle(BUNDLE_NAME),
+                        fields, dimensions,
+                        num_tickers + 1,  # number of tickers in buldle + 1
+                        ZIPLINE_DATA_DIR + FN)
 
     print("this worked boss")
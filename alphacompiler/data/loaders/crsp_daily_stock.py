@@ -8,8 +8,8 @@ Created by Peter Harrington (pbharrin) on 3/6/18.
 
 import pandas as pd
 import numpy as np
-from zipline.utils.calendars import get_calendar
-import sys
+# from zipline.utils.calendars import get_calendar # zipline Quantopian
+from zipline.utils.calendar_utils import get_calendar # zipline-reloaded
 
 
 METADATA_HEADERS = ['start_date', 'end_date', 'auto_close_date',
@@ -25,7 +25,195 @@ CRAZY_DATE = pd.Timestamp('2008-09-28')  # TODO: delete me
 ALLOWED_MISSING_DATES_RATIO = 0.5   # ticker will be skipped if missing/possible > ratio
 
 
-def from_crsp_dump(file_name, start=None, end=None):
+def calendar_gaps(dates, sessions):
+    """
+    Returns the sessions spanned by the sorted dates of one security and the
+    sessions missing from dates, both found with searchsorted/isin on the
+    sorted arrays instead of Python sets.
+    """
+    first, last = sessions.searchsorted([dates[0], dates[-1]], side='left')
+    if last < len(sessions) and sessions[last] == dates[-1]:
+        last += 1
+    this_cal = sessions[first:last]
+    missing = this_cal[~np.isin(this_cal.values, dates.values)]
+    return this_cal, missing
+
+
+def prepare_security(permno, df_tkr, sessions):
+    """
+    Checks and cleans up the rows of a single security (PERMNO), df_tkr has
+    to be sorted by date.
+    Returns (metadata, OHLCV DataFrame, None) or (None, None, reason) when the
+    security has to be skipped.
+    """
+    df_tkr = df_tkr[~df_tkr.index.duplicated(keep='first')]
+
+    # could drop all rows where the ticker is null
+    # df_tkr = df_tkr[~pd.isnull(df_tkr['TSYMBOL'])]
+
+    row0 = df_tkr.iloc[0]  # get metadata from row
+
+    # need to find the first row with a ticker.
+    if pd.isnull(row0['TSYMBOL']):
+        print('no ticker on first line, finding first line with ticker')
+        df_non_null_ticker = df_tkr[~pd.isnull(df_tkr['TSYMBOL'])]
+        if df_non_null_ticker.shape[0] == 0:
+            print('no ticker, skipping')
+            return None, None, 'no ticker'
+
+        first_index = df_non_null_ticker.index[0]
+        print('first index with a ticker: ', first_index)
+        df_tkr = df_tkr.loc[first_index:]
+        row0 = df_tkr.iloc[0]  # reset row0
+
+    if row0["PRIMEXCH"] == "X":  # skip exchange X
+        return None, None, 'exchange X'
+
+    print(" preparing {} / {} ".format(row0["TSYMBOL"],
+                                       row0["PRIMEXCH"]))
+
+    if HURRICANE_SANDY_ER in df_tkr.index:
+        print('contains HURRICANE Sandy')
+        df_tkr = df_tkr.copy()
+        # copy dividend dates
+        df_tkr.loc[HURRICANE_SANDY_FD, DIV_COLUMNS] = df_tkr.loc[HURRICANE_SANDY_ER, DIV_COLUMNS].values
+        # delete extra day
+        df_tkr = df_tkr.drop(HURRICANE_SANDY_ER)
+
+    # check to see if there are missing dates in the middle
+    this_cal, missing_dates = calendar_gaps(df_tkr.index, sessions)
+
+    if len(this_cal) == 0 or df_tkr.shape[0]/float(len(this_cal)) < ALLOWED_MISSING_DATES_RATIO:
+        print('too many missing dates, skipping ticker')
+        return None, None, 'too many missing dates'
+
+    if len(this_cal) != df_tkr.shape[0]:
+        print(len(this_cal), df_tkr.shape[0])  # the ticker has more rows than the calendar (traded on non-trading day?)
+        print("MISSING interstitial dates for: %s" % row0["TSYMBOL"])
+        print("dates missing: ", list(missing_dates))
+
+        # detect delisting pattern and fix
+        if this_cal[-(len(missing_dates) + 1):-1].equals(missing_dates):
+            print("all missing dates lead to end, dropping last two rows")
+            # delete last two rows of df_tkr
+            df_tkr = df_tkr.iloc[:-2]
+        else:
+            return None, None, '{} missing interstitial dates'.format(len(missing_dates))
+
+    this_cal_post, _ = calendar_gaps(df_tkr.index, sessions)
+    if len(this_cal_post) != df_tkr.shape[0]:
+        print('calendar not correct, has {} dates, please fix'.format(df_tkr.shape[0]))
+        print('This could be dividends released on the weekend.')
+        return None, None, 'dates not on the calendar'
+
+    cusip_ticker = '{}-{}'.format(row0['CUSIP'], row0['TSYMBOL'])
+    # 'start_date', 'end_date', 'auto_close_date',
+    # 'symbol', 'exchange', 'asset_name'
+    metadata = (df_tkr.index[0],
+                df_tkr.index[-1],
+                df_tkr.index[-1] + pd.Timedelta(days=1),
+                cusip_ticker,   # store CUSIP-ticker as ticker, Zipline cannot reuse tickers
+                row0['PRIMEXCH'],
+                row0['CUSIP']  #permno,    # store CRSP permno for company name
+                )
+
+    # drop metadata columns
+    df_tkr = df_tkr.assign(close=df_tkr['PRC'].abs())  # take abs(close) for esitmated values
+
+    OHLCV_COLUMNS = ['close', 'VOL', 'ASKHI', 'BIDLO', 'OPENPRC']
+    df_tkr = df_tkr.drop([col for col in df_tkr.columns if col not in OHLCV_COLUMNS], axis=1)
+
+    # rename volume, high, low, open
+    df_tkr = df_tkr.rename(columns={"VOL": "volume",
+                                    "ASKHI": "high",
+                                    "BIDLO": "low",
+                                    "OPENPRC": "open"})
+    return metadata, df_tkr, None
+
+
+def drop_rows_off_calendar(df, calendar):
+    """
+    Drops the rows of the dump dated before the first or after the last session
+    of calendar, Zipline cannot store them.  Returns the remaining rows and the
+    (permno, ticker, reason) problems of the securities that lost rows.
+    """
+    outside = (df.index < calendar.first_session) | (df.index > calendar.last_session)
+    problems = []
+    if outside.any():
+        kept_permnos = set(df.loc[~outside, 'PERMNO'])
+        for permno, df_out in df[outside].groupby('PERMNO', sort=False):
+            tickers = df_out['TSYMBOL'].dropna()
+            reason = 'no dates on the calendar' if permno not in kept_permnos else \
+                '{} rows outside the calendar dropped'.format(df_out.shape[0])
+            problems.append((permno, tickers.iloc[0] if len(tickers) else None, reason))
+        df = df[~outside]
+    return df, problems
+
+
+def write_problem_report(problems, report_file=None):
+    """Prints the securities that were skipped or trimmed and why, optionally saves them as a .csv"""
+    report = pd.DataFrame(problems, columns=['PERMNO', 'TSYMBOL', 'reason'])
+    print("{} securities skipped or trimmed:".format(report.shape[0]))
+    if report.shape[0] > 0:
+        print(report.groupby('reason').size().to_string())
+    if report_file is not None:
+        report.to_csv(report_file, index=False)
+        print("problem report written to: {}".format(report_file))
+    return report
+
+
+def parse_crsp_dates(dates):
+    """CRSP dates come either as YYYYMMDD numbers or as date strings, NaT where absent."""
+    if pd.api.types.is_numeric_dtype(dates):
+        return pd.to_datetime(dates.astype('Int64').astype(str), format='%Y%m%d', errors='coerce')
+    return pd.to_datetime(dates, errors='coerce')
+
+
+def build_crsp_adjustments(df_adj, permno2sid_map):
+    """
+    Builds the splits and dividends frames for the adjustment_writer in one
+    pass.  df_adj has a date index and the PERMNO and DIV_COLUMNS columns
+    (other columns are ignored), permno2sid_map maps the loaded PERMNOs to
+    sids, rows of any other PERMNO are dropped.
+    A FACPR of 0 is a dividend, -1 a stock going away, anything else a split.
+    """
+    # drop rows where FACPR is absent
+    # the splits that have declare date absent will be dropped as well
+    df_adj = df_adj[pd.notnull(df_adj['FACPR'])]
+    print("number of non-NaN rows: ", df_adj.shape[0])
+
+    # map PERMNOs to sids, this also drops the rows of skipped securities
+    sids = df_adj['PERMNO'].map(permno2sid_map)
+    loaded = sids.notnull().values
+    df_adj = df_adj[loaded]
+    sids = sids.values[loaded].astype('int64')
+    print("number of non-NaN rows, after dropping skipped permnos: ", df_adj.shape[0])
+
+    facpr = df_adj['FACPR'].values
+    is_dividend = facpr == 0.0
+    is_split = ~is_dividend & (facpr != -1.0)  # drop rows where FACPR is -1.0 (stock going away)
+    dates = df_adj.index
+
+    dfd = pd.DataFrame({'sid': sids[is_dividend],
+                        'ex_date': dates[is_dividend],
+                        'declared_date': parse_crsp_dates(df_adj['DCLRDT']).values[is_dividend],
+                        'record_date': parse_crsp_dates(df_adj['RCRDDT']).values[is_dividend],
+                        'pay_date': parse_crsp_dates(df_adj['PAYDT']).values[is_dividend],
+                        'amount': df_adj['DIVAMT'].values[is_dividend].astype('float64')},
+                       index=dates[is_dividend])
+
+    dfs = pd.DataFrame({'sid': sids[is_split],
+                        'effective_date': dates[is_split],
+                        'ratio': 1.0 / (1 + facpr[is_split])},
+                       index=dates[is_split])
+
+    print('extreme split values')
+    print(dfs[(dfs['ratio'] > 100) | (dfs['ratio'] < 0.01)])
+    print("number of rows in splits: {}".format(dfs.shape[0]))
+    return dfs, dfd
+
+
+def from_crsp_dump(file_name, start=None, end=None, report_file=None):
     """
     Load data from a CRSP daily stock dump, the following fields are assumed to
     be in the dump: date, PERMCO TSYMBOL PRIMEXCH PRC VOL OPENPRC ASKHI BIDLO DIVAMT FACPR DCLRDT RCRDDT PAYDT
@@ -39,8 +227,12 @@ def from_crsp_dump(file_name, start=None, end=None):
     register("crsp",
          from_crsp_dump("/path/to/your/CRSP/dump/7112bc373f6a4ba8.csv"),)
 
+    Securities that cannot be loaded (no ticker, too many missing dates, dates
+    off the NYSE calendar...) are skipped and listed at the end of the ingest,
+    as are the securities that lost rows dated outside the calendar (before
+    1990).  Pass report_file="/path/to/problems.csv" to also save that list.
     """
-    us_calendar = get_calendar("NYSE").all_sessions
+    us_calendar = get_calendar("NYSE")
 
     def ingest(environ,
                asset_db_writer,
@@ -61,126 +253,44 @@ def from_crsp_dump(file_name, start=None, end=None):
         df = pd.read_csv(file_name, index_col='date',
                          parse_dates=['date'], na_values=['NA'])
 
+        # rows before 1990 or past the end of the calendar cannot be written
+        df, problems = drop_rows_off_calendar(df, us_calendar)
+
+        # the few rows with a dividend or split, in file order
+        df_adj = df.loc[pd.notnull(df['FACPR']), ['PERMNO'] + DIV_COLUMNS]
+
         uv = df.PERMNO.unique()  # get unique PERMNO (CRSP primary key, doesn't change)
 
+        # one stable sort, then every security is a contiguous block of rows
+        df = df.iloc[np.lexsort((df.index.values, df['PERMNO'].values))]
+        sessions = us_calendar.sessions_in_range(df.index.min(), df.index.max()).tz_localize(None)
+
         # counter of valid securites
         sec_counter = 0
         data_list = []  # list to send to daily_bar_writer
         metadata_list = []  # list to send to asset_db_writer (metadata)
         permno2sid_map = {}
-        skipped_permnos = []
 
         # iterate over all the unique securities (CRSP permno) and pack data,
-        for permno in uv:  # TODO: See sep data loader for a faster way of doing this.
-            df_tkr = df[df['PERMNO'] == permno]
-            df_tkr = df_tkr[~df_tkr.index.duplicated(keep='first')]
-
-            # could drop all rows where the ticker is null
-            # df_tkr = df_tkr[~pd.isnull(df_tkr['TSYMBOL'])]
-
-            row0 = df_tkr.ix[0]  # get metadata from row
-
-            # need to find the first row with a ticker.
-            if pd.isnull(row0['TSYMBOL']):
-                print('no ticker on first line, finding first line with ticker')
-                df_non_null_ticker = df_tkr[~pd.isnull(df_tkr['TSYMBOL'])]
-                if df_non_null_ticker.shape[0] == 0:
-                    print('no ticker, skipping')
-                    skipped_permnos.append(permno)
-                    continue
-
-                first_index = df_non_null_ticker.index[0]
-                print('first index with a ticker: ', first_index)
-                df_tkr = df_tkr.loc[first_index:]
-                row0 = df_tkr.ix[0]  # reset row0
-
-                # # try 2nd row
-                # if df_tkr.shape[0] > 1 and not pd.isnull(df_tkr.ix[1]["TSYMBOL"]):
-                #     print('first row missing ticker, dropping first row')
-                #     df_tkr = df_tkr.drop(df_tkr.index[0])
-                #     row0 = df_tkr.ix[0]
-                # else:
-                #     print "no ticker skipping"
-                #     continue
-
-            if row0["PRIMEXCH"] == "X":  # skip exchange X
-                skipped_permnos.append(permno)
+        # in the order they first appear in the dump
+        groups = df.groupby('PERMNO', sort=False)
+        for permno in uv:
+            df_tkr = groups.get_group(permno)
+            metadata, df_ohlcv, reason = prepare_security(permno, df_tkr, sessions)
+            if reason is not None:
+                tickers = df_tkr['TSYMBOL'].dropna()
+                problems.append((permno, tickers.iloc[0] if len(tickers) else None, reason))
                 continue
 
-            print(" preparing {} / {} ".format(row0["TSYMBOL"],
-                                               row0["PRIMEXCH"]))
-
-            if HURRICANE_SANDY_ER in df_tkr.index:
-                print('contains HURRICANE Sandy')
-                # copy dividend dates
-                df_tkr.loc[HURRICANE_SANDY_FD, DIV_COLUMNS] = df_tkr.loc[HURRICANE_SANDY_ER, DIV_COLUMNS].values
-                # delete extra day
-                df_tkr = df_tkr.drop(HURRICANE_SANDY_ER)
-
-            # check to see if there are missing dates in the middle
-            this_cal = us_calendar[(us_calendar >= df_tkr.index[0]) & (us_calendar <= df_tkr.index[-1])]
-
-            if df_tkr.shape[0]/float(len(this_cal)) < ALLOWED_MISSING_DATES_RATIO:
-                print('too many missing dates, skipping ticker')
-                skipped_permnos.append(permno)
-                continue
-
-            if len(this_cal) != df_tkr.shape[0]:
-                print(len(this_cal), df_tkr.shape[0])  # the ticker has more rows than the calendar (traded on non-trading day?)
-                emptyDF = pd.DataFrame(index=this_cal)
-                emptyDF.index.tz = None
-                print("MISSING interstitial dates for: %s please fix" % row0["TSYMBOL"])
-                print(df_tkr.join(emptyDF, how='outer'))
-                missing_dates = set(emptyDF.index) - set(df_tkr.index)
-                print("dates missing: ", missing_dates)
-
-                # detect delisting pattern and fix
-                if set(emptyDF.index[-(len(missing_dates) + 1):-1]) == missing_dates:
-                    print("all missing dates lead to end, dropping last two rows")
-                    # delete last two rows of df_tkr
-                    df_tkr = df_tkr.drop(df_tkr.index[-2:])
-                else:
-                    sys.exit()
-
-            this_cal_post = us_calendar[(us_calendar >= df_tkr.index[0]) & (us_calendar <= df_tkr.index[-1])]
-            if len(this_cal_post) != df_tkr.shape[0]:
-                print('calendar not correct, has {} dates, please fix'.format(df_tkr.shape[0]))
-                print('This could be dividends released on the weekend.')
-                sys.exit()
-
-            cusip_ticker = '{}-{}'.format(row0['CUSIP'], row0['TSYMBOL'])
-            # update metadata; 'start_date', 'end_date', 'auto_close_date',
-            # 'symbol', 'exchange', 'asset_name'
-            metadata_list.append((df_tkr.index[0],
-                                  df_tkr.index[-1],
-                                  df_tkr.index[-1] + pd.Timedelta(days=1),
-                                  cusip_ticker,   # store CUSIP-ticker as ticker, Zipline cannot reuse tickers
-                                  row0['PRIMEXCH'],
-                                  row0['CUSIP']  #permno,    # store CRSP permno for company name
-                                  )
-                                 )
-
-            # drop metadata columns
-            df_tkr.loc[:, 'close'] = abs(df_tkr['PRC'])  # take abs(close) for esitmated values
-
-            OHLCV_COLUMNS = ['close', 'VOL', 'ASKHI', 'BIDLO', 'OPENPRC']
-            df_tkr = df_tkr.drop([col for col in df_tkr.columns if col not in OHLCV_COLUMNS], axis=1)
-            # df_tkr = df_tkr.drop(['TSYMBOL', 'PERMNO',
-            #                       'PERMCO', 'PRIMEXCH', 'PRC', 'CUSIP',
-            #                       u'DCLRDT', u'PAYDT', u'RCRDDT', u'DIVAMT', u'FACPR', u'NWPERM'], axis=1)
-
-
-            # rename volume, high, low, open
-            df_tkr = df_tkr.rename(columns={"VOL": "volume",
-                                            "ASKHI": "high",
-                                            "BIDLO": "low",
-                                            "OPENPRC": "open"})
+            metadata_list.append(metadata)
 
             # pack data to be written by daily_bar_writer
-            data_list.append((sec_counter, df_tkr))  # zipline will only use this permno as ref to match adjustments
+            data_list.append((sec_counter, df_ohlcv))  # zipline will only use this permno as ref to match adjustments
             permno2sid_map[permno] = sec_counter  # record the sid for use later
             sec_counter += 1
 
+        write_problem_report(problems, report_file)
+
         print("writing data for {} securities".format(len(metadata_list)))
         daily_bar_writer.write(data_list, show_progress=False)
 
@@ -190,54 +300,8 @@ def from_crsp_dump(file_name, start=None, end=None):
         print("**a total of {} securities were loaded into this bundle **".format(
             sec_counter))
 
-        # read in Dividend History
-        # dataframe for dividends and splits
-        dfds = pd.read_csv(file_name, index_col='date',
-                             parse_dates=['date'], na_values=['NA'])
-
-        if 'NWPERM' in dfds.columns:  # todo this could be replaced with a whitelist
-            dfds = dfds.drop(['NWPERM'], axis=1)
-        if 'SHRCD' in dfds.columns:
-            dfds = dfds.drop(['SHRCD'], axis=1)
-        print(dfds)
-
-        # drop rows where FACPR is absent
-        dfds = dfds[pd.notnull(dfds['FACPR'])]
-        # the splits that have declare date absent will be dropped as well
-        print("number of non-NaN rows: ", dfds.shape[0])
-
-        # drop rows of skipped securities
-        dfds = dfds[~dfds['PERMNO'].isin(skipped_permnos)]
-        print("number of non-NaN rows, after dropping skipped permnos: ", dfds.shape[0])
-
-        # create sid column by mapping PERMNOs to sids
-        dfds.loc[:, 'sid'] = dfds.loc[:, 'PERMNO'].apply(lambda x: permno2sid_map[x])
-        dfds = dfds.drop(["VOL", "ASKHI", "BIDLO", "OPENPRC",
-                              'PERMCO', 'PRIMEXCH', 'PRC', 'PERMNO', 'CUSIP'], axis=1)
-
-        # if FACPR == 0, then those are dividend, else it is a split
-        dfd = dfds[dfds["FACPR"] == 0.0]  # dividend
-        dfd.loc[:, 'ex_date'] = dfd.index
-        dfd = dfd.rename(columns={'DCLRDT': 'declared_date',
-                                  'PAYDT': 'pay_date',
-                                  'RCRDDT': 'record_date',
-                                  'DIVAMT': 'amount'})
-        dfd = dfd.drop(['FACPR', 'TSYMBOL'], axis=1)
-
-        # move splits into desired format
-        dfs = dfds[dfds["FACPR"] != 0.0]  # splits
-        # drop rows where FACPR is -1.0 (stock going away)
-        dfs = dfs[dfs['FACPR'] != -1.0]
-
-        dfs.loc[:, 'effective_date'] = dfs.index
-        dfs.loc[:, 'ratio'] = 1.0 / (1 + dfs.loc[:,'FACPR'])
-
-        print('extreme split values')
-        print(dfs[(dfs['ratio'] > 100) | (dfs['ratio'] < 0.01)])
-
-        dfs = dfs.drop(['TSYMBOL', 'DCLRDT', 'PAYDT', 'RCRDDT', 'DIVAMT', 'FACPR'], axis=1)
-
-        print("number of rows in splits: {}".format(dfs.shape[0]))
+        # dividends and splits, from the rows kept aside when the dump was read
+        dfs, dfd = build_crsp_adjustments(df_adj, permno2sid_map)
 
         # write adjustments
         adjustment_writer.write(splits=dfs, dividends=dfd)
@@ -4,15 +4,20 @@ Created by Peter Harrington (pbharrin) on 9/22/2021.
 """
 
 
+import os
+from functools import partial
+import numpy as np
 import pandas as pd
-from os import listdir
 from alphacompiler.util.crypto_trading_calendar import TwentyFourSevenCal
+from alphacompiler.data.loaders.dir_ingest import iter_dir_files, print_skip_summary, SkipFile
+from alphacompiler.data.crypto_scales import uint32_scales, save_scales, SCALES_FILE
+from zipline.utils.paths import zipline_root
 
 METADATA_HEADERS = ['start_date', 'end_date', 'auto_close_date',
                     'symbol', 'exchange', 'asset_name']
 
 MISSING_DAYS_THRESH = 20  # max allowable number of missing dates (in 15 years)
-UINT32_MAX = 4294967295
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
 
 # Exchange Metadata (for country code mapping)
 exchange_d = {'exchange': ['CRYPTO'], 'canonical_name': ['CRYPTO'], 'country_code': ['US']}
@@ -23,24 +28,56 @@ TRUE_STARTS = {'BCH': pd.to_datetime('2017-08-09', utc=True),
 
 def scale_df_for_uint32(dfin):
     """
-    Dynamically scales the price and volume so that they fit into uint32.
-    Preserves market cap.
+    Scales the prices and volume by powers of 2 so that they fit into uint32,
+    see uint32_scales().  Returns the scaled DataFrame and the price and
+    volume scale factors.
     """
-    sf = 2.0  # scale factor
     if dfin['low'].min() <= 0:  # for debug purposes
         print('adjusting for less or equal to 0')
         print('the min is: ', dfin['low'].idxmin())
 
-    while dfin['low'].min() < 10:
-        dfin['volume'] = dfin['volume'] / sf
-        for field in ['open', 'high', 'low', 'close']:
-            dfin[field] = dfin[field] * sf
+    price_scale, volume_scale = uint32_scales(dfin)
+    dfout = dfin.copy()
+    dfout[PRICE_COLUMNS] = dfin[PRICE_COLUMNS] * price_scale
+    dfout['volume'] = dfin['volume'] * volume_scale
+    return dfout, price_scale, volume_scale
 
-    dfin['volume'] = UINT32_MAX - 1
-    return dfin
 
+def prepare_crypto_file(path, calendar):
+    """
+    Reads the file of one coin, returns the ticker (the file name without
+    extension), the OHLCV DataFrame reindexed to the sessions of calendar and
+    scaled to fit in uint32, and the (price, volume) scale factors.
+    """
+    tkr = os.path.basename(path).split('.')[0]
+    try:
+        df_tkr = pd.read_csv(path, index_col='timestamp',
+                             parse_dates=['timestamp'], na_values=['NA'])
+    except pd.errors.EmptyDataError:
+        raise SkipFile('no data')
+
+    #print(f'the min value of this ticker is: {df_tkr.idxmin()}')
+    df_tkr = df_tkr.sort_index()
+    if tkr in TRUE_STARTS:
+        df_tkr = df_tkr[df_tkr.index >= TRUE_STARTS[tkr]]
+
+    # check to see if there are missing interstitial dates
+    this_cal = calendar.sessions_in_range(df_tkr.index[0], df_tkr.index[-1])
+
+    num_missing_dates = len(this_cal) - df_tkr.shape[0]
+    if num_missing_dates > MISSING_DAYS_THRESH:
+        raise SkipFile(f'too many missing dates({num_missing_dates}) for {tkr}')
+    # fill in missing dates with NaNs
+    df_tkr = df_tkr.reindex(this_cal)
 
-def from_crypto_dir(folder_name, start=None, end=None):
+    # divide the volume by 1000
+    # df_tkr['volume'] = df_tkr['volume']/1000
+
+    df_tkr, price_scale, volume_scale = scale_df_for_uint32(df_tkr)
+    return tkr, df_tkr, (price_scale, volume_scale)
+
+
+def from_crypto_dir(folder_name, start=None, end=None, workers=1, processes=False):
     """
     Crypto data (from Messari) will look like this:
     timestamp,open,high,low,close,volume
@@ -51,6 +88,12 @@ def from_crypto_dir(folder_name, start=None, end=None):
     from zipline.data.bundles import register
     from alphacompiler.data.loaders.crypto import from_crypto_dir
     register("crypto", from_crypto_dir("/path/to/crypto/data/dir"),)
+    Files are read in sorted order, pass workers=8 (or so) to read them with a
+    pool of threads.  Empty or broken files are skipped and listed at the end.
+
+    Prices and volumes are scaled by powers of 2 to fit the bcolz uint32
+    columns, the factors are saved by sid in $ZIPLINE_ROOT/data/crypto_scales.npy,
+    use the CryptoScales factor to get back to the true values.
     """
     ticker2sid_map = {}
     us_calendar = TwentyFourSevenCal()
@@ -70,61 +113,44 @@ def from_crypto_dir(folder_name, start=None, end=None):
 
         print("starting ingesting data from: {}".format(folder_name))
 
-        # counter of valid securites, this will be our primary key
-        sec_counter = 0
-        data_list = []  # list to send to daily_bar_writer
         metadata_list = []  # list to send to asset_db_writer (metadata)
-
-        # iterate over all the unique securities and pack data, and metadata
-        # for writing
-        for fn in listdir(folder_name):
-            print('preparing {}'.format(fn))
-            tkr = fn.split('.')[0]
-            try:
-                df_tkr = pd.read_csv(folder_name + fn, index_col='timestamp',
-                                     parse_dates=['timestamp'], na_values=['NA'])
-            except pd.errors.EmptyDataError:
-                print('No data in: {}, skipping.'.format(fn))
-                continue
-
-            #print(f'the min value of this ticker is: {df_tkr.idxmin()}')
-            df_tkr = df_tkr.sort_index()
-            if tkr in TRUE_STARTS:
-                df_tkr = df_tkr[df_tkr.index >= TRUE_STARTS[tkr]]
-
-            # check to see if there are missing interstitial dates
-            this_cal = us_calendar.sessions_in_range(df_tkr.index[0], df_tkr.index[-1])
-
-            num_missing_dates = len(this_cal) - df_tkr.shape[0]
-            if num_missing_dates > MISSING_DAYS_THRESH:
-                print(f'too many missing dates({num_missing_dates}) for {tkr}, skipping')
-                continue
-            # fill in missing dates with NaNs
-            df_tkr = df_tkr.reindex(this_cal)
-
-            # divide the volume by 1000
-            # df_tkr['volume'] = df_tkr['volume']/1000
-
-            df_tkr = scale_df_for_uint32(df_tkr)
-
-            # update metadata; 'start_date', 'end_date', 'auto_close_date',
-            # 'symbol', 'exchange', 'asset_name'
-            metadata_list.append((df_tkr.index[0],
-                                  df_tkr.index[-1],
-                                  df_tkr.index[-1] + pd.Timedelta(days=1),
-                                  tkr,
-                                  "CRYPTO",  # all have exchange = IEX
-                                  tkr,
-                                  )
-                                 )
-
-            # pack data to be written by daily_bar_writer
-            data_list.append((sec_counter, df_tkr))
-            ticker2sid_map[tkr] = sec_counter  # record the sid for use later
-            sec_counter += 1
-
-        print("writing data for {} securities".format(len(metadata_list)))
-        daily_bar_writer.write(data_list, show_progress=True)
+        scales = []  # (price, volume) scale factors, by sid
+        skipped = []
+        prepare = partial(prepare_crypto_file, calendar=us_calendar)
+
+        def bars():
+            """pack data, and metadata for writing, as the files are read"""
+            for fn, (tkr, df_tkr, tkr_scales) in iter_dir_files(folder_name, prepare, workers,
+                                                               processes, skipped):
+                print('prepared {}'.format(fn))
+                # update metadata; 'start_date', 'end_date', 'auto_close_date',
+                # 'symbol', 'exchange', 'asset_name'
+                metadata_list.append((df_tkr.index[0],
+                                      df_tkr.index[-1],
+                                      df_tkr.index[-1] + pd.Timedelta(days=1),
+                                      tkr,
+                                      "CRYPTO",  # all have exchange = IEX
+                                      tkr,
+                                      )
+                                     )
+
+                scales.append(tkr_scales)
+
+                # the position in metadata_list is our primary key (sid)
+                sid = len(metadata_list) - 1
+                ticker2sid_map[tkr] = sid  # record the sid for use later
+                yield sid, df_tkr
+
+        # the writer consumes the bars as the files are read
+        daily_bar_writer.write(bars(), show_progress=True)
+        print_skip_summary(skipped)
+        sec_counter = len(metadata_list)
+
+        # the scale factors are needed to get back to the true prices and volumes
+        scales_dir = os.path.join(zipline_root(environ), 'data')
+        os.makedirs(scales_dir, exist_ok=True)
+        scales = np.array(scales).reshape(-1, 2)
+        save_scales(scales[:, 0], scales[:, 1], os.path.join(scales_dir, SCALES_FILE))
 
         # write metadata
         asset_db_writer.write(equities=pd.DataFrame(metadata_list,
@@ -0,0 +1,79 @@
+"""
+Shared helpers for the bundle loaders that read one file per ticker from a
+directory (IEX, crypto).
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pandas as pd
+
+# errors of a broken file, anything else is a bug and stops the ingest
+PARSE_ERRORS = (pd.errors.ParserError, ValueError)
+
+
+class SkipFile(Exception):
+    """Raised by a prepare function when a file should not be loaded, the message is the reason."""
+    pass
+
+
+def prepare_or_skip(prepare, path):
+    """Runs prepare(path), returns (result, None) or (None, reason) when the file has to be skipped.
+    Only SkipFile and the PARSE_ERRORS of a broken file skip it, other exceptions propagate."""
+    try:
+        return prepare(path), None
+    except SkipFile as e:
+        return None, str(e)
+    except PARSE_ERRORS as e:  # broken file, we do not want one file to stop the ingest
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def iter_dir_files(folder_name, prepare, workers=1, processes=False, skipped=None):
+    """
+    Calls prepare(path) on every file in folder_name and yields
+    (file name, result).  Files are handled in sorted file name order, so the
+    sids handed out by the caller are the same on every run.
+
+    Files for which prepare raises SkipFile or one of PARSE_ERRORS are not
+    yielded, (file name, reason) is appended to skipped instead.
+    With workers > 1 the files are read by a pool of threads (or processes
+    with processes=True, then prepare has to be a module level function).  The
+    results still come back in order, and at most 2 * workers of them are held
+    at a time, so this can feed daily_bar_writer.write() directly.
+    """
+    if skipped is None:
+        skipped = []
+    file_names = sorted(os.listdir(folder_name))
+    paths = [os.path.join(folder_name, fn) for fn in file_names]
+
+    if workers <= 1:
+        results = (prepare_or_skip(prepare, path) for path in paths)
+    else:
+        results = _pool_results(prepare, paths, workers, processes)
+
+    for fn, (result, reason) in zip(file_names, results):
+        if reason is not None:
+            print('SKIPPING {}: {}'.format(fn, reason))
+            skipped.append((fn, reason))
+            continue
+        yield fn, result
+
+
+def _pool_results(prepare, paths, workers, processes):
+    """Yields prepare_or_skip() of every path in order, with a bounded number in flight."""
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(prepare_or_skip, prepare, path))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def print_skip_summary(skipped):
+    """Prints the files skipped by iter_dir_files()."""
+    print("skipped {} files".format(len(skipped)))
+    for fn, reason in skipped:
+        print("  {}: {}".format(fn, reason))
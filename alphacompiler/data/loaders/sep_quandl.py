@@ -8,6 +8,7 @@ Created by Peter Harrington (pbharrin) on 3/8/18.
 import pandas as pd
 # from zipline.utils.calendars import get_calendar # zipline Quantopian 
 from zipline.utils.calendar_utils import get_calendar # zipline-reloaded
+from multiprocessing import Pool
 import sys
 
 # Exchange Metadata (for country code mapping)
@@ -17,6 +18,8 @@ exchange_d = {'exchange': [EXCHANGE_NAME], 'canonical_name': [EXCHANGE_NAME], 'c
 METADATA_HEADERS = ['start_date', 'end_date', 'auto_close_date',
                     'symbol', 'exchange', 'asset_name']
 
+IMAP_CHUNKSIZE = 64  # tickers sent to a worker process at a time
+
 
 def check_for_abnormal_returns(df, thresh=3.0):
     """Checks to see if any days have abnormal returns"""
@@ -27,7 +30,76 @@ def check_for_abnormal_returns(df, thresh=3.0):
         sys.stderr.write('{}\n'.format(str(abnormal_rets)))
 
 
-def from_sep_dump(file_name, start=None, end=None):
+def get_us_calendar():
+    """The calendar used to find missing sessions, zipline caches it so this is
+    cheap to call once per ticker (and once per worker process)."""
+    # return get_calendar("NYSE").all_sessions # zipline Quantopian
+    return get_calendar("XNYS")  # zipline-reloaded
+
+
+def prepare_ticker(tkr_and_df):
+    """
+    Prepares the data of a single ticker for the daily_bar_writer, takes a
+    (ticker, DataFrame) pair as produced by groupby('ticker').
+    Returns the metadata tuple and the OHLCV DataFrame with interstitial dates
+    forward filled.  This is a module level function so it can be sent to a
+    worker process.
+    """
+    tkr, df_tkr = tkr_and_df
+    df_tkr = df_tkr.sort_index()
+
+    row0 = df_tkr.iloc[0]  # get metadata from row
+
+    print(" preparing {}".format(row0["ticker"]))
+    check_for_abnormal_returns(df_tkr)
+
+    # check to see if there are missing dates in the middle
+    # this_cal = us_calendar[(us_calendar >= df_tkr.index[0]) & (us_calendar <= df_tkr.index[-1])]  # zipline Quantopian
+    this_cal = get_us_calendar().sessions_in_range(df_tkr.index[0], df_tkr.index[-1])  # zipline-reloaded
+
+    if len(this_cal) != df_tkr.shape[0]:
+        print('MISSING interstitial dates for: %s using forward fill' % row0["ticker"])
+        print('number of dates missing: {}'.format(len(this_cal) - df_tkr.shape[0]))
+        df_desired = pd.DataFrame(index=this_cal.tz_localize(None))
+        df_desired = df_desired.join(df_tkr)
+        df_tkr = df_desired.ffill()
+
+    # 'start_date', 'end_date', 'auto_close_date',
+    # 'symbol', 'exchange', 'asset_name'
+    metadata = (df_tkr.index[0],
+                df_tkr.index[-1],
+                df_tkr.index[-1] + pd.Timedelta(days=1),
+                row0["ticker"],
+                EXCHANGE_NAME,  # all have exchange = NYSE, even though this is not true
+                row0["ticker"]
+                )
+
+    # drop metadata columns
+    return metadata, df_tkr.drop(['ticker'], axis=1)
+
+
+def prepare_tickers(df, workers=1):
+    """
+    Yields (ticker, metadata, DataFrame) for every ticker in df, in sorted
+    ticker order.  With workers > 1 the preparation is spread over a pool of
+    processes, results still come back in the same order as the serial path.
+    """
+    groups = df.groupby('ticker')
+    if workers <= 1:
+        for tkr, df_tkr in groups:
+            metadata, df_tkr = prepare_ticker((tkr, df_tkr))
+            yield tkr, metadata, df_tkr
+        return
+
+    tickers = list(groups.groups.keys())
+    with Pool(workers) as pool:
+        # imap keeps the input order, chunks keep the IPC overhead down
+        prepared = pool.imap(prepare_ticker, groups, chunksize=IMAP_CHUNKSIZE)
+        for tkr, (metadata, df_tkr) in zip(tickers, prepared):
+            yield tkr, metadata, df_tkr
+
+
+def from_sep_dump(file_name, start=None, end=None, workers=1):
     """
     ticker,date,open,high,low,close,volume,dividends,lastupdated
     A,2008-01-02,36.67,36.8,36.12,36.3,1858900.0,0.0,2017-11-01
@@ -40,9 +112,10 @@ def from_sep_dump(file_name, start=None, end=None):
     register("sep",
          from_sep_dump("/path/to/your/SEP/dump/SHARADAR_SEP_69.csv"),)
 
+    The per ticker preparation (calendar check and forward fill) is CPU bound,
+    pass workers=4 (or so) to spread it over several processes, the bundle
+    written is the same as with workers=1.
     """
-    # us_calendar = get_calendar("NYSE").all_sessions # zipline Quantopian 
-    us_calendar = get_calendar("XNYS") # zipline-reloaded
     ticker2sid_map = {}
 
     def ingest(environ,
@@ -64,7 +137,13 @@ def from_sep_dump(file_name, start=None, end=None):
         df = pd.read_csv(file_name, index_col='date',
                          parse_dates=['date'], na_values=['NA'])
 
-        # drop unused columns, dividends will be used later
+        # keep the (few) dividend rows for later, so the dump only gets parsed once
+        # drop rows where dividends == 0.0
+        dfd = df[df["dividends"] != 0.0]
+        dfd = dfd.dropna()
+        dfd = dfd[['ticker', 'dividends']]
+
+        # drop unused columns
         df = df.drop(['lastupdated', 'dividends', 'closeunadj'], axis=1)
 
         # counter of valid securites, this will be our primary key
@@ -73,39 +152,10 @@ def from_sep_dump(file_name, start=None, end=None):
         metadata_list = []  # list to send to asset_db_writer (metadata)
 
         # iterate over all the unique securities and pack data, and metadata
-        # for writing
-        for tkr, df_tkr in df.groupby('ticker'):
-            df_tkr = df_tkr.sort_index()
-
-            row0 = df_tkr.iloc[0]  # get metadata from row
-
-            print(" preparing {}".format(row0["ticker"]))
-            check_for_abnormal_returns(df_tkr)
-
-            # check to see if there are missing dates in the middle
-            # this_cal = us_calendar[(us_calendar >= df_tkr.index[0]) & (us_calendar <= df_tkr.index[-1])]  # zipline Quantopian 
-            this_cal = us_calendar.sessions_in_range(df_tkr.index[0], df_tkr.index[-1]) # zipline-reloaded
-          
-            if len(this_cal) != df_tkr.shape[0]:
-                print('MISSING interstitial dates for: %s using forward fill' % row0["ticker"])
-                print('number of dates missing: {}'.format(len(this_cal) - df_tkr.shape[0]))
-                df_desired = pd.DataFrame(index=this_cal.tz_localize(None))
-                df_desired = df_desired.join(df_tkr)
-                df_tkr = df_desired.fillna(method='ffill')
-
-            # update metadata; 'start_date', 'end_date', 'auto_close_date',
-            # 'symbol', 'exchange', 'asset_name'
-            metadata_list.append((df_tkr.index[0],
-                                  df_tkr.index[-1],
-                                  df_tkr.index[-1] + pd.Timedelta(days=1),
-                                  row0["ticker"],
-                                  EXCHANGE_NAME,  # all have exchange = NYSE, even though this is not true
-                                  row0["ticker"]
-                                  )
-                                 )
-
-            # drop metadata columns
-            df_tkr = df_tkr.drop(['ticker'], axis=1)
+        # for writing, sids are handed out in ticker order so they do not
+        # depend on the number of workers
+        for tkr, metadata, df_tkr in prepare_tickers(df, workers):
+            metadata_list.append(metadata)
 
             # pack data to be written by daily_bar_writer
             data_list.append((sec_counter, df_tkr))
@@ -122,18 +172,12 @@ def from_sep_dump(file_name, start=None, end=None):
         print("a total of {} securities were loaded into this bundle".format(
             sec_counter))
 
-        # read in Dividend History
-        dfd = pd.read_csv(file_name, index_col='date',
-                         parse_dates=['date'], na_values=['NA'])
-        # drop rows where dividends == 0.0
-        dfd = dfd[dfd["dividends"] != 0.0]
-        dfd = dfd.dropna()
-
+        # Dividend History
         dfd.loc[:, 'ex_date'] = dfd.loc[:, 'record_date'] = dfd.index
         dfd.loc[:, 'declared_date'] = dfd.loc[:, 'pay_date'] = dfd.index
-        dfd.loc[:, 'sid'] = dfd.loc[:, 'ticker'].apply(lambda x: ticker2sid_map[x])
+        dfd.loc[:, 'sid'] = dfd.loc[:, 'ticker'].map(ticker2sid_map)
         dfd = dfd.rename(columns={'dividends': 'amount'})
-        dfd = dfd.drop(['open', 'high', 'low', 'close', 'volume', 'lastupdated', 'ticker', 'closeunadj'], axis=1)
+        dfd = dfd.drop(['ticker'], axis=1)
 
         # # format dfd to have sid
         adjustment_writer.write(dividends=dfd)
@@ -6,16 +6,101 @@ This is a premium dataset, and requires valid permissions to download.
 Created by Peter Harrington on 3/1/17.
 """
 
+import os
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
-import gc  # garbage collection
 
 START_DATE = '2009-01-02'
 METADATA_HEADERS = ['start_date', 'end_date', 'auto_close_date',
                     'symbol', 'exchange', 'asset_name']
 UNWANTED_EXCHANGES = set(["OTC", "OTCBB", "INDX"])
 
+# only these columns of the dump are read, comp_name_2 and currency_code are not used
+DUMP_COLUMNS = ['m_ticker', 'ticker', 'comp_name', 'exchange', 'date',
+                'open', 'high', 'low', 'close', 'volume']
+DUMP_DTYPES = {'m_ticker': str, 'ticker': str, 'comp_name': str, 'exchange': str,
+               'open': 'float64', 'high': 'float64', 'low': 'float64',
+               'close': 'float64', 'volume': 'float64'}
+DUMP_CHUNKSIZE = 500000  # rows of the dump parsed at a time
+MEMORY_BUDGET_MB = 2000  # rough upper bound on the memory used for the bars
+SORT_OVERHEAD = 3  # a bucket is concatenated and sorted, about 3 copies in memory
 
-def from_zacks_dump(file_name, dvdend_file=None, start=None, end=None):
+
+def read_dump_chunks(file_name, chunksize=DUMP_CHUNKSIZE):
+    """
+    Streams the dump, yields chunks with the rows we want to load: on or after
+    START_DATE, not on an unwanted exchange and without NaNs (or the loader
+    will turn all columns to NaNs).
+    """
+    reader = pd.read_csv(file_name, usecols=DUMP_COLUMNS, dtype=DUMP_DTYPES,
+                         parse_dates=['date'], na_values=['NA'], chunksize=chunksize)
+    start = pd.Timestamp(START_DATE)
+    for chunk in reader:
+        chunk = chunk[(chunk['date'] >= start) & ~chunk['exchange'].isin(UNWANTED_EXCHANGES)]
+        chunk = chunk.dropna()
+        if chunk.shape[0] > 0:
+            yield chunk
+
+
+def estimate_num_buckets(file_name, memory_budget_mb, sample_rows=10000):
+    """
+    Number of buckets the dump has to be split into so one bucket can be
+    sorted within memory_budget_mb, estimated from the first sample_rows rows.
+    """
+    sample = pd.read_csv(file_name, usecols=DUMP_COLUMNS, dtype=DUMP_DTYPES,
+                         parse_dates=['date'], na_values=['NA'], nrows=sample_rows)
+    with open(file_name, 'rb') as f:
+        sample_bytes = sum(len(f.readline()) for _ in range(sample.shape[0] + 1))
+    bytes_in_memory = os.path.getsize(file_name) / float(sample_bytes) * sample.memory_usage(deep=True).sum()
+    return max(1, int(np.ceil(SORT_OVERHEAD * bytes_in_memory / (memory_budget_mb * 1e6))))
+
+
+def partition_by_ticker(chunks, num_buckets, spill_dir):
+    """
+    Spreads the rows of chunks over num_buckets buckets by m_ticker, so all
+    rows of a ticker end up in the same bucket.  The buckets are spilled to
+    spill_dir as they fill, then yielded one at a time.  With a single bucket
+    nothing is written to disk.
+    """
+    if num_buckets == 1:
+        parts = list(chunks)
+        if len(parts) > 0:
+            yield pd.concat(parts)
+        return
+
+    for i, chunk in enumerate(chunks):
+        # hash_array is seeded with a fixed key, so buckets do not change between runs
+        bucket = pd.util.hash_array(chunk['m_ticker'].values) % num_buckets
+        for b, part in chunk.groupby(bucket):
+            part.to_pickle(os.path.join(spill_dir, 'bucket_{}_{:06d}.pkl'.format(b, i)))
+
+    spilled = sorted(os.listdir(spill_dir))
+    for b in range(num_buckets):
+        prefix = 'bucket_{}_'.format(b)
+        paths = [os.path.join(spill_dir, fn) for fn in spilled if fn.startswith(prefix)]
+        if len(paths) == 0:
+            continue
+        bucket_df = pd.concat([pd.read_pickle(path) for path in paths])
+        for path in paths:
+            os.remove(path)
+        yield bucket_df
+
+
+def iter_tickers(buckets):
+    """
+    Sorts every bucket by (m_ticker, date) and yields (m_ticker, DataFrame)
+    with the rows of one ticker, indexed by date.
+    """
+    for bucket_df in buckets:
+        bucket_df = bucket_df.sort_values(['m_ticker', 'date'], kind='mergesort')
+        for tkr, df_tkr in bucket_df.groupby('m_ticker', sort=False):
+            yield tkr, df_tkr.set_index('date')
+
+
+def from_zacks_dump(file_name, dvdend_file=None, start=None, end=None,
+                    memory_budget_mb=MEMORY_BUDGET_MB, chunksize=DUMP_CHUNKSIZE):
     """
     Load data from a Zacks dump from Quandl, the data dump is assumed to be in
     a .csv file located at: file_name.
@@ -29,8 +114,9 @@ def from_zacks_dump(file_name, dvdend_file=None, start=None, end=None):
 
     Tickers come from one of the following exchanges:
     'NYSE', 'NSDQ', 'OTC', 'ARCA', 'INDX', 'TSXV', 'OTCBB', 'TSX'
-    This can take a long time on the order of hours.  Using the defaults on a
-    modern laptop will take 1-2 hours.
+    The dump is streamed in chunks of chunksize rows, the rows we keep are
+    split by ticker into buckets that each fit in memory_budget_mb once sorted,
+    buckets that do not fit in memory are spilled to a temporary folder.
 
     To use this make your ~/.zipline/extension.py look similar this:
 
@@ -57,60 +143,47 @@ def from_zacks_dump(file_name, dvdend_file=None, start=None, end=None):
 
         print("starting ingesting data from: {}".format(file_name))
 
-        # read in the whole dump (will require ~7GB of RAM)
-        df = pd.read_csv(file_name, index_col='date',
-                         parse_dates=['date'], na_values=['NA'])
-        # drop unused columns
-        df = df.drop(['comp_name_2', 'currency_code'], axis=1)
-        # using inplace=true here instead of functional
-        # approach saves peak memory usage
-
-        df = df.ix[START_DATE:]  # drop dates before START_DATE
-        gc.collect()  # force garbage collection to free up memory
-
-        # drop row with NaNs or the loader will turn all columns to NaNs
-        df = df.dropna()
-
-        uv = df.m_ticker.unique()  # get unique m_tickers (Zacks primary key)
+        num_buckets = estimate_num_buckets(file_name, memory_budget_mb)
+        print("splitting the dump into {} bucket(s) by ticker".format(num_buckets))
 
-        # counter of valid securites, this will be our primary key
-        sec_counter = 0
-        data_list = []  # list to send to daily_bar_writer
         metadata_list = []  # list to send to asset_db_writer (metadata)
 
-        # iterate over all the unique securities and pack data, and metadata
-        # for writing
-        for tkr in uv:
-            df_tkr = df[df['m_ticker'] == tkr]
-
-            row0 = df_tkr.ix[0]  # get metadata from row
-            if row0["exchange"] in UNWANTED_EXCHANGES:  # skip OTC securities
-                continue
-
-            print(" preparing {} / {} ".format(row0["ticker"],
-                                               row0["exchange"]))
-
-            # update metadata; 'start_date', 'end_date', 'auto_close_date',
-            # 'symbol', 'exchange', 'asset_name'
-            metadata_list.append((df_tkr.index[0],
-                                  df_tkr.index[-1],
-                                  df_tkr.index[-1] + pd.Timedelta(days=1),
-                                  row0["ticker"],
-                                  row0["exchange"],
-                                  row0["comp_name"]
-                                  )
-                                 )
-
-            # drop metadata columns
-            df_tkr = df_tkr.drop(['m_ticker', 'ticker',
-                                  'comp_name', 'exchange'], axis=1)
-
-            # pack data to be written by daily_bar_writer
-            data_list.append((sec_counter, df_tkr))
-            sec_counter += 1
-
-        print("writing data for {} securities".format(len(metadata_list)))
-        daily_bar_writer.write(data_list, show_progress=False)
+        def bars(buckets):
+            """pack data, and metadata for writing, one ticker at a time"""
+            for tkr, df_tkr in iter_tickers(buckets):
+                row0 = df_tkr.iloc[0]  # get metadata from row
+
+                print(" preparing {} / {} ".format(row0["ticker"],
+                                                   row0["exchange"]))
+
+                # update metadata; 'start_date', 'end_date', 'auto_close_date',
+                # 'symbol', 'exchange', 'asset_name'
+                metadata_list.append((df_tkr.index[0],
+                                      df_tkr.index[-1],
+                                      df_tkr.index[-1] + pd.Timedelta(days=1),
+                                      row0["ticker"],
+                                      row0["exchange"],
+                                      row0["comp_name"]
+                                      )
+                                     )
+
+                # drop metadata columns
+                df_tkr = df_tkr.drop(['m_ticker', 'ticker',
+                                      'comp_name', 'exchange'], axis=1)
+
+                # the position in metadata_list is our primary key (sid),
+                # handed out in the (deterministic) bucket order
+                yield len(metadata_list) - 1, df_tkr
+
+        spill_dir = tempfile.mkdtemp()
+        try:
+            buckets = partition_by_ticker(read_dump_chunks(file_name, chunksize),
+                                          num_buckets, spill_dir)
+            # the writer consumes the bars as they are prepared
+            daily_bar_writer.write(bars(buckets), show_progress=False)
+        finally:
+            shutil.rmtree(spill_dir)
+        sec_counter = len(metadata_list)
 
         # write metadata
         asset_db_writer.write(equities=pd.DataFrame(metadata_list,
@@ -131,7 +204,7 @@ def from_zacks_dump(file_name, dvdend_file=None, start=None, end=None):
                               parse_dates=['div_ex_date', 'per_end_date'],
                               na_values=['NA'])
 
-            dfd = dfd.ix[START_DATE:]  # drop old data
+            dfd = dfd[dfd.index >= START_DATE]  # drop old data
             # format dfd to have sid
             adjustment_writer.write(dividends=dfd)
 
@@ -0,0 +1,145 @@
+"""
+Factor loadings stored as a dense float32 cube of factor x date x asset.
+
+The cube is a .npy file that is memory mapped, next to it are the dates and
+the sids of the assets (dates.npy, sids.npy), filled.npy which marks the dates
+already written, and a small JSON header with the factor names.  The loadings
+of a day are written in place as soon as they are computed, and readers only
+read from disk the part of the cube they slice.
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+LOADINGS_HEADER_FILE = 'header.json'
+LOADINGS_FILE = 'loadings.npy'
+DATES_FILE = 'dates.npy'
+SIDS_FILE = 'sids.npy'
+FILLED_FILE = 'filled.npy'
+MERGE_CHUNK_DATES = 256
+
+
+class FactorLoadings(object):
+    """A cube of factor loadings, create() a new one or open() an existing one.
+    Assets are stored by sid, Zipline Assets and sids can be used to index it."""
+
+    def __init__(self, path, factors, dates, sids, values, filled):
+        self.path = path
+        self.factors = factors  # list of the factor names
+        self.dates = dates      # pd.DatetimeIndex
+        self.sids = sids        # pd.Index of the sids
+        self.values = values    # (factors, dates, sids) float32 memmap
+        self.filled = filled    # (dates,) bool memmap, True once a date is written
+
+    @classmethod
+    def create(cls, path, factors, dates, assets):
+        """Creates the files of a cube full of NaNs, and returns it open for writing."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        dates = pd.DatetimeIndex(dates)
+        sids = np.array([int(asset) for asset in assets], dtype='int64')
+
+        np.save(os.path.join(path, DATES_FILE), dates.asi8)
+        np.save(os.path.join(path, SIDS_FILE), sids)
+        values = np.lib.format.open_memmap(os.path.join(path, LOADINGS_FILE), mode='w+', dtype='float32',
+                                           shape=(len(factors), len(dates), len(sids)))
+        values[:] = np.nan
+        values.flush()
+        np.save(os.path.join(path, FILLED_FILE), np.zeros(len(dates), dtype=bool))
+
+        # written last, a folder without a header was not fully created
+        header = {'factors': list(factors), 'num_dates': len(dates), 'num_sids': len(sids),
+                  'dtype': values.dtype.str, 'tz': str(dates.tz) if dates.tz is not None else None}
+        with open(os.path.join(path, LOADINGS_HEADER_FILE), 'w') as fw:
+            json.dump(header, fw, indent=2)
+        return cls.open(path, mode='r+')
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Opens a cube, mode='r+' to write to it."""
+        with open(os.path.join(path, LOADINGS_HEADER_FILE)) as fr:
+            header = json.load(fr)
+
+        dates = pd.DatetimeIndex(np.load(os.path.join(path, DATES_FILE)))
+        if header['tz'] is not None:
+            dates = dates.tz_localize('UTC').tz_convert(header['tz'])
+        sids = pd.Index(np.load(os.path.join(path, SIDS_FILE)))
+        values = np.load(os.path.join(path, LOADINGS_FILE), mmap_mode=mode)
+        filled = np.load(os.path.join(path, FILLED_FILE), mmap_mode=mode)
+        return cls(path, header['factors'], dates, sids, values, filled)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def missing_dates(self):
+        """The dates that have not been written yet."""
+        return self.dates[~np.asarray(self.filled)]
+
+    def write_day(self, date, exposures):
+        """Writes the loadings of a date, exposures is indexed by asset with a column per
+        factor (as the packed_exposures of calc_exposures_to_equities()).  The loadings are
+        flushed to disk before the date is marked as filled.  Assets not in the cube are ignored."""
+        i = self.dates.get_loc(date)
+        cols = self.sids.get_indexer([int(asset) for asset in exposures.index])
+        found = cols >= 0
+        block = np.asarray(exposures[self.factors].values, dtype='float32')[found]
+        self.values[:, i, cols[found]] = block.T
+        self.values.flush()
+        self.filled[i] = True
+        self.filled.flush()
+
+    def _columns(self, assets):
+        if assets is None:
+            return slice(None), self.sids
+        sids = pd.Index([int(asset) for asset in assets])
+        cols = self.sids.get_indexer(sids)
+        if (cols < 0).any():
+            raise KeyError('sids not in the factor loadings: {}'.format(list(sids[cols < 0])))
+        return cols, sids
+
+    def factor(self, name, start=None, end=None, assets=None):
+        """Loadings of one factor, a DataFrame of dates x sids.  Only the dates in [start, end]
+        and the given assets are read (all of them by default)."""
+        f = self.factors.index(name)
+        d0, d1 = self.dates.slice_locs(start, end)
+        cols, sids = self._columns(assets)
+        return pd.DataFrame(self.values[f, d0:d1][:, cols], index=self.dates[d0:d1], columns=sids)
+
+    def loadings_on(self, date, assets=None):
+        """Loadings of every factor on one date, a DataFrame of sids x factors."""
+        i = self.dates.get_loc(date)
+        cols, sids = self._columns(assets)
+        return pd.DataFrame(self.values[:, i][:, cols].T, index=sids, columns=self.factors)
+
+
+def merge_factor_loadings(paths, path, chunk_dates=MERGE_CHUNK_DATES):
+    """
+    Merges cubes with the same factors and dates but different assets (the
+    shards of an asset sharded build) into one cube at path, the assets are in
+    the order of the shards.  A date is filled in the merged cube only if it
+    is filled in every shard.  The shards are copied chunk_dates dates at a
+    time, so the memory used does not grow with the size of the cubes.
+    """
+    parts = [FactorLoadings.open(p) for p in paths]
+    first = parts[0]
+    for part in parts[1:]:
+        if part.factors != first.factors or not part.dates.equals(first.dates):
+            raise ValueError('{} does not have the same factors and dates as {}'.format(part.path, first.path))
+    sids = np.concatenate([part.sids.values for part in parts])
+    if len(np.unique(sids)) < len(sids):
+        raise ValueError('the same sid is in more than one shard')
+
+    merged = FactorLoadings.create(path, first.factors, first.dates, sids)
+    col = 0
+    for part in parts:
+        n = len(part.sids)
+        for d0 in range(0, len(first.dates), chunk_dates):
+            merged.values[:, d0:d0 + chunk_dates, col:col + n] = part.values[:, d0:d0 + chunk_dates]
+        col += n
+    merged.values.flush()
+    merged.filled[:] = np.logical_and.reduce([np.asarray(part.filled) for part in parts])
+    merged.filled.flush()
+    return merged
@@ -8,11 +8,12 @@ import pandas as pd
 import pyfolio as pf
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
+from alphacompiler.risk.factor_loadings import FactorLoadings
 
 # BACKTEST_FN = '../backtest/perf.h5'
 BACKTEST_FN = '../backtest/perf_risk.h5'
 
-FACTOR_LOADINGS_FILE = '../risk/factor_loadings.h5'
+FACTOR_LOADINGS_DIR = '../risk/factor_loadings'
 
 
 if __name__ == '__main__':
@@ -20,7 +21,10 @@ if __name__ == '__main__':
 
     # load backtest of strategy
     returns, positions, transactions = pf.utils.extract_rets_pos_txn_from_zipline(results)
-    risk_factors_panel = pd.read_hdf(FACTOR_LOADINGS_FILE, 'key')
+    risk_factors_panel = FactorLoadings.open(FACTOR_LOADINGS_DIR)
+    # the loadings are by sid, only the dates and assets of the backtest are read
+    positions = positions.rename(columns=lambda asset: getattr(asset, 'sid', asset))
+    assets = [sid for sid in positions.columns if sid in risk_factors_panel.sids]
 
     # plot one risk exposure panel at a time
 
@@ -30,7 +34,8 @@ if __name__ == '__main__':
     ax_sector_alloc = plt.subplot(gs[:1, :])
     ax = plt.subplot(gs[:1, :])
 
-    sfe = pf.risk.compute_style_factor_exposures(positions, risk_factors_panel['HML'])
+    hml = risk_factors_panel.factor('HML', positions.index[0], positions.index[-1], assets)
+    sfe = pf.risk.compute_style_factor_exposures(positions, hml)
     print(sfe)
     pf.risk.plot_style_factor_exposures(sfe, 'HML', ax)
 
@@ -38,18 +43,19 @@ if __name__ == '__main__':
 
     # start of copied code (the following 14 lines were copied from:
     # https://github.com/quantopian/pyfolio/blob/master/pyfolio/tears.py#L1412 )
-    # vertical_sections = len(risk_factors_panel.items)
+    # vertical_sections = len(risk_factors_panel.factors)
     # fig = plt.figure(figsize=[14, vertical_sections * 6])
     # gs = gridspec.GridSpec(vertical_sections, 3, wspace=0.5, hspace=0.5)
     #
     # style_axes = []  # style axes
     # style_axes.append(plt.subplot(gs[0, :]))  # insert first axis
-    # for i in range(1, len(risk_factors_panel.items)):
+    # for i in range(1, len(risk_factors_panel.factors)):
     #     print plt.subplot(gs[i, :])
     #     style_axes.append(plt.subplot(gs[i, :]))
     #
     # j = 0
-    # for name, df in risk_factors_panel.iteritems():
+    # for name in risk_factors_panel.factors:
+    #     df = risk_factors_panel.factor(name, positions.index[0], positions.index[-1], assets)
     #     sfe = pf.risk.compute_style_factor_exposures(positions, df)
     #     pf.risk.plot_style_factor_exposures(sfe, name, style_axes[j])
     #     j += 1
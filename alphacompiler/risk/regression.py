@@ -0,0 +1,161 @@
+"""
+Batched least squares for the risk model.  Every asset is regressed on the
+same factor returns, so instead of one sm.OLS() per asset the cross products
+X'X and X'y are computed once for all the assets, and the few rows each asset
+drops (NaNs and 3 sigma outliers) are subtracted from them.
+"""
+import numpy as np
+from zipline.utils.math_utils import nanmean, nanstd
+
+
+def outlier_mask(Y, n_sigma=3.0):
+    """
+    Returns the (T, M) bool mask of the rows kept to fit each column of Y:
+    not NaN and within n_sigma std of the column mean, the same as
+    np.abs(y - y.mean()) <= (3 * y.std()) on a pandas Series.
+    """
+    Y = np.asarray(Y, dtype=float)
+    with np.errstate(invalid='ignore'):
+        return np.abs(Y - nanmean(Y, axis=0)) <= n_sigma * nanstd(Y, axis=0, ddof=1)
+
+
+def _dropped_sums(X, Y0, dropped):
+    """
+    Sums of x x', x y, y, y*y and the number of rows over the (t, j) entries
+    that are dropped, for every column j.  Y0 has 0 where Y is NaN.
+    """
+    M = dropped.shape[1]
+    k = X.shape[1]
+    t, j = np.nonzero(dropped)
+    x = X[t]
+    y = Y0[t, j]
+
+    xx = np.empty((M, k, k))
+    for a in range(k):
+        for b in range(a, k):
+            xx[:, a, b] = xx[:, b, a] = np.bincount(j, x[:, a] * x[:, b], minlength=M)
+    xy = np.empty((M, k))
+    for a in range(k):
+        xy[:, a] = np.bincount(j, x[:, a] * y, minlength=M)
+    return (xx, xy, np.bincount(j, y, minlength=M), np.bincount(j, y * y, minlength=M),
+            np.bincount(j, minlength=M))
+
+
+def _solve(xx, xy, sy, syy, n):
+    """
+    Solves the normal equations of every column, xx is (M, k, k) and xy (M, k).
+    Returns (params (M, k), rsquared (M,)), the rsquared is the centered one as
+    statsmodels reports when X has a constant.  Columns with fewer than k rows are NaN.
+    """
+    k = xx.shape[-1]
+    try:
+        params = np.linalg.solve(xx, xy[..., None])[..., 0]
+    except np.linalg.LinAlgError:  # some column is singular, statsmodels uses the pinv too
+        params = np.einsum('mij,mj->mi', np.linalg.pinv(xx), xy)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssr = syy - 2 * np.einsum('mi,mi->m', params, xy) + np.einsum('mi,mij,mj->m', params, xx, params)
+        rsquared = 1 - ssr / (syy - sy * sy / n)
+    too_few = n < k
+    params[too_few] = np.nan
+    rsquared[too_few] = np.nan
+    return params, rsquared
+
+
+def masked_ols(X, Y, mask=None):
+    """
+    Regresses every column of Y (T, M) on X (T, k), using only the rows where
+    mask (T, M) is True (all the non NaN rows by default).
+    Returns (params (M, k), rsquared (M,)), column j being the same as
+    sm.OLS(Y[mask[:, j], j], X[mask[:, j]]).fit().  X should include a
+    constant column, as added by sm.add_constant().
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if X.shape[0] != Y.shape[0]:
+        raise ValueError('X has {} rows and Y has {}, they must be the same dates'.format(X.shape[0], Y.shape[0]))
+    if mask is None:
+        mask = ~np.isnan(Y)
+    Y0 = np.where(mask, Y, 0.0)  # the y sums are then over the kept rows already
+
+    dxx, _, _, _, dn = _dropped_sums(X, Y0, ~mask)
+    return _solve(np.dot(X.T, X) - dxx, np.dot(Y0.T, X), Y0.sum(axis=0), (Y0 * Y0).sum(axis=0),
+                  X.shape[0] - dn)
+
+
+class RollingOLS(object):
+    """
+    Rolling window version of masked_ols(), fit(end) regresses every column of
+    Y on X over the rows [end - window, end), dropping the NaNs and the rows
+    more than n_sigma std away from the mean of the column in that window.
+
+    The cross products of the window are kept as running sums, when the window
+    moves forward the rows entering it are added and the ones leaving it are
+    subtracted, so fitting consecutive windows does not go over the whole
+    window again (apart from finding the outliers).  Jumping backwards or
+    further than a window starts from scratch, as does every window-th move
+    so rounding errors do not pile up.
+
+    Y is not copied (a slice of a memory mapped array stays a view), the NaN
+    filled rows are only made for the rows being added or fitted.
+    """
+    def __init__(self, X, Y, window, n_sigma=3.0):
+        self.X = np.asarray(X, dtype=float)
+        self.Y = np.asarray(Y, dtype=float)
+        if self.X.shape[0] != self.Y.shape[0]:
+            raise ValueError('X has {} rows and Y has {}, they must be the same dates'.format(
+                self.X.shape[0], self.Y.shape[0]))
+        self.window = window
+        self.n_sigma = n_sigma
+        self.end = None
+        self.moves = 0
+
+    def _add_rows(self, rows, sign):
+        x = self.X[rows]
+        y = self.Y[rows]
+        y0 = np.nan_to_num(y)
+        self.xx += sign * np.dot(x.T, x)
+        self.xy += sign * np.dot(y0.T, x)
+        self.sy += sign * y0.sum(axis=0)
+        self.syy += sign * (y0 * y0).sum(axis=0)
+        self.n += sign * (~np.isnan(y)).sum(axis=0)
+
+    def cold_start(self, end):
+        """Computes the sums of the window ending at end from scratch."""
+        M = self.Y.shape[1]
+        k = self.X.shape[1]
+        self.xx = np.zeros((k, k))
+        self.xy = np.zeros((M, k))
+        self.sy = np.zeros(M)
+        self.syy = np.zeros(M)
+        self.n = np.zeros(M, dtype=int)
+        self._add_rows(slice(end - self.window, end), 1)
+        self.end = end
+        self.moves = 0
+
+    def move_to(self, end):
+        """Moves the window so it ends at end, updating the running sums."""
+        if (self.end is None or end < self.end or end - self.end >= self.window or
+                self.moves >= self.window):
+            self.cold_start(end)
+            return
+        self._add_rows(slice(self.end, end), 1)
+        self._add_rows(slice(self.end - self.window, end - self.window), -1)
+        self.moves += end - self.end
+        self.end = end
+
+    def fit(self, end):
+        """Returns (params (M, k), rsquared (M,)) of the window of rows [end - window, end)."""
+        if end < self.window or end > self.X.shape[0]:
+            raise ValueError('window ending at {} is out of range'.format(end))
+        self.move_to(end)
+        y = self.Y[end - self.window:end]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sy / self.n
+            std = np.sqrt((self.syy - self.sy * mean) / (self.n - 1))
+            keep = np.abs(y - mean) <= self.n_sigma * std
+
+        dxx, dxy, dsy, dsyy, dn = _dropped_sums(self.X[end - self.window:end], np.nan_to_num(y), ~keep)
+        return _solve(self.xx - dxx, self.xy - dxy, self.sy - dsy, self.syy - dsyy,
+                      self.window - dn)
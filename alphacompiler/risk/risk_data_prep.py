@@ -6,16 +6,19 @@ Created by Peter Harrington (pbharrin) on 11/15/18.
 """
 import pandas as pd
 import pyfolio as pf
-from risk_factors import calc_exposures_to_equities, SECTOR_ETF_RETURNS_FILE, GICSNAME2ETF
-from alphacompiler.util.zipline_data_tools import get_all_assets_for_bundle
-from zipline.data.bundles.core import load, register
+from risk_factors import (get_exposure_inputs, get_style_returns, build_factor_loadings, asset_shards, shard_path,
+                          merge_loadings_shards, SECTOR_ETF_RETURNS_FILE, GICSNAME2ETF, EXPOSURE_WINDOW)
+from alphacompiler.util.zipline_data_tools import get_all_assets_for_bundle, get_bundle_data
+from alphacompiler.risk.factor_loadings import FactorLoadings, LOADINGS_HEADER_FILE
+from zipline.data.bundles.core import register
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 
 # sector raw data file
 SECTOR_RAW_DATA = '/Users/peterharrington/Downloads/sector_etf_data.csv'
 EQUITIES_OF_INTEREST_FILE = 'equities_of_interest.txt'
-FACTOR_LOADINGS_FILE = 'factor_loadings.h5'
+FACTOR_LOADINGS_DIR = 'factor_loadings'  # see FactorLoadings
 RISK_FACTORS = ['SMB', 'HML', 'MOMENTUM', 'VOL', 'STREVERSAL']
 
 
@@ -42,7 +45,7 @@ def create_sector_returns_file_yahoo(datadir):
     Assumes the data is stored in a common folder and the files are named TICKER.csv.
     (That's how they come from yahoo.)"""
     for fn in os.listdir(datadir):
-        print "opening: ", fn
+        print("opening: ", fn)
 
     # df_all = pd.read_csv(SECTOR_RAW_DATA, index_col='date', parse_dates=['date'], na_values=['NA'])
     # desired_columns = ['date', 'TSYMBOL', 'PRC']
@@ -69,9 +72,9 @@ def create_sector_returns_file_CRSP():
     df_all = pd.read_csv(SECTOR_RAW_DATA, index_col='date', parse_dates=['date'], na_values=['NA'])
     desired_columns = ['date', 'TSYMBOL', 'PRC']
     df_all = df_all.drop([col for col in df_all.columns if col not in desired_columns], axis=1)
-    print df_all.index
+    print(df_all.index)
     df_all.index = df_all.index.tz_localize('UTC')
-    print df_all.index
+    print(df_all.index)
 
     tickers = df_all.TSYMBOL.unique()
     print(tickers)
@@ -80,7 +83,7 @@ def create_sector_returns_file_CRSP():
         data_f[ticker] = df_all[df_all.TSYMBOL == ticker]['PRC']
 
     df_stacked = pd.DataFrame(data=data_f)
-    print 'df_stacked: ', df_stacked.pct_change()[1:]
+    print('df_stacked: ', df_stacked.pct_change()[1:])
     returns = df_stacked.pct_change()[1:]
     # save to file
     returns.to_csv(SECTOR_ETF_RETURNS_FILE)
@@ -98,61 +101,91 @@ def create_equities_of_interest_file_and_test():
 def get_trading_days(bundle, start_date, end_date):
     """Gets the trading days between start_date and end_date inclusive, for a given bundle.
     Will also return the trading calendar."""
-    bundle_data = load(bundle, os.environ, None)
+    bundle_data, _ = get_bundle_data(bundle)
     cal = bundle_data.equity_daily_bar_reader.trading_calendar.all_sessions
     return cal[(cal >= start_date) & (cal <= end_date)], cal
 
 
-def create_factor_loadings_files():
-    """Creates a dataframe for each risk factor, the dataframes are persisted to files.
-    Each dataframe has dates as the index, and Assets as the columns, with values being the factor
-    loadings of each equity of each day.  """
-
+def factor_loadings_dates():
+    """Returns the data dates, the trading days of the backtest and the (first, last) days the
+    exposure inputs are loaded for: from two years before the first day of the backtest."""
     data_dates = ('2008-01-01', '2016-12-31')
     backtest_dates = ('2012-01-04', '2016-12-31')
     pd_data_dates = (pd.to_datetime(data_dates[0], utc=True), pd.to_datetime(data_dates[1], utc=True))
 
+    trading_days_in_bt, cal = get_trading_days('crsp', backtest_dates[0], backtest_dates[1])  # index for dates
+    first = cal.get_loc(trading_days_in_bt[0])
+    run_dates = (cal[first - EXPOSURE_WINDOW], trading_days_in_bt[-1])
+    return pd_data_dates, trading_days_in_bt, run_dates
+
+
+def create_factor_loadings_files(workers=1, shard=None, num_shards=1):
+    """Computes the factor loadings of the equities of interest for every day of the backtest,
+    and stores them in a factor x date x asset cube in FACTOR_LOADINGS_DIR (see FactorLoadings).
+    Each day is written to the cube as soon as it is computed, if the cube already exists only
+    the days not written yet are computed (delete the folder to start over).
+    With workers > 1 the days are computed by a pool of processes.
+
+    For universes too big for one process, the equities are split in num_shards blocks and
+    shard=k only computes block k, in its own cube (see shard_path()).  The blocks can be
+    computed by separate processes, or hosts sharing the folder, then merged with
+    merge_factor_loadings_files().  create_factor_loadings_shards() does both locally.  """
+
     register('crsp', int)  # dummy register
+    pd_data_dates, trading_days_in_bt, run_dates = factor_loadings_dates()
 
     # get Assets for all symbols stored
     all_assets = get_all_assets_for_bundle('crsp')
     symbol2asset_map = dict(map(lambda x: (x.symbol, x), all_assets))
 
     asset_symbols = [line.strip() for line in open(EQUITIES_OF_INTEREST_FILE).readlines()]
-    equities_of_interest = map(lambda x: symbol2asset_map[x], asset_symbols)
-    print equities_of_interest
+    equities_of_interest = [symbol2asset_map[x] for x in asset_symbols]
+    path = FACTOR_LOADINGS_DIR
+    if shard is not None:
+        equities_of_interest = asset_shards(equities_of_interest, num_shards)[shard]
+        path = shard_path(FACTOR_LOADINGS_DIR, shard)
+    print(equities_of_interest)
 
-    # create continer (DataFrame for factor loadings)
-    # columns=equities_of_interest, rows=dates
-    trading_days_in_bt, cal = get_trading_days('crsp', backtest_dates[0], backtest_dates[1])  # index for dates
-    factor_loadings = {}  # dictonary of DataFrames
-    for factor in RISK_FACTORS:
-        factor_loadings[factor] = pd.DataFrame(index=trading_days_in_bt, columns=equities_of_interest)
+    # create container for factor loadings: factors x dates x equities_of_interest
+    if not os.path.exists(os.path.join(path, LOADINGS_HEADER_FILE)):
+        FactorLoadings.create(path, RISK_FACTORS, trading_days_in_bt, equities_of_interest)
+
+    # load the data of the whole period once, from two years before the first day of the backtest
+    x, R, sector_returns = get_exposure_inputs('crsp', pd_data_dates, run_dates, assets=equities_of_interest)
+
+    # go over all days in backtest, the loadings of each day are over the two years before it
+    build_factor_loadings(path, x, R, sector_returns, workers=workers)
 
-    # loop to go over all days in backtest, calculate loadings over two years and pack in Pandas Panel
-    cal_list = cal.tolist()
-    for day in trading_days_in_bt:
-        i = cal_list.index(day)
-        print cal[i - 504], day
-        factor_loading_calc_period = (cal[i - 504], day)
 
-        one_day_exposures = calc_exposures_to_equities(equities_of_interest, 'crsp', pd_data_dates, factor_loading_calc_period)
-        one_day_t = one_day_exposures.transpose()
-        print one_day_t  # this contains all risk factors
+def merge_factor_loadings_files(num_shards):
+    """Merges the cubes of the blocks computed by create_factor_loadings_files(shard=k) into
+    the cube in FACTOR_LOADINGS_DIR."""
+    merged = merge_loadings_shards(FACTOR_LOADINGS_DIR, num_shards)
+    print('merged {} shards, {} dates not filled'.format(num_shards, len(merged.missing_dates())))
 
-        for factor in RISK_FACTORS:  # pack loadings by factor and date
-            factor_loadings[factor].loc[factor_loading_calc_period[1]] = one_day_t.loc[factor]
 
-    # create Panel of factor_loadings and save to HDF5 file
-    pd.Panel(factor_loadings).to_hdf(FACTOR_LOADINGS_FILE, 'key', mode='w')
+def create_factor_loadings_shards(num_shards, processes=None):
+    """Computes each block of equities in its own process, then merges the blocks.
+    The style returns run make_pipeline() on the whole universe, so they are stored once
+    here, the blocks then only read them from the store."""
+    register('crsp', int)  # dummy register
+    pd_data_dates, _, run_dates = factor_loadings_dates()
+    get_style_returns('crsp', pd_data_dates, run_dates)
+
+    with ProcessPoolExecutor(processes or num_shards) as pool:
+        futures = [pool.submit(create_factor_loadings_files, shard=shard, num_shards=num_shards)
+                   for shard in range(num_shards)]
+        for future in futures:
+            future.result()
+    merge_factor_loadings_files(num_shards)
 
 
 def verify_factor_loadins_file():
-    p = pd.read_hdf(FACTOR_LOADINGS_FILE, 'key')
-    # print p['HML']
-    print p.size
-    print p.shape
-    for item in p.items:
+    p = FactorLoadings.open(FACTOR_LOADINGS_DIR)
+    # print p.factor('HML')
+    print(p.shape)
+    print('{} dates not filled'.format(len(p.missing_dates())))
+    for item in p.factors:
         assert item in RISK_FACTORS
         print(item)
 
@@ -161,6 +194,7 @@ if __name__ == '__main__':
     # create_equities_of_interest_file_and_test()
     create_sector_returns_file_yahoo('/Users/peterharrington/Downloads/sector_etf')
     # create_factor_loadings_files()
+    # create_factor_loadings_files(shard=0, num_shards=4)  # on each host, then merge_factor_loadings_files(4)
     # verify_factor_loadins_file()
 
     print("ISYMFS")
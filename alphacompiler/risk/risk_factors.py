@@ -7,17 +7,22 @@ Created by Peter Harrington (pbharrin) on 2/22/18.
 from zipline.pipeline import Pipeline
 from zipline.pipeline.data import USEquityPricing
 from zipline.pipeline.factors import CustomFactor, Returns, VWAP, SimpleMovingAverage, AverageDollarVolume, RSI
+from zipline.pipeline.filters import StaticSids
 from zipline.utils.paths import zipline_root
 
 # from alphacompiler.data.compustat_fundamentals import Fundamentals
 from alphacompiler.data.sf1_fundamentals import Fundamentals
 # from eclongshort.alphafactory.ASTtoQFactor import make_pipeline_code  # TODO: remove this
 # from eclongshort.alphafactory.AlphaTree import parse_AST  # TODO: remove this
-from alphacompiler.util.zipline_data_tools import make_pipeline_engine
+from alphacompiler.util.zipline_data_tools import make_pipeline_engine, get_bundle_data
 
 import pandas as pd
 import numpy as np
 import pickle
+import json
+import shutil
+import tempfile
+from multiprocessing import Pool
 
 from scipy import stats
 import os
@@ -25,10 +30,19 @@ from dateutil.tz import tzutc
 from dateutil.parser import parse
 import statsmodels.api as sm
 from alphacompiler.util.zipline_data_tools import fast_corr, fast_cov
+from zipline.utils.math_utils import nanstd
+from alphacompiler.risk.regression import RollingOLS, masked_ols, outlier_mask
+from alphacompiler.risk.factor_loadings import FactorLoadings, merge_factor_loadings
 
 SECTOR_ETF_RETURNS_FILE = '../data/sector_etf_returns.csv'  # todo: put this in constants file
 MAPPING_FILE = '../data/sector_mappings.pkl'
 NUM_SEC = 20         # Number of securities per side (long or short)
+STYLE_RETURNS_DIR = zipline_root() + '/data/style_returns/'  # one file per bundle
+STYLE_FACTORS = ["SMB", "HML", "MOMENTUM", "VOL", "STREVERSAL"]
+EXPOSURE_WINDOW = 504  # two years of trading days
+EXPOSURE_COLUMNS = ["const"] + STYLE_FACTORS + ["rsquared"]
+EXPOSURE_INPUTS_HEADER_FILE = 'header.json'
+SHARDS_PER_WORKER = 4
 SPY_PATH = "%s/data/SPY.csv" % zipline_root()
 
 GICSNAME2ETF = {'Energy': 'XLE',
@@ -45,7 +59,16 @@ GICSNAME2ETF = {'Energy': 'XLE',
                 'Unmappable': 'SPY'}
 
 
-# SECTOR_MAPPING = pickle.load(open(MAPPING_FILE, 'rb'))
+_SECTOR_MAPPING = {}  # asset -> GICS sector name, loaded on first use
+
+
+def get_sector_mapping():
+    """Returns the asset -> GICS sector name dict, MAPPING_FILE is only read by the first call."""
+    if not _SECTOR_MAPPING:
+        with open(MAPPING_FILE, 'rb') as f:
+            _SECTOR_MAPPING.update(pickle.load(f))
+    return _SECTOR_MAPPING
+
 
 def date_utc(s):
     """For setting the timezone while parsing dates."""
@@ -55,21 +78,24 @@ def date_utc(s):
 class Momentum(CustomFactor):
     """delay(close, 19)/delay(close, 251)"""
     inputs = [USEquityPricing.close]
+    # only two rows are used, but a window is contiguous so it has to reach back to delay 251
     window_length = 252
 
     def compute(self, today, assets, out, close):
-        out[:] = close[-20] / close[0]
+        np.divide(close[-20], close[0], out=out)
 
 
 class Volatility(CustomFactor):
+    """1 / std of the daily log returns over the window."""
     inputs = [USEquityPricing.close]
     window_length = 252
 
     def compute(self, today, assets, out, close):
-        close = pd.DataFrame(data=close, columns=assets)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_returns = np.diff(np.log(close), axis=0)
 
-        # Since we are going to rank largest is best we need to invert the sdev.
-        out[:] = 1 / np.log(close).diff().std()
+            # Since we are going to rank largest is best we need to invert the sdev.
+            np.divide(1.0, nanstd(log_returns, axis=0, ddof=1), out=out)
 
 
 def make_pipeline():
@@ -122,15 +148,8 @@ def make_pipeline():
     )
 
 
-def get_factor_returns(alpha_str, bundle, data_dates, run_dates):
-    """Calculates factor returns."""
-
-    # create the pipeline engine
-    spe = make_pipeline_engine(bundle, data_dates)
-    my_pipeline = make_pipeline()
-
-    results = spe.run_pipeline(my_pipeline, run_dates[0], run_dates[1])
-    print results.head()
+def style_returns_from_results(results):
+    """Daily returns of the style factors (top minus bottom bucket) from the output of make_pipeline()."""
 
     # mean returns of the biggest/smallest by market cap
     R_biggest = results[results.biggest]['returns'].groupby(level=0).mean()
@@ -148,42 +167,93 @@ def get_factor_returns(alpha_str, bundle, data_dates, run_dates):
     R_low_streversal = results[results.low_streversal]['returns'].groupby(level=0).mean()
     R_high_streversal = results[results.high_streversal]['returns'].groupby(level=0).mean()
 
-    R_longs = results[results.my_longs]['returns'].groupby(level=0).mean()
-    R_shorts = results[results.my_shorts]['returns'].groupby(level=0).mean()
+    return pd.DataFrame({
+        'SMB': R_smallest - R_biggest,                       # company size
+        'HML': R_highpb - R_lowpb,                           # company PB ratio  value
+        'MOMENTUM': R_high_momentum - R_low_momentum,
+        'VOL': R_highvol - R_lowvol,
+        'STREVERSAL': R_high_streversal - R_low_streversal,  # short term reversal
+    }, columns=STYLE_FACTORS)
+
+
+def load_style_returns(bundle, path=STYLE_RETURNS_DIR):
+    """Returns the style returns stored for a bundle, an empty DataFrame if there are none."""
+    fn = os.path.join(path, bundle + '.pkl')
+    if os.path.exists(fn):
+        return pd.read_pickle(fn)
+    return pd.DataFrame(columns=STYLE_FACTORS, dtype=float)
+
+
+def save_style_returns(bundle, style_returns, path=STYLE_RETURNS_DIR):
+    """Saves the style returns of a bundle, replacing the stored ones."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    fn = os.path.join(path, bundle + '.pkl')
+    # a temp file of its own, so concurrent writers do not clobber each other
+    fd, tmp = tempfile.mkstemp(dir=path, prefix=bundle + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        style_returns.to_pickle(tmp)
+        os.replace(tmp, fn)  # readers never see a half written file
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def session_runs(sessions, days):
+    """Splits days into runs of consecutive sessions, returns a list of (first day, last day)."""
+    locs = sessions.get_indexer(days)
+    breaks = np.flatnonzero(np.diff(locs) > 1)
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [len(locs) - 1]])
+    return [(sessions[locs[i]], sessions[locs[j]]) for i, j in zip(starts, ends)]
+
+
+def get_style_returns(bundle, data_dates, run_dates, path=STYLE_RETURNS_DIR):
+    """Returns the daily style factor returns (one row per session of the bundle in run_dates).
+
+    The returns are stored on disk per bundle, only the sessions that are not stored yet
+    run make_pipeline(), and are then added to the store.  Running this every night after
+    ingesting only computes the new day.  Delete the file of the bundle to recompute all."""
+    bundle_data, _ = get_bundle_data(bundle)
+    sessions = bundle_data.equity_daily_bar_reader.sessions
+    start, end = (pd.Timestamp(d) for d in run_dates)
+    if sessions.tz is None:  # run_dates may be UTC while the sessions are naive on zipline-reloaded
+        start, end = (d.tz_localize(None) if d.tz else d for d in (start, end))
+    else:
+        start, end = (d.tz_convert(sessions.tz) if d.tz else d.tz_localize(sessions.tz) for d in (start, end))
+    days = sessions[(sessions >= start) & (sessions <= end)]
+
+    stored = load_style_returns(bundle, path)
+    missing = days.difference(stored.index)
+    if len(missing) > 0:
+        spe = make_pipeline_engine(bundle, data_dates)
+        computed = [] if stored.empty else [stored]
+        for first, last in session_runs(sessions, missing):
+            print('computing style returns from {} to {}'.format(first, last))
+            results = spe.run_pipeline(make_pipeline(), first, last)
+            run_days = sessions[(sessions >= first) & (sessions <= last)]
+            # days without results are stored as NaN, so they are not computed again
+            computed.append(style_returns_from_results(results).reindex(run_days))
+        stored = pd.concat(computed).sort_index()
+        save_style_returns(bundle, stored, path)
+
+    return stored.reindex(days)
 
 
-    SMB = R_smallest - R_biggest
-    HML = R_highpb - R_lowpb
-    MOMENTUM = R_high_momentum - R_low_momentum
-    VOL = R_highvol - R_lowvol
-    STREVERSAL = R_high_streversal - R_low_streversal
-    MyReturns = R_longs - R_shorts         #
-
-    smb_n_hml = pd.DataFrame({
-        'SMB': SMB,                # company size
-        'HML': HML,                # company PB ratio  value
-        'MOMENTUM': MOMENTUM,
-        'VOL': VOL,
-        'STREVERSAL': STREVERSAL,  # short term reversal
-        'MyReturns': MyReturns
-    }, columns=["SMB", "HML", "MOMENTUM", "VOL", "STREVERSAL", "MyReturns"]).shift(periods=-1).dropna()
-
-    # # get SPY data (not included in quantopian-quandl bundle)
-    # spy_series = pd.read_csv(SPY_PATH, index_col=0, parse_dates=True, usecols=[0, 4], date_parser=date_utc)
-    # spy_series = spy_series[spy_series.index >= run_dates[0]]  # added to only use same dates as data from the Pipeline
-    #
-    # assert "close" in spy_series.columns
-    # MKT = spy_series.pct_change()[1:].rename(columns={"close": "MKT"})  # market returns
-    #
-    # return pd.concat([MKT, smb_n_hml], axis=1).dropna()
-    return smb_n_hml
+def get_factor_returns(alpha_str, bundle, data_dates, run_dates):
+    """Returns the style factor returns, each row holding the returns of the next day.
+    These come from the store of get_style_returns()."""
+    return get_style_returns(bundle, data_dates, run_dates).shift(periods=-1).dropna()
 
 
-def calc_exposures_to_factor(alpha_str, bundle, data_dates, run_dates):
-    """Calculates the factor exposures to a given alpha on a given day, and returns them."""
+def calc_exposures_to_factor(alpha_returns, bundle, data_dates, run_dates):
+    """Calculates the factor exposures to a given alpha on a given day, and returns them.
+    alpha_returns is the daily returns of the long short portfolio of the alpha."""
 
     # get data
-    F = get_factor_returns(alpha_str, bundle, data_dates, run_dates)
+    F = get_factor_returns("close", bundle, data_dates, run_dates)
+    F = F.join(alpha_returns.rename('MyReturns'), how='inner')
 
     # calculate exposures
     y = F["MyReturns"]
@@ -195,15 +265,16 @@ def calc_exposures_to_factor(alpha_str, bundle, data_dates, run_dates):
 
     # fit OLS model
     result = sm.OLS(y_inlier, x_inlier).fit()
-    print "result.rsquared: ", result.rsquared
+    print("result.rsquared: ", result.rsquared)
 
     return result.params, result.rsquared
 
 
-def get_equity_returns(bundle, data_dates, run_dates):
-    """Gets the close price for all assets over all trading days in run_dates."""
+def get_equity_returns(bundle, data_dates, run_dates, assets=None):
+    """Gets the close price for all assets (or only the given ones) over all trading days in run_dates."""
 
-    pipe = Pipeline(columns={'Close': USEquityPricing.close.latest},)
+    screen = None if assets is None else StaticSids([int(asset) for asset in assets])
+    pipe = Pipeline(columns={'Close': USEquityPricing.close.latest}, screen=screen)
 
     # create the pipeline engine
     spe = make_pipeline_engine(bundle, data_dates)
@@ -220,44 +291,7 @@ def get_equity_returns(bundle, data_dates, run_dates):
 def get_style_cov(bundle, data_dates, run_dates):
     """Calculates the style covariance matrix."""
 
-    my_pipeline = make_pipeline(Momentum)  # Momentum is just placeholder to reuse code
-    spe = make_pipeline_engine(bundle, data_dates)
-
-    results = spe.run_pipeline(my_pipeline,
-                               pd.to_datetime(run_dates[0], utc=True),
-                               pd.to_datetime(run_dates[1], utc=True))
-    results.drop(['my_factor', 'my_longs', 'my_shorts'], axis=1)
-    # print results.head()
-
-    # mean returns of the biggest/smallest by market cap
-    R_biggest = results[results.biggest]['returns'].groupby(level=0).mean()
-    R_smallest = results[results.smallest]['returns'].groupby(level=0).mean()
-
-    R_highpb = results[results.highpb]['returns'].groupby(level=0).mean()
-    R_lowpb = results[results.lowpb]['returns'].groupby(level=0).mean()
-
-    R_low_momentum = results[results.low_momentum]['returns'].groupby(level=0).mean()
-    R_high_momentum = results[results.high_momentum]['returns'].groupby(level=0).mean()
-
-    R_lowvol = results[results.lowvol]['returns'].groupby(level=0).mean()
-    R_highvol = results[results.highvol]['returns'].groupby(level=0).mean()
-
-    R_low_streversal = results[results.low_streversal]['returns'].groupby(level=0).mean()
-    R_high_streversal = results[results.high_streversal]['returns'].groupby(level=0).mean()
-
-    SMB = R_smallest - R_biggest
-    HML = R_highpb - R_lowpb
-    MOMENTUM = R_high_momentum - R_low_momentum
-    VOL = R_highvol - R_lowvol
-    STREVERSAL = R_high_streversal - R_low_streversal
-
-    smb_n_hml = pd.DataFrame({
-        'SMB': SMB,                # company size
-        'HML': HML,                # company PB ratio  value
-        'MOMENTUM': MOMENTUM,
-        'VOL': VOL,
-        'STREVERSAL': STREVERSAL  # short term reversal
-    }, columns=["SMB", "HML", "MOMENTUM", "VOL", "STREVERSAL"]).shift(periods=-1).dropna()
+    smb_n_hml = get_style_returns(bundle, data_dates, run_dates).shift(periods=-1).dropna()
 
     # get SPY data (not included in bundle)
     spy_series = pd.read_csv(SPY_PATH, index_col=0, parse_dates=True, usecols=[0, 4], date_parser=date_utc)
@@ -276,10 +310,8 @@ def remove_sector_returns(asset, y, sector_returns):
     """Computes the beta to the sector to which the asset belongs, over the last two years."""
 
     # choose the correct sector (use sector map)
-    # print SECTOR_MAPPING[asset]
-
     # use sector mapping (to etf) to get data for regression
-    r_sect = sector_returns[GICSNAME2ETF[SECTOR_MAPPING[asset]]]  # TODO: get asset to sector map
+    r_sect = sector_returns[GICSNAME2ETF[get_sector_mapping()[asset]]]
     x = sm.add_constant(r_sect)
 
     # compute Beta to the relevant sector returns (r_sect) using OLS
@@ -292,67 +324,241 @@ def remove_sector_returns(asset, y, sector_returns):
     return y - np.dot(x, result.params) # return residual
 
 
-def calc_exposures_to_equities(equities_of_interest, bundle, data_dates, run_dates):
-    """Calculates the every stock's exposure to the five style factors, using my
-    implementation of the Quantopian Risk model.
-    https://media.quantopian.com/quantopian_risk_model_whitepaper.pdf
-    (Mostly the same, except there are no complimentary stocks)
+def get_sector_etfs(assets):
+    """Returns the array of the sector ETF of each asset, from the sector mapping."""
+    sector_mapping = get_sector_mapping()
+    return np.array([GICSNAME2ETF[sector_mapping[asset]] for asset in assets])
 
-    equities_of_interest is a set of Zipline Assets for equites we want factor loadings
-    bundle is string denoting the Zipline bundle to be used.
-    data_dates and run_dates should be a tuple of Pandas datetime.
-    """
+
+def sector_residuals(R, sector_returns, etfs):
+    """remove_sector_returns() of every asset (column) of R, etfs being the sector ETF of each one.
+    The assets of a sector share their regressors, so each sector is a single masked_ols()."""
+    returns = np.asarray(R, dtype=float)
+    eps_sector = np.empty(returns.shape)
+    for etf in np.unique(etfs):
+        cols = np.flatnonzero(etfs == etf)
+        x_sect = sm.add_constant(np.asarray(sector_returns[etf], dtype=float))
+        y = returns[:, cols]
+        params, _ = masked_ols(x_sect, y, outlier_mask(y))
+        eps_sector[:, cols] = y - np.dot(x_sect, params.T)
+    return eps_sector
+
+
+def style_exposures(x, eps_sector, assets):
+    """Regresses the sector residuals of every asset on the style factor returns x (with the
+    constant), without the outliers.  Returns the packed exposures, indexed by assets."""
+    params, rsquared = masked_ols(x, eps_sector, outlier_mask(eps_sector))
+    return pd.DataFrame(np.column_stack([params, rsquared]), index=assets, columns=EXPOSURE_COLUMNS)
+
+
+def get_exposure_inputs(bundle, data_dates, run_dates, assets=None):
+    """Gets what the exposures are computed from, over run_dates: the factor returns with a
+    constant column, the asset returns and the sector ETF returns, all on the same dates.
+    With assets, only the returns of these assets are loaded."""
 
     # get factor data, used dummy factor
     F = get_factor_returns("close", bundle, data_dates, run_dates)
-    # R is DF with stocks as columns, dates as rows
-    print 'The number of timestamps in F is {} from {} to {}.'.format(F.shape[0], run_dates[0], run_dates[1])
+    print('The number of timestamps in F is {} from {} to {}.'.format(F.shape[0], run_dates[0], run_dates[1]))
 
-    R = get_equity_returns(bundle, data_dates, run_dates)
+    R = get_equity_returns(bundle, data_dates, run_dates, assets)
     # R is DF with stocks as columns, dates as rows
 
-    print "The universe we define includes {} assets.".format(R.shape[1])
-    print 'The number of timestamps in R is {} from {} to {}.'.format(R.shape[0], run_dates[0], run_dates[1])
-    assets = R.columns
-
-    x = sm.add_constant(F.drop(['MyReturns'], axis=1))  # add a column of 1s to F, and drop dummy column
+    print("The universe we define includes {} assets.".format(R.shape[1]))
+    print('The number of timestamps in R is {} from {} to {}.'.format(R.shape[0], run_dates[0], run_dates[1]))
 
-    # create DF for packing exposures
-    packed_exposures = pd.DataFrame(index=equities_of_interest, #index=assets, # use index=assets for full universe
-                                    columns=["const", "SMB", "HML", "MOMENTUM", "VOL", "STREVERSAL", "rsquared"])
+    x = sm.add_constant(F)  # add a column of 1s to F
 
     # load sector returns
     sector_returns = pd.read_csv(SECTOR_ETF_RETURNS_FILE, index_col='date',
                                  parse_dates=['date'], na_values=['NA'], date_parser=pd.to_datetime)
     sector_returns.index = sector_returns.index.tz_localize('UTC')
 
-    # mask = (sector_returns.index >= R.index[0]) & (sector_returns.index <= R.index[-1])
-    sector_returns = sector_returns.loc[R.index]
-    print 'The number of timestamps in sector_returns is {} from {} to {}'.format(sector_returns.shape[0],
-                                                                                  sector_returns.index[0],
-                                                                                  sector_returns.index[-1])
+    # the regressions pair the rows by position, so all three must be on the same dates
+    x, R, sector_returns = align_exposure_inputs(x, R, sector_returns)
+    print('The number of timestamps in sector_returns is {} from {} to {}'.format(sector_returns.shape[0],
+                                                                                   sector_returns.index[0],
+                                                                                   sector_returns.index[-1]))
+    return x, R, sector_returns
+
+
+def align_exposure_inputs(x, R, sector_returns):
+    """Reindexes x, R and sector_returns onto the dates all three have (as UTC, naive dates
+    are taken as UTC), so the same row is the same date in each.  The dates dropped are printed."""
+    frames = []
+    for df in (x, R, sector_returns):
+        index = df.index.tz_localize('UTC') if df.index.tz is None else df.index.tz_convert('UTC')
+        frames.append(df.set_axis(index, axis=0))
+    common = frames[0].index.intersection(frames[1].index).intersection(frames[2].index)
+    for name, df in zip(['x', 'R', 'sector_returns'], frames):
+        if len(df.index) != len(common):
+            print('dropping {} dates of {} not in the other inputs'.format(len(df.index) - len(common), name))
+    return tuple(df.reindex(common) for df in frames)
+
+
+def check_same_dates(x, R, sector_returns):
+    """Raises a ValueError unless x, R and sector_returns are on the same dates, see align_exposure_inputs()."""
+    for name, df in [('x', x), ('sector_returns', sector_returns)]:
+        if not df.index.equals(R.index):
+            raise ValueError('{} and R are not on the same dates ({} and {} rows), '
+                             'use align_exposure_inputs()'.format(name, len(df.index), len(R.index)))
+
+
+def rolling_exposures(x, R, sector_returns, days, window=EXPOSURE_WINDOW, etfs=None):
+    """Yields (day, packed_exposures) for each day in days, packed_exposures being what
+    calc_exposures_to_equities() computes for every asset of R over the window rows before day.
+
+    x, R and sector_returns are as returned by get_exposure_inputs() for the whole period,
+    so the data is loaded once instead of once per day.  The sector betas come from one
+    RollingOLS per sector, moving from one day to the next only updates their sums, and
+    the style regression of all the assets is one masked_ols().
+    etfs is the sector ETF of each asset, from the sector mapping by default."""
+    check_same_dates(x, R, sector_returns)
+    if etfs is None:
+        etfs = get_sector_etfs(R.columns)
+    returns = R.values
+    sector_ols = []
+    for etf in np.unique(etfs):
+        cols = np.flatnonzero(etfs == etf)
+        if cols[-1] - cols[0] + 1 == len(cols):
+            cols = slice(cols[0], cols[-1] + 1)  # a view, not a copy of the sector's returns
+        x_sect = sm.add_constant(sector_returns[etf].values)
+        sector_ols.append((cols, RollingOLS(x_sect, returns[:, cols], window)))
+
+    for day in days:
+        end = R.index.searchsorted(day)  # the rows up to the session before day
+        rows = slice(end - window, end)
 
-    for i in assets:  # iterate over all the assets
-        print('calculating exposures to: {}'.format(i))
-        if i not in equities_of_interest:
-            print('skipping')
-            continue
+        # calculate beta to sector and subtract off beta * sector_returns
+        eps_sector = np.empty((window, returns.shape[1]))
+        for cols, ols in sector_ols:
+            params, _ = ols.fit(end)
+            eps_sector[:, cols] = returns[rows, cols] - np.dot(ols.X[rows], params.T)
+
+        yield day, style_exposures(x.values[rows], eps_sector, R.columns)
+
+
+def save_exposure_inputs(path, x, R, sector_returns, etfs):
+    """Saves what rolling_exposures() needs as .npy files, so the workers of
+    build_factor_loadings() can memory map them instead of each getting a copy.
+    The columns of the returns are sorted by sector ETF, the sids are saved in the same order."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    etf_columns = sorted(set(etfs))
+    # the assets are grouped by sector, so the returns of a sector are a contiguous slice
+    order = np.argsort(np.asarray(etfs), kind='stable')
+    np.save(os.path.join(path, 'dates.npy'), R.index.asi8)
+    np.save(os.path.join(path, 'x.npy'), np.asarray(x.values, dtype=float))
+    np.save(os.path.join(path, 'returns.npy'), np.asarray(R.values, dtype=float)[:, order])
+    np.save(os.path.join(path, 'sids.npy'), np.array([int(asset) for asset in R.columns], dtype='int64')[order])
+    np.save(os.path.join(path, 'sector_returns.npy'), np.asarray(sector_returns[etf_columns].values, dtype=float))
+    header = {'x_columns': list(x.columns), 'etf_columns': etf_columns,
+              'etfs': list(np.asarray(etfs)[order])}
+    with open(os.path.join(path, EXPOSURE_INPUTS_HEADER_FILE), 'w') as fw:
+        json.dump(header, fw)
+
+
+def load_exposure_inputs(path):
+    """Opens the inputs saved by save_exposure_inputs(), the arrays are memory mapped.
+    Returns x, R, sector_returns and etfs, R has the sids as columns and naive UTC dates."""
+    with open(os.path.join(path, EXPOSURE_INPUTS_HEADER_FILE)) as fr:
+        header = json.load(fr)
+    dates = pd.DatetimeIndex(np.load(os.path.join(path, 'dates.npy')))
+    x = pd.DataFrame(np.load(os.path.join(path, 'x.npy'), mmap_mode='r'), index=dates, columns=header['x_columns'])
+    R = pd.DataFrame(np.load(os.path.join(path, 'returns.npy'), mmap_mode='r'), index=dates,
+                     columns=np.load(os.path.join(path, 'sids.npy')))
+    sector_returns = pd.DataFrame(np.load(os.path.join(path, 'sector_returns.npy'), mmap_mode='r'),
+                                  index=dates, columns=header['etf_columns'])
+    return x, R, sector_returns, np.array(header['etfs'])
+
+
+def fill_loadings_days(args):
+    """Pool worker of build_factor_loadings(), computes a shard of days and writes them to the cube."""
+    path, inputs_path, locs, window = args
+    x, R, sector_returns, etfs = load_exposure_inputs(inputs_path)
+    factor_loadings = FactorLoadings.open(path, mode='r+')
+    days = pd.DatetimeIndex(factor_loadings.dates.asi8[locs])  # naive UTC, as the dates of R
+    for loc, (_, exposures) in zip(locs, rolling_exposures(x, R, sector_returns, days, window, etfs)):
+        factor_loadings.write_day(factor_loadings.dates[loc], exposures)
+    return len(locs)
+
+
+def build_factor_loadings(path, x, R, sector_returns, workers=1, window=EXPOSURE_WINDOW):
+    """Computes the exposures of every date of the FactorLoadings cube in path that is not
+    filled yet, and writes them to it.  After a crash, running it again only computes the
+    dates that were not written.
+
+    With workers > 1 the dates are split in shards of consecutive days computed by a pool of
+    processes, each one writing its days directly to the cube.  The inputs are saved once
+    next to the cube and memory mapped read only by all the workers."""
+    factor_loadings = FactorLoadings.open(path, mode='r+')
+    missing = np.flatnonzero(~np.asarray(factor_loadings.filled))
+    print('{} of {} days to compute'.format(len(missing), len(factor_loadings.dates)))
+    if len(missing) == 0:
+        return
+    etfs = get_sector_etfs(R.columns)
+
+    if workers <= 1:
+        days = factor_loadings.dates[missing]
+        for day, exposures in rolling_exposures(x, R, sector_returns, days, window, etfs):
+            factor_loadings.write_day(day, exposures)
+        return
+
+    inputs_path = os.path.join(path, 'inputs')
+    save_exposure_inputs(inputs_path, x, R, sector_returns, etfs)
+    # a few shards per worker balances the load, each shard starts its RollingOLS from scratch once
+    shards = [locs for locs in np.array_split(missing, workers * SHARDS_PER_WORKER) if len(locs) > 0]
+    with Pool(workers) as pool:
+        done = 0
+        for num_days in pool.imap_unordered(fill_loadings_days,
+                                            [(path, inputs_path, locs, window) for locs in shards]):
+            done += num_days
+            print('{} of {} days done'.format(done, len(missing)))
+    shutil.rmtree(inputs_path)
+
+
+def asset_shards(assets, num_shards):
+    """Splits assets in num_shards blocks of consecutive sids.  The blocks only depend on
+    the assets, so separate processes or hosts agree on them."""
+    assets = sorted(assets, key=int)
+    return [list(block) for block in np.array_split(np.array(assets, dtype=object), num_shards)]
+
+
+def shard_path(path, shard):
+    """The folder of the cube of one block of assets, for the merged cube at path."""
+    return os.path.join(path, 'shards', str(shard))
+
+
+def merge_loadings_shards(path, num_shards):
+    """Merges the cubes of the num_shards blocks of assets into one cube at path,
+    see merge_factor_loadings()."""
+    return merge_factor_loadings([shard_path(path, shard) for shard in range(num_shards)], path)
 
-        y = R.loc[:, i]
 
-        # calculate beta to sector and subtract off beta * sector_returns
-        eps_sector = remove_sector_returns(i, y, sector_returns)
+def calc_exposures_to_equities(equities_of_interest, bundle, data_dates, run_dates):
+    """Calculates the every stock's exposure to the five style factors, using my
+    implementation of the Quantopian Risk model.
+    https://media.quantopian.com/quantopian_risk_model_whitepaper.pdf
+    (Mostly the same, except there are no complimentary stocks)
+
+    equities_of_interest is a set of Zipline Assets for equites we want factor loadings
+    bundle is string denoting the Zipline bundle to be used.
+    data_dates and run_dates should be a tuple of Pandas datetime.
+    """
+
+    x, R, sector_returns = get_exposure_inputs(bundle, data_dates, run_dates)
+    check_same_dates(x, R, sector_returns)
 
-        # remove outliers
-        outlier_mask = (np.abs(eps_sector - eps_sector.mean()) <= (3 * eps_sector.std()))
-        y_inlier = eps_sector[outlier_mask]
-        x_inlier = x[outlier_mask]
+    # all the equities of interest are fitted at once
+    wanted = set(equities_of_interest)
+    assets = [asset for asset in R.columns if asset in wanted]
+    print('calculating exposures to {} assets'.format(len(assets)))
 
-        result = sm.OLS(y_inlier, x_inlier).fit()
+    # calculate beta to sector and subtract off beta * sector_returns
+    eps_sector = sector_residuals(R[assets], sector_returns, get_sector_etfs(assets))
 
-        # pack betas in data structure
-        packed_exposures.loc[i, :] = result.params
-        packed_exposures.loc[i, "rsquared"] = result.rsquared
+    # pack betas in data structure, assets of interest that are not in R are left NaN
+    packed_exposures = style_exposures(x, eps_sector, assets).reindex(equities_of_interest)
+    # use style_exposures(x, sector_residuals(R, ...), R.columns) for the full universe
 
     return packed_exposures, R[1:]
 
@@ -7,57 +7,97 @@ from os import listdir
 from alphacompiler.util.zipline_data_tools import get_ticker_sid_dict_from_bundle
 
 
-def pack_dense_data(raw_fldr, final_fn, bundle_name):
+def pack_dense_data(raw_fldr, final_fn, bundle_name, verbose=False):
     """
     This uses a pd.DataFrame, the index is dates and SIDs.
     Special care is taken to make sure every SID has a value for
     every date.  This simplifies the runtime code.
     Multiple columns of data can be stored, no extra work is required.
+    Set verbose=True to print progress for every file.
     """
     all_dfs = []
     # create a pandas dataframe
     for fn in listdir(raw_fldr):
         df = pd.read_csv(f'{raw_fldr}/{fn}', parse_dates=['timestamp'])
         sid = int(fn.split('.')[0])
-        print(f'processing: {sid}')
+        if verbose:
+            print(f'processing: {sid}')
         df['sid'] = sid
         all_dfs.append(df)
 
     df_all = pd.concat(all_dfs)
     # set date and sid as indicies
     df_all = df_all.set_index(['timestamp', 'sid'])
-    df_all = df_all.sort_index()
-    print(df_all)
+    if verbose:
+        print(df_all)
 
     # fill in df_all with NaNs for sids that are missing
-    # iterate over all the dates
-
     # get all SIDs in this bundle
     tickers2sid = get_ticker_sid_dict_from_bundle(bundle_name)
-    all_possible_sids = set(tickers2sid.values())
-    empty_data = []
-    for this_day, daydf in df_all.groupby(by='timestamp'):
-        print(this_day)
-        used_sids = daydf.index.get_level_values(1)
-        print('sids on this day: ', used_sids)
-        unused_sids = all_possible_sids - set(used_sids)
-        print('not used sids: ', unused_sids)
-        emptynans = [np.NAN] * daydf.shape[1]
-        for unused_sid in unused_sids:
-            empty_data.append([this_day, unused_sid] + emptynans)
-    unindexed_columns = ['timestamp', 'sid'] + df_all.columns.to_list()
-
-    df_empty = pd.DataFrame(empty_data, columns=unindexed_columns)
-    df_empty = df_empty.set_index(['timestamp', 'sid'])
-
-    # merge all and sort
-    df_all = pd.concat([df_all, df_empty])
-    df_all = df_all.sort_index()
+    df_all = fill_missing_sids(df_all, tickers2sid.values(), verbose=verbose)
 
     # save to file
     df_all.to_parquet(final_fn)
 
 
+def fill_missing_sids(df_all, all_possible_sids, verbose=False):
+    """
+    Reindexes df_all, indexed by (timestamp, sid), against every timestamp in
+    df_all times every sid in all_possible_sids (and in df_all).  The rows added
+    are all NaNs.  Returns the result sorted by (timestamp, sid).
+    """
+    df_all = df_all[~df_all.index.duplicated(keep='last')]
+    timestamps = df_all.index.get_level_values(0).unique().sort_values()
+    sids = df_all.index.get_level_values(1).unique().union(pd.Index(list(all_possible_sids)))
+    full_index = pd.MultiIndex.from_product([timestamps, sids.sort_values()],
+                                            names=df_all.index.names)
+
+    num_rows = df_all.shape[0]
+    df_all = df_all.reindex(full_index)
+    if verbose:
+        print(f'filled {df_all.shape[0] - num_rows} missing (timestamp, sid) rows '
+              f'for {len(timestamps)} timestamps and {len(sids)} sids')
+        print(df_all)
+    return df_all
+
+
+class PackedDenseData(object):
+    """Dense data as one dates x sids float64 matrix per field.
+
+    The column of a sid is the sid itself, so a day of data for a set of
+    assets is one row lookup and a fancy index of the columns."""
+
+    def __init__(self, dates, arrays):
+        self.dates = dates  # pd.DatetimeIndex, sorted
+        self.arrays = arrays
+        self.row_for_date = dict(zip(dates.asi8, range(len(dates))))  # ns since epoch -> row
+
+    @property
+    def num_sids(self):
+        return next(iter(self.arrays.values())).shape[1]
+
+    def __getitem__(self, field):
+        return self.arrays[field]
+
+    @classmethod
+    def from_frame(cls, df):
+        """Converts a DataFrame indexed by (timestamp, sid), as written by pack_dense_data()."""
+        date_codes, dates = pd.factorize(df.index.get_level_values(0), sort=True)
+        sids = df.index.get_level_values(1).values.astype('int64')
+
+        arrays = {}
+        for field in df.columns:
+            arr = np.full((len(dates), sids.max() + 1), np.nan)
+            arr[date_codes, sids] = df[field].values
+            arrays[field] = arr
+        return cls(pd.DatetimeIndex(dates), arrays)
+
+
+def load_dense_data(path):
+    """Reads the parquet file written by pack_dense_data() into a PackedDenseData."""
+    return PackedDenseData.from_frame(pd.read_parquet(path))
+
+
 class DenseDataFactor(CustomFactor):
     """Abstract Base Class for dense (few missing bars) data."""
     inputs = []
@@ -65,16 +105,25 @@ class DenseDataFactor(CustomFactor):
 
     def __init__(self, *args, **kwargs):
         self.data = None
-        self.data_path = "please_specify_.npy_file"
+        self.data_path = "please_specify_.parquet_file"
 
     def compute(self, today, assets, out, *arrays):
         """
-        This simply loads the data from a parquet and then reads the
-        data and outputs it.  See pack_dense_data() above for how to store
-        the data.
+        This loads the data from a parquet, converted to one matrix per field,
+        and then reads the row for today.  See pack_dense_data() above for how
+        to store the data.
         """
         if self.data is None:
-            self.data = pd.read_parquet(self.data_path)
+            self.data = load_dense_data(self.data_path)
+
+        row = self.data.row_for_date.get(today.value)
+        if row is None:
+            raise KeyError('no dense data for: {}'.format(today))
 
+        known = assets < self.data.num_sids
         for field in self.__class__.outputs:
-            out[field][:] = self.data.loc[(today, assets), field].values
+            if known.all():
+                out[field][:] = self.data[field][row, assets]
+            else:
+                out[field][:] = np.nan
+                out[field][known] = self.data[field][row, assets[known]]
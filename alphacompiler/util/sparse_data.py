@@ -16,135 +16,288 @@ from os import listdir
 import pandas as pd
 import os
 import glob
+import json
+from collections import OrderedDict
+
+SPARSE_HEADER_FILE = 'header.json'  # describes the fields stored in a packed directory
+MAX_CURSOR_HISTORY = 260  # number of dates for which the time index is kept, about a year
+
+_SPARSE_CURSORS = {}  # data_path -> SparseDataCursor, shared by all SparseDataFactors
 
 
 class SparseDataFactor(CustomFactor):
     """Abstract Base Class to be used for computing sparse data.
-    The data is packed and persisted into a NumPy binary data file
-    in a previous step.
+    The data is packed and persisted into NumPy binary data files
+    in a previous step, see pack_sparse_data().
 
     This class must be subclassed with class variable 'outputs' set.  The fields
-    in 'outputs' should match those persisted."""
+    in 'outputs' should match those persisted.
+
+    The data and the time index are shared by all factors reading the same
+    data_path, see get_sparse_cursor()."""
     inputs = []
     window_length = 1
 
     def __init__(self, *args, **kwargs):
-        self.time_index = None
-        self.curr_date = None     # date for which time_index is accurate
-        self.last_date_seen = 0   # earliest date possible
         self.data = None
-        self.data_path = "please_specify_.npy_file"
-
-    def bs(self, arr):
-        """Binary Search"""
-        if len(arr) == 1:
-            if self.curr_date < arr[0]:
-                return 0
-            else: return 1
-
-        mid = int(len(arr) / 2)
-        if self.curr_date < arr[mid]:
-            return self.bs(arr[:mid])
-        else:
-            return mid + self.bs(arr[mid:])
+        self.data_path = "please_specify_packed_data_dir"
 
-    def bs_sparse_time(self, sid):
-        """For each security find the best range in the sparse data."""
-        dates_for_sid = self.data.date[sid]
-        if np.isnan(dates_for_sid[0]):
-            return 0
+    def compute(self, today, assets, out, *arrays):
+        # for each asset in assets determine index from date (today)
+        cursor = get_sparse_cursor(self.data_path)
+        self.data = cursor.data
+        time_index = cursor.time_index_for(today)
 
-        # do a binary search of the dates array finding the index
-        # where self.curr_date will lie.
-        non_nan_dates = dates_for_sid[~np.isnan(dates_for_sid)]
-        return self.bs(non_nan_dates) - 1
+        rows, has_data = self.data.rows_for(assets, time_index)
+        for field in self.__class__.outputs:
+            out[field][:] = np.nan
+            out[field][has_data] = self.data[field][rows]
+
+
+class SparseDataCursor(object):
+    """The time index of every sid into packed sparse data, for the dates of a simulation.
 
-    def cold_start(self, today, assets):
-        if self.data is None:
-            self.data = np.load(self.data_path, allow_pickle=True)
+    Pipeline computes one factor over all the dates of a chunk before moving to the
+    next factor, so the time index of recent dates is kept and the following factors
+    reading the same data reuse it instead of redoing the work."""
 
-        self.M = self.data.date.shape[1]
+    def __init__(self, data, max_history=MAX_CURSOR_HISTORY):
+        self.data = data
+        self.max_history = max_history
+        self.time_index = None  # position in each sid's rows
+        self.curr_date = None   # date for which time_index is accurate
+        self.history = OrderedDict()  # date -> time_index, in the order computed
 
-        # for each sid, do binary search of date array to find current index
-        # the results can be shared across all factors that inherit from SparseDataFactor
+    def cold_start(self, today):
+        # binary search of the date array for all sids at once, see sparse_time_index()
         # this sets an array of ints: time_index
-        self.time_index = np.full(self.N, -1, np.dtype('int64'))
+        self.time_index = sparse_time_index(self.data, today.value)
         self.curr_date = today.value
-        for asset in assets:  # asset is numpy.int64
-            self.time_index[asset] = self.bs_sparse_time(asset)
 
-    def update_time_index(self, today, assets):
+    def update_time_index(self, today):
         """Ratchet update.
 
-        for each asset check if today >= dates[self.time_index]
-        if so then increment self.time_index[asset.sid] += 1"""
+        for each sid check if today >= the date of its next row
+        if so then increment self.time_index[sid] += 1
+        A sid can only move one row, if some sid is still behind today
+        (a jump of more than one session) the time index is recomputed."""
 
-        ind_p1 = self.time_index.copy()
-        np.add.at(ind_p1, ind_p1 != (self.M - 1), 1)
-        sids_to_increment = today.value >= self.data.date[np.arange(self.N), ind_p1]
-        sids_not_max = self.time_index != (self.M - 1)   # create mask of non-maxed
-        self.time_index[sids_to_increment & sids_not_max] += 1
+        self.time_index = self.time_index + self._rows_due(today)
+        if self._rows_due(today).any():
+            self.cold_start(today)
+            return
 
         self.curr_date = today.value
 
-    def compute(self, today, assets, out, *arrays):
-        # for each asset in assets determine index from date (today)
-        if self.time_index is None or today < self.last_date_seen:
-            self.cold_start(today, assets)
+    def _rows_due(self, today):
+        """Mask of the sids whose next row is dated on or before today."""
+        next_index = self.time_index + 1
+        due = next_index < self.data.lengths  # create mask of non-maxed
+        next_row = self.data.offsets[:-1][due] + next_index[due]
+        due[due] = today.value >= self.data.date[next_row]
+        return due
+
+    def time_index_for(self, today):
+        """Returns the time index of all sids for today, advancing at most once per date."""
+        time_index = self.history.get(today.value)
+        if time_index is not None:
+            return time_index
+
+        if self.time_index is None or today.value < self.curr_date:
+            self.cold_start(today)
         else:
-            self.update_time_index(today, assets)
-        self.last_date_seen = today
-
-        ti_used_today = self.time_index[assets]
-
-        for field in self.__class__.outputs:
-            out[field][:] = self.data[field][assets, ti_used_today]
+            self.update_time_index(today)
+
+        self.history[today.value] = self.time_index
+        while len(self.history) > self.max_history:
+            self.history.popitem(last=False)
+        return self.time_index
+
+
+def get_sparse_cursor(data_path):
+    """Returns the SparseDataCursor for data_path, loading the data on first use.
+    Cursors are kept for the life of the process, see clear_sparse_cursors()."""
+    cursor = _SPARSE_CURSORS.get(data_path)
+    if cursor is None:
+        cursor = SparseDataCursor(load_sparse_data(data_path))
+        _SPARSE_CURSORS[data_path] = cursor
+    return cursor
+
+
+def clear_sparse_cursors():
+    """Forgets all loaded data, for example after re-packing it."""
+    _SPARSE_CURSORS.clear()
+
+
+def sparse_time_index(data, curr_date, sids=None):
+    """Finds the time index of many sids at once.
+
+    data is a PackedSparseData, the rows of each sid are sorted by date.  A binary
+    search is run over the rows of every requested sid at the same time, one NumPy
+    step per level, so the cost is O(len(sids) * log(max rows per sid)).
+    Returns the position of the last date <= curr_date in the rows of each sid,
+    -1 if curr_date is before the first date or the sid has no data."""
+    if sids is None:
+        sids = np.arange(data.num_sids)
+    sids = np.asarray(sids, dtype='int64')
+    first = data.offsets[sids]
+
+    # lo ends up as the first row with a date > curr_date
+    lo = first.copy()
+    hi = data.offsets[sids + 1]
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        go_right = active & (data.date[np.where(active, mid, 0)] <= curr_date)
+        go_left = active & ~go_right
+        lo[go_right] = mid[go_right] + 1
+        hi[go_left] = mid[go_left]
+        active = lo < hi
+
+    return lo - first - 1
+
+
+class PackedSparseData(object):
+    """Packed sparse data as written by pack_sparse_data().
+
+    The rows of all sids are stored back to back (CSR-style), sorted by sid then
+    by date.  The rows of sid i are [offsets[i], offsets[i + 1]) in the flat 'date'
+    array and in the flat array of each field, so memory scales with the number of
+    rows actually stored.  Fields are accessed as data.date or data[field]."""
+
+    def __init__(self, offsets, arrays):
+        self.offsets = offsets
+        self.arrays = arrays
+        self.fields = [field for field in arrays if field != 'date']
+
+    @property
+    def date(self):
+        return self.arrays['date']
+
+    @property
+    def num_sids(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def num_rows(self):
+        return self.date.shape[0]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, field):
+        return self.arrays[field]
+
+    def rows_for(self, sids, time_index):
+        """Returns the rows of the sids that have data at their time_index (known sid,
+        time_index >= 0), and the mask of those sids."""
+        sids = np.asarray(sids, dtype='int64')
+        has_data = sids < self.num_sids
+        has_data[has_data] = time_index[sids[has_data]] >= 0
+        sids = sids[has_data]
+        return self.offsets[sids] + time_index[sids], has_data
+
+    @classmethod
+    def from_padded(cls, arrays):
+        """Converts (N, M) arrays padded with NaN dates, as written by older versions."""
+        valid = ~np.isnan(arrays['date'])
+        offsets = np.zeros(valid.shape[0] + 1, np.dtype('int64'))
+        np.cumsum(valid.sum(axis=1), out=offsets[1:])
+        return cls(offsets, dict((field, np.asarray(arr)[valid]) for field, arr in arrays.items()))
+
+
+def save_sparse_data(data, path):
+    """Writes the arrays of data to the folder: path, one .npy file per field, the
+    offsets of each sid, and a small JSON header describing the fields.
+    Read back with load_sparse_data()."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    np.save(os.path.join(path, 'offsets.npy'), data.offsets)
+    for field, arr in data.arrays.items():
+        np.save(os.path.join(path, '{}.npy'.format(field)), arr)
+
+    header = {'layout': 'ragged', 'fields': data.fields, 'num_sids': int(data.num_sids),
+              'num_rows': int(data.num_rows), 'dtype': data.date.dtype.str}
+    with open(os.path.join(path, SPARSE_HEADER_FILE), 'w') as fw:
+        json.dump(header, fw, indent=2)
+
+
+def load_sparse_data(path, mmap_mode='r'):
+    """Opens packed sparse data.  The .npy files are memory mapped, so the data is
+    only read from disk when used and the OS page cache is shared by all processes
+    reading the same files.
+    The padded (N, M) formats written by older versions are still supported, but
+    are converted and fully loaded in memory."""
+    if not os.path.isdir(path):  # pickled np.recarray
+        data = np.load(path, allow_pickle=True)
+        return PackedSparseData.from_padded(dict((field, data[field]) for field in data.dtype.names))
+
+    with open(os.path.join(path, SPARSE_HEADER_FILE)) as fr:
+        header = json.load(fr)
+
+    arrays = {}
+    for field in ['date'] + header['fields']:
+        arrays[field] = np.load(os.path.join(path, '{}.npy'.format(field)), mmap_mode=mmap_mode)
+
+    if header.get('layout') != 'ragged':
+        return PackedSparseData.from_padded(arrays)
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+    return PackedSparseData(offsets, arrays)
 
 
 def pack_sparse_data(N, rawpath, fields, filename):
-    """pack data into np.recarray and persists it to a file to be
-    used by SparseDataFactor"""
-
-    # create buffer to hold data for all tickers
-    dfs = [None] * N
-
-    max_len = -1
+    """pack the per sid files in rawpath into flat arrays and persists them to
+    the folder: filename to be used by SparseDataFactor, see pack_sparse_frame()"""
+    dfs = []
     for fn in listdir(rawpath):
         if not fn.endswith(".csv"):
             continue
-        df = pd.read_csv(os.path.join(rawpath,fn), index_col="Date", parse_dates=True)
-        df = df.sort_index()
-        sid = int(fn.split('.')[0])
-        print("packing sid: %d" % sid)
-        dfs[sid] = df
-
-        # width is max number of rows in any file
-        max_len = max(max_len, df.shape[0])
-
-    # TODO: temp workaround for `Array Index Out of Bound` bug
-    max_len = max_len + 1
-
-    # pack up data as buffer
-    num_fundamentals = len(fields)
-    buff = np.full((num_fundamentals + 1, N, max_len), np.nan)
-
-    dtypes = [('date', '<f8')]
+        df = pd.read_csv(os.path.join(rawpath,fn), parse_dates=['Date'])
+        df['sid'] = int(fn.split('.')[0])
+        dfs.append(df)
+    print("packing {} sids from: {}".format(len(dfs), rawpath))
+    if len(dfs) == 0:
+        dfs.append(pd.DataFrame(columns=['sid', 'Date'] + list(fields)))
+
+    pack_sparse_frame(pd.concat(dfs, ignore_index=True), N, fields, filename)
+
+
+def pack_sparse_frame(df, N, fields, filename, raw_path=None):
+    """pack a long table, one row per (sid, Date) with columns: sid, Date
+    and fields, into flat arrays and persists them to the folder: filename to
+    be used by SparseDataFactor.  df can be a pd.DataFrame or a pyarrow.Table.
+
+    The rows are sorted once and the offsets of each sid come from counting
+    the rows per sid, no per sid files are needed.  If raw_path is given the
+    per sid files are also written there, for debugging, see export_raw_csv()."""
+    if hasattr(df, 'to_pandas'):  # pyarrow.Table
+        df = df.select(['sid', 'Date'] + list(fields)).to_pandas()
+    df = df.sort_values(['sid', 'Date'], kind='mergesort')
+    sids = df['sid'].values.astype('int64')
+    if sids.shape[0] > 0 and sids.max() >= N:
+        raise ValueError('sid {} does not fit in N={}'.format(sids.max(), N))
+
+    # the rows of sid i are stored at [offsets[i], offsets[i + 1])
+    offsets = np.zeros(N + 1, np.dtype('int64'))
+    np.cumsum(np.bincount(sids, minlength=N), out=offsets[1:])
+
+    dates = pd.to_datetime(df['Date']).values.astype('datetime64[ns]')
+    arrays = {'date': dates.astype('int64').astype('float64')}
     for field in fields:
-        dtypes.append((field, '<f8'))
+        arrays[field] = df[field].values.astype('float64')
 
-    # pack self.data as np.recarray
-    data = np.recarray(shape=(N, max_len), buf=buff, dtype=dtypes)
+    save_sparse_data(PackedSparseData(offsets, arrays), filename)
+    if raw_path is not None:
+        export_raw_csv(df, fields, raw_path)
 
-    # iterate over loaded data and populate self.data
-    for i, df in enumerate(dfs):
-        if df is None:
-            continue
-        ind_len = df.index.shape[0]
-        data.date[i, :ind_len] = df.index
-        for field in fields:
-            data[field][i, :ind_len] = df[field]
 
-    data.dump(filename)  # can be read back with np.load()
+def export_raw_csv(df, fields, raw_path):
+    """Writes one file per sid: raw_path/{sid}.csv with a Date column and fields,
+    the format read by pack_sparse_data().  Only needed for debugging."""
+    for sid, df_sid in df.groupby('sid'):
+        df_sid.set_index('Date')[list(fields)].to_csv(os.path.join(raw_path, "{}.csv".format(sid)))
 
 
 def clear_raw_folder(raw_folder_path):
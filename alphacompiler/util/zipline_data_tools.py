@@ -5,61 +5,97 @@ Created by Peter Harrington (pbharrin) on 10/10/17.
 """
 
 import os
-from zipline.data.bundles.core import load
+import json
+from zipline.data.bundles.core import load, ingestions_for_bundle, to_bundle_ingest_dirname
+from zipline.utils.paths import data_path
 import numpy as np
-from zipline.utils.math_utils import nanmean, nanstd
+from zipline.utils.math_utils import nanstd
 from zipline.pipeline import SimplePipelineEngine
 from zipline.pipeline.loaders import USEquityPricingLoader
 from zipline.pipeline.data import USEquityPricing
+from zipline.pipeline.domain import US_EQUITIES
+
+ASSET_MAP_FILE = 'asset_map.json'
+_ASSET_MAPS = {}  # (bundle_name, ingestion) -> asset map, read at most once per process
+_BUNDLES = {}  # bundle name -> (bundle_data, pricing loader), loaded at most once per process
+_PIPELINE_LOADERS = {}  # column -> PipelineLoader, see register_pipeline_loader()
+
+
+def nan_cov_corr(m0, m1, corr=True, allowed_missing_ratio=0.25):
+    """
+    Column by column covariance and correlation of m0 and m1, ignoring NaNs.
+    m0 and m1 are (N, M), either one can also be (N,) or (N, 1) to use the
+    same series against every column of the other one (a factor against a
+    matrix of returns for example).
+    Returns (covariances, correlations) of shape (M,), correlations is None
+    with corr=False.
+
+    Same definitions as the original fast_cov()/fast_corr(): the covariance is
+    the population covariance over the rows where both are present, the
+    correlation divides it by the std of each input over its own non NaN rows.
+    Columns with more than allowed_missing_ratio * N rows missing in either
+    input are NaN, these are found first and skipped.
+    """
+    m0 = np.asarray(m0, dtype=float)
+    m1 = np.asarray(m1, dtype=float)
+    if m0.ndim == 1:
+        m0 = m0[:, None]
+    if m1.ndim == 1:
+        m1 = m1[:, None]
+    N = m0.shape[0]
+    M = max(m0.shape[1], m1.shape[1])
+    allowed_missing_count = int(allowed_missing_ratio * N)
+
+    # joint mask, built once, and the missing count before doing any work
+    missing = np.isnan(m0) | np.isnan(m1)         # shape: (N, M)
+    count = N - np.count_nonzero(missing, axis=0)
+    keep = count >= N - allowed_missing_count
+
+    covariances = np.full(M, np.nan)
+    correlations = np.full(M, np.nan) if corr else None
+    if not keep.any():
+        return covariances, correlations
+    if keep.sum() < M // 2:  # only worth the copies when many columns are dropped
+        if m0.shape[1] > 1:
+            m0 = m0[:, keep]
+        if m1.shape[1] > 1:
+            m1 = m1[:, keep]
+        missing = missing[:, keep]
+        count = count[keep]
+
+    # only one side needs centering: the centered side sums to 0 over the
+    # joint rows, so sum(x * (y - mean(y))) == sum((x - mean(x)) * (y - mean(y)))
+    x = np.where(missing, 0.0, m0)
+    y = np.where(missing, 0.0, m1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y -= y.sum(axis=0) / count                # rows outside the mask have x == 0
+        cov = np.einsum('ij,ij->j', x, y) / count
+
+        if corr:
+            # corr(x,y) = cov(x,y)/std(x)/std(y), each std over its own rows
+            cor = cov / nanstd(m0, axis=0) / nanstd(m1, axis=0)
+
+    if cov.shape[0] == M:
+        cov[~keep] = np.nan
+        covariances = cov
+        if corr:
+            cor[~keep] = np.nan
+            correlations = cor
+    else:
+        covariances[keep] = cov
+        if corr:
+            correlations[keep] = cor
+    return covariances, correlations
 
 
 def fast_cov(m0, m1):
     """Improving the speed of cov()"""
-    nan = np.nan
-    isnan = np.isnan
-    N, M = m0.shape
-    #out = np.full(M, nan)
-    allowed_missing_count = int(0.25 * N)
-
-    independent = np.where(  # shape: (N, M)
-        isnan(m0),
-        nan,
-        m1,
-    )
-    ind_residual = independent - nanmean(independent, axis=0)  # shape: (N, M)
-    covariances = nanmean(ind_residual * m0, axis=0)           # shape: (M,)
-
-    nanlocs = isnan(independent).sum(axis=0) > allowed_missing_count
-    covariances[nanlocs] = nan
-    return covariances
+    return nan_cov_corr(m0, m1, corr=False)[0]
 
 
 def fast_corr(m0, m1):
     """Improving the speed of correlation"""
-    nan = np.nan
-    isnan = np.isnan
-    N, M = m0.shape
-    out = np.full(M, nan)
-    allowed_missing_count = int(0.25 * N)
-
-    independent = np.where(  # shape: (N, M)
-        isnan(m0),
-        nan,
-        m1,
-    )
-    ind_residual = independent - nanmean(independent, axis=0)  # shape: (N, M)
-    covariances = nanmean(ind_residual * m0, axis=0)  # shape: (M,)
-
-    # corr(x,y) = cov(x,y)/std(x)/std(y)
-    std_v = nanstd(m0, axis=0)  # std(X)  could reuse ind_residual for possible speedup
-    np.divide(covariances, std_v, out=out)
-    std_v = nanstd(m1, axis=0)  # std(Y)
-    np.divide(out, std_v, out=out)
-
-    # handle NaNs
-    nanlocs = isnan(independent).sum(axis=0) > allowed_missing_count
-    out[nanlocs] = nan
-    return out
+    return nan_cov_corr(m0, m1)[1]
 
 
 def get_tickers_from_bundle(bundle_name):
@@ -67,7 +103,7 @@ def get_tickers_from_bundle(bundle_name):
     bundle_data = load(bundle_name, os.environ, None)
 
     # get a list of all sids
-    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes(frozenset([str("US")]))
+    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes(country_codes=frozenset([str("US")]))
     all_sids = lifetimes.sid
 
     # retreive all assets in the bundle
@@ -82,7 +118,7 @@ def get_all_assets_for_bundle(bundle_name):
     bundle_data = load(bundle_name, os.environ, None)
 
     # get a list of all sids
-    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes(frozenset([str("US")]))
+    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes(country_codes=frozenset([str("US")]))
     all_sids = lifetimes.sid
 
     print('all_sids: ', all_sids)
@@ -91,27 +127,118 @@ def get_all_assets_for_bundle(bundle_name):
     return bundle_data.asset_finder.retrieve_all(sids=all_sids)
 
 
+def build_asset_map(bundle_name, environ=os.environ):
+    """Reads the asset DB of a bundle, returns a dict with the ticker2sid map,
+    the max sid and the number of assets."""
+    bundle_data = load(bundle_name, environ, None)
+    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes(country_codes=frozenset([str("US")]))
+    all_assets = bundle_data.asset_finder.retrieve_all(lifetimes.sid)
+
+    ticker2sid = dict((asset.symbol, int(asset.sid)) for asset in all_assets)
+    return {'ticker2sid': ticker2sid,
+            'max_sid': max([int(asset.sid) for asset in all_assets] or [-1]),
+            'num_assets': len(all_assets)}
+
+
+def load_asset_map(bundle_name, environ=os.environ):
+    """
+    Returns the asset map (see build_asset_map()) of the most recent ingestion
+    of a bundle.  The map is saved as a .json in the folder of the ingestion,
+    re-ingesting creates a new folder so the old map is not used anymore.
+    It is also kept in memory, so only the first call in a process reads a file.
+    """
+    try:
+        ingestions = ingestions_for_bundle(bundle_name, environ)
+    except FileNotFoundError:  # no folder at all for the bundle
+        ingestions = []
+    if len(ingestions) == 0:
+        raise ValueError('bundle {} has no ingestions, it must be ingested first'.format(bundle_name))
+    ingestion = to_bundle_ingest_dirname(ingestions[0])
+    key = (bundle_name, ingestion)
+    if key in _ASSET_MAPS:
+        return _ASSET_MAPS[key]
+
+    path = data_path([bundle_name, ingestion, ASSET_MAP_FILE], environ)
+    if os.path.exists(path):
+        with open(path) as f:
+            asset_map = json.load(f)
+    else:
+        asset_map = build_asset_map(bundle_name, environ)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(asset_map, f)
+        os.replace(tmp_path, path)  # readers never see a half written file
+
+    _ASSET_MAPS[key] = asset_map
+    return asset_map
+
+
 def get_ticker_sid_dict_from_bundle(bundle_name):
-    """Packs the (ticker,sid) tuples into a dict."""
-    all_equities = get_tickers_from_bundle(bundle_name)
-    return dict(all_equities)
+    """Returns the ticker -> sid dict of a bundle, from the cached asset map."""
+    return dict(load_asset_map(bundle_name)['ticker2sid'])
 
 
-def make_pipeline_engine(bundle, data_dates):
-    """Creates a pipeline engine for the dates in data_dates.
-    Using this allows usage very similar to run_pipeline in Quantopian's env."""
+def get_max_sid_from_bundle(bundle_name):
+    """The largest sid in a bundle, from the cached asset map."""
+    return load_asset_map(bundle_name)['max_sid']
+
+
+def register_pipeline_loader(column_or_dataset, loader):
+    """Makes the engines of make_pipeline_engine() use loader for a column, or
+    for all the columns of a DataSet."""
+    for column in getattr(column_or_dataset, 'columns', [column_or_dataset]):
+        _PIPELINE_LOADERS[column] = loader
 
-    bundle_data = load(bundle, os.environ, None)
 
-    pipeline_loader = USEquityPricingLoader(bundle_data.equity_daily_bar_reader, bundle_data.adjustment_reader)
+def get_bundle_data(bundle):
+    """Loads a bundle (and its pricing loader) once per process, returns
+    (bundle_data, pricing_loader)."""
+    if bundle not in _BUNDLES:
+        bundle_data = load(bundle, os.environ, None)
+        if hasattr(USEquityPricingLoader, 'without_fx'):  # zipline-reloaded
+            pricing_loader = USEquityPricingLoader.without_fx(bundle_data.equity_daily_bar_reader,
+                                                              bundle_data.adjustment_reader)
+        else:  # zipline Quantopian
+            pricing_loader = USEquityPricingLoader(bundle_data.equity_daily_bar_reader,
+                                                   bundle_data.adjustment_reader)
+        _BUNDLES[bundle] = (bundle_data, pricing_loader)
+    return _BUNDLES[bundle]
+
+
+def clear_bundle_cache():
+    """Forgets the loaded bundles, needed after re-ingesting a bundle in the same process."""
+    _BUNDLES.clear()
+
+
+def make_pipeline_engine(bundle, data_dates, loaders=None):
+    """Creates a pipeline engine for the dates in data_dates.
+    Using this allows usage very similar to run_pipeline in Quantopian's env.
+    The bundle is only loaded the first time, later calls (for any dates)
+    reuse its readers.  loaders is an optional dict of column -> PipelineLoader
+    for columns other than USEquityPricing, on top of the ones registered with
+    register_pipeline_loader()."""
+
+    bundle_data, pipeline_loader = get_bundle_data(bundle)
+    custom_loaders = dict(_PIPELINE_LOADERS)
+    for column, loader in (loaders or {}).items():
+        for col in getattr(column, 'columns', [column]):
+            custom_loaders[col] = loader
 
     def choose_loader(column):
         if column in USEquityPricing.columns:
             return pipeline_loader
+        if column in custom_loaders:
+            return custom_loaders[column]
         raise ValueError("No PipelineLoader registered for column %s." % column)
 
     # set up pipeline
-    cal = bundle_data.equity_daily_bar_reader.trading_calendar.all_sessions
+    trading_calendar = bundle_data.equity_daily_bar_reader.trading_calendar
+    if not hasattr(trading_calendar, 'all_sessions'):  # zipline-reloaded, sessions come from the domain
+        return SimplePipelineEngine(get_loader=choose_loader,
+                                    asset_finder=bundle_data.asset_finder,
+                                    default_domain=US_EQUITIES)
+
+    cal = trading_calendar.all_sessions  # zipline Quantopian
     cal2 = cal[(cal >= data_dates[0]) & (cal <= data_dates[1])]
 
     spe = SimplePipelineEngine(get_loader=choose_loader,
@@ -0,0 +1,64 @@
+"""
+Benchmark of the exposures of one day in calc_exposures_to_equities(), the
+per asset sector and style sm.OLS() fits it used to run vs the batched
+sector_residuals() and style_exposures().
+
+python benchmarks/bench_calc_exposures.py
+"""
+import time
+from unittest import mock
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from alphacompiler.risk import risk_factors
+from alphacompiler.risk.risk_factors import (remove_sector_returns, sector_residuals, style_exposures,
+                                             get_sector_etfs, GICSNAME2ETF, EXPOSURE_COLUMNS)
+
+T = 504    # two years of days
+M = 1500   # assets
+
+
+def legacy_exposures(x, R, sector_returns, equities_of_interest):
+    """As previously done by calc_exposures_to_equities() once the data is loaded."""
+    packed_exposures = pd.DataFrame(index=equities_of_interest, columns=EXPOSURE_COLUMNS)
+    for i in R.columns:
+        if i not in equities_of_interest:
+            continue
+        y = R.loc[:, i]
+        eps_sector = remove_sector_returns(i, y, sector_returns)
+        outlier_mask = (np.abs(eps_sector - eps_sector.mean()) <= (3 * eps_sector.std()))
+        result = sm.OLS(eps_sector[outlier_mask], x[outlier_mask]).fit()
+        packed_exposures.loc[i, :] = result.params
+        packed_exposures.loc[i, "rsquared"] = result.rsquared
+    return packed_exposures
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    dates = pd.date_range('2014-01-02', periods=T, freq='B', tz='UTC')
+    x = sm.add_constant(pd.DataFrame(rng.randn(T, 5) * 0.01, index=dates,
+                                     columns=EXPOSURE_COLUMNS[1:-1]))
+    sector_names = sorted(GICSNAME2ETF)
+    sector_returns = pd.DataFrame(rng.randn(T, len(sector_names)) * 0.01, index=dates,
+                                  columns=[GICSNAME2ETF[name] for name in sector_names])
+    assets = ['A{}'.format(i) for i in range(M)]
+    sectors = dict((asset, sector_names[i % len(sector_names)]) for i, asset in enumerate(assets))
+    R = pd.DataFrame(np.dot(x.values[:, 1:], rng.randn(5, M)) + rng.standard_t(3, (T, M)) * 0.01,
+                     index=dates, columns=assets)
+    R.iloc[0] = np.nan
+
+    with mock.patch.dict(risk_factors._SECTOR_MAPPING, sectors):
+        t0 = time.time()
+        legacy = legacy_exposures(x, R, sector_returns, assets)
+        t_legacy = time.time() - t0
+
+        t0 = time.time()
+        batched = style_exposures(x, sector_residuals(R, sector_returns, get_sector_etfs(assets)), assets)
+        t_batched = time.time() - t0
+
+    assert np.allclose(batched.values, legacy.values.astype(float), rtol=1e-7, atol=1e-12)
+    print('exposures of {} assets over {} days'.format(M, T))
+    print('  sm.OLS() per asset:  {:.3f}s'.format(t_legacy))
+    print('  batched masked_ols(): {:.4f}s'.format(t_batched))
+    print('  speedup: {:.0f}x'.format(t_legacy / t_batched))
@@ -0,0 +1,102 @@
+"""
+Benchmark of the adjustment stage of from_crsp_dump(), the second read_csv of
+the dump plus per row PERMNO -> sid apply it used to run vs
+build_crsp_adjustments() on the rows kept from the first read.
+Reports wall time and peak memory (tracemalloc) of both, on a synthetic
+CRSP shaped dump.
+
+python benchmarks/bench_crsp_adjustments.py
+"""
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from alphacompiler.data.loaders.crsp_daily_stock import build_crsp_adjustments, DIV_COLUMNS
+
+NUM_PERMNOS = 2000
+NUM_DAYS = 500
+ADJUSTMENT_RATIO = 0.005  # fraction of rows with a dividend or split
+
+
+def write_crsp_dump(path, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.bdate_range('2015-01-02', periods=NUM_DAYS)
+    num_rows = NUM_PERMNOS * NUM_DAYS
+    permnos = np.repeat(10000 + np.arange(NUM_PERMNOS), NUM_DAYS)
+    prc = 10 + rng.rand(num_rows) * 90
+    has_adj = rng.rand(num_rows) < ADJUSTMENT_RATIO
+    facpr = np.where(has_adj, rng.choice([0.0, 0.0, 0.0, 1.0, -1.0], num_rows), np.nan)
+    div_date = np.where(has_adj, '20150101', '')
+    df = pd.DataFrame({'date': np.tile(dates.strftime('%Y%m%d'), NUM_PERMNOS),
+                       'PERMNO': permnos, 'PERMCO': permnos + 5,
+                       'TSYMBOL': np.char.add('T', permnos.astype(str)), 'PRIMEXCH': 'N',
+                       'PRC': prc, 'VOL': rng.randint(100, 10000, num_rows), 'OPENPRC': prc,
+                       'ASKHI': prc + 1, 'BIDLO': prc - 1, 'CUSIP': np.char.add('C', permnos.astype(str)),
+                       'DCLRDT': div_date, 'PAYDT': div_date, 'RCRDDT': div_date,
+                       'DIVAMT': np.where(has_adj, rng.rand(num_rows), np.nan), 'FACPR': facpr})
+    df.to_csv(path, index=False)
+    return {permno: sid for sid, permno in enumerate(np.unique(permnos))}
+
+
+def legacy_adjustments(file_name, permno2sid_map, skipped_permnos):
+    """The adjustment stage previously run at the end of from_crsp_dump(), without the prints."""
+    dfds = pd.read_csv(file_name, index_col='date',
+                       parse_dates=['date'], na_values=['NA'])
+    dfds = dfds[pd.notnull(dfds['FACPR'])]
+    dfds = dfds[~dfds['PERMNO'].isin(skipped_permnos)]
+    dfds.loc[:, 'sid'] = dfds.loc[:, 'PERMNO'].apply(lambda x: permno2sid_map[x])
+    dfds = dfds.drop(["VOL", "ASKHI", "BIDLO", "OPENPRC",
+                      'PERMCO', 'PRIMEXCH', 'PRC', 'PERMNO', 'CUSIP'], axis=1)
+
+    dfd = dfds[dfds["FACPR"] == 0.0].copy()
+    dfd.loc[:, 'ex_date'] = dfd.index
+    dfd = dfd.rename(columns={'DCLRDT': 'declared_date', 'PAYDT': 'pay_date',
+                              'RCRDDT': 'record_date', 'DIVAMT': 'amount'})
+    dfd = dfd.drop(['FACPR', 'TSYMBOL'], axis=1)
+
+    dfs = dfds[dfds["FACPR"] != 0.0]
+    dfs = dfs[dfs['FACPR'] != -1.0].copy()
+    dfs.loc[:, 'effective_date'] = dfs.index
+    dfs.loc[:, 'ratio'] = 1.0 / (1 + dfs.loc[:, 'FACPR'])
+    dfs = dfs.drop(['TSYMBOL', 'DCLRDT', 'PAYDT', 'RCRDDT', 'DIVAMT', 'FACPR'], axis=1)
+    return dfs, dfd
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    t0 = time.time()
+    result = func(*args)
+    elapsed = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+if __name__ == '__main__':
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(tmp_dir, 'CRSP.csv')
+        permno2sid_map = write_crsp_dump(file_name)
+        skipped = list(permno2sid_map)[:10]  # pretend a few securities were skipped
+        for permno in skipped:
+            del permno2sid_map[permno]
+
+        # the frame from_crsp_dump() already has in memory
+        df = pd.read_csv(file_name, index_col='date', parse_dates=['date'], na_values=['NA'])
+        df_adj = df.loc[pd.notnull(df['FACPR']), ['PERMNO'] + DIV_COLUMNS]
+
+        (dfs_old, dfd_old), t_old, mem_old = measure(legacy_adjustments, file_name, permno2sid_map, skipped)
+        (dfs_new, dfd_new), t_new, mem_new = measure(build_crsp_adjustments, df_adj, permno2sid_map)
+
+        pd.testing.assert_frame_equal(dfs_old[dfs_new.columns], dfs_new, check_names=False)
+        np.testing.assert_array_equal(dfd_old['sid'], dfd_new['sid'])
+        np.testing.assert_array_equal(dfd_old['amount'], dfd_new['amount'])
+        print('{} rows, {} splits, {} dividends'.format(df.shape[0], dfs_new.shape[0], dfd_new.shape[0]))
+        print('  re-read + apply:          {:.2f}s, peak {:.0f} MB'.format(t_old, mem_old))
+        print('  build_crsp_adjustments(): {:.2f}s, peak {:.0f} MB'.format(t_new, mem_new))
+    finally:
+        shutil.rmtree(tmp_dir)
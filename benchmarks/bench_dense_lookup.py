@@ -0,0 +1,58 @@
+"""
+Benchmark of DenseDataFactor lookups over a multi-year range, the per day
+MultiIndex .loc it used to run vs the row lookup in PackedDenseData.
+
+python benchmarks/bench_dense_lookup.py
+"""
+import time
+import numpy as np
+import pandas as pd
+
+from alphacompiler.util.dense_data import PackedDenseData
+
+NUM_DAYS = 4 * 365  # the crypto calendar trades every day
+NUM_SIDS = 500
+FIELDS = ['mktdom']
+
+
+def make_dense_frame(num_days, num_sids, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2017-01-01', periods=num_days, freq='D', tz='UTC')
+    index = pd.MultiIndex.from_product([dates, np.arange(num_sids)], names=['timestamp', 'sid'])
+    return pd.DataFrame({'mktdom': rng.rand(len(index))}, index=index)
+
+
+if __name__ == '__main__':
+    df = make_dense_frame(NUM_DAYS, NUM_SIDS)
+    dates = df.index.levels[0]
+    assets = pd.Index(np.arange(0, NUM_SIDS, 2))
+    out = np.empty(len(assets))
+
+    t0 = time.time()
+    legacy = []
+    for today in dates:
+        for field in FIELDS:
+            out[:] = df.loc[(today, assets), field].values
+        legacy.append(out.copy())
+    t_legacy = time.time() - t0
+
+    t0 = time.time()
+    data = PackedDenseData.from_frame(df)
+    t_convert = time.time() - t0
+
+    t0 = time.time()
+    columnar = []
+    for today in dates:
+        row = data.row_for_date[today.value]
+        for field in FIELDS:
+            out[:] = data[field][row, assets]
+        columnar.append(out.copy())
+    t_columnar = time.time() - t0
+
+    assert np.array_equal(np.array(legacy), np.array(columnar))
+    print('{} days x {} assets, {} field(s)'.format(NUM_DAYS, len(assets), len(FIELDS)))
+    print('  MultiIndex .loc per day:  {:.3f}s'.format(t_legacy))
+    print('  one time conversion:      {:.3f}s'.format(t_convert))
+    print('  matrix row lookup:        {:.3f}s'.format(t_columnar))
+    print('  speedup: {:.0f}x ({:.0f}x including the conversion)'.format(
+        t_legacy / t_columnar, t_legacy / (t_columnar + t_convert)))
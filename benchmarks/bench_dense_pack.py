@@ -0,0 +1,67 @@
+"""
+Benchmark of the NaN fill step of pack_dense_data(), the per day loop
+over missing sids it used to run vs the reindex in fill_missing_sids().
+Reports wall time and peak memory (tracemalloc) of both.
+
+python benchmarks/bench_dense_pack.py
+"""
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from alphacompiler.util.dense_data import fill_missing_sids
+
+NUM_DAYS = 3 * 365
+NUM_SIDS = 2000
+MISSING_RATIO = 0.2  # fraction of (day, sid) pairs absent from the raw files
+
+
+def make_raw_frame(num_days, num_sids, seed=0):
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2018-01-01', periods=num_days, freq='D', tz='UTC')
+    index = pd.MultiIndex.from_product([dates, np.arange(num_sids)], names=['timestamp', 'sid'])
+    keep = rng.rand(len(index)) > MISSING_RATIO
+    return pd.DataFrame({'marketcap_dominance': rng.rand(keep.sum())}, index=index[keep])
+
+
+def legacy_fill(df_all, all_possible_sids):
+    """The fill previously done in pack_dense_data(), without the prints."""
+    all_possible_sids = set(all_possible_sids)
+    empty_data = []
+    for this_day, daydf in df_all.groupby(by='timestamp'):
+        used_sids = daydf.index.get_level_values(1)
+        unused_sids = all_possible_sids - set(used_sids)
+        emptynans = [np.nan] * daydf.shape[1]
+        for unused_sid in unused_sids:
+            empty_data.append([this_day, unused_sid] + emptynans)
+    unindexed_columns = ['timestamp', 'sid'] + df_all.columns.to_list()
+
+    df_empty = pd.DataFrame(empty_data, columns=unindexed_columns)
+    df_empty = df_empty.set_index(['timestamp', 'sid'])
+
+    df_all = pd.concat([df_all, df_empty])
+    return df_all.sort_index()
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    t0 = time.time()
+    result = func(*args)
+    elapsed = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+if __name__ == '__main__':
+    df = make_raw_frame(NUM_DAYS, NUM_SIDS).sort_index()
+    sids = range(NUM_SIDS)
+
+    legacy, t_legacy, mem_legacy = measure(legacy_fill, df, sids)
+    filled, t_filled, mem_filled = measure(fill_missing_sids, df, sids)
+
+    pd.testing.assert_frame_equal(legacy, filled, check_index_type=False)
+    print('{} days x {} sids, {} rows filled'.format(NUM_DAYS, NUM_SIDS, filled.shape[0] - df.shape[0]))
+    print('  per day loop:  {:.2f}s, peak {:.0f} MB'.format(t_legacy, mem_legacy))
+    print('  reindex:       {:.2f}s, peak {:.0f} MB'.format(t_filled, mem_filled))
@@ -0,0 +1,92 @@
+"""
+Benchmark of fast_corr()/fast_cov(), the versions with several nanmean/nanstd
+passes they used to be vs nan_cov_corr().  Checks the results match and
+reports the time of both, for pairs of matrices and for one factor against a
+matrix of returns.
+
+python benchmarks/bench_fast_corr.py
+"""
+import time
+import numpy as np
+from zipline.utils.math_utils import nanmean, nanstd
+
+from alphacompiler.util.zipline_data_tools import fast_corr, fast_cov, nan_cov_corr
+
+N = 504     # two years of days
+M = 3000    # assets
+NAN_RATIO = 0.05
+REPEATS = 10
+
+
+def legacy_fast_cov(m0, m1):
+    """As previously done by fast_cov()"""
+    nan = np.nan
+    isnan = np.isnan
+    N, M = m0.shape
+    allowed_missing_count = int(0.25 * N)
+
+    independent = np.where(isnan(m0), nan, m1)
+    ind_residual = independent - nanmean(independent, axis=0)
+    covariances = nanmean(ind_residual * m0, axis=0)
+
+    nanlocs = isnan(independent).sum(axis=0) > allowed_missing_count
+    covariances[nanlocs] = nan
+    return covariances
+
+
+def legacy_fast_corr(m0, m1):
+    """As previously done by fast_corr()"""
+    nan = np.nan
+    isnan = np.isnan
+    N, M = m0.shape
+    out = np.full(M, nan)
+    allowed_missing_count = int(0.25 * N)
+
+    independent = np.where(isnan(m0), nan, m1)
+    ind_residual = independent - nanmean(independent, axis=0)
+    covariances = nanmean(ind_residual * m0, axis=0)
+
+    std_v = nanstd(m0, axis=0)
+    np.divide(covariances, std_v, out=out)
+    std_v = nanstd(m1, axis=0)
+    np.divide(out, std_v, out=out)
+
+    nanlocs = isnan(independent).sum(axis=0) > allowed_missing_count
+    out[nanlocs] = nan
+    return out
+
+
+def make_data(seed=0):
+    rng = np.random.RandomState(seed)
+    m0 = rng.randn(N, M) * 0.02
+    m1 = 0.5 * m0 + rng.randn(N, M) * 0.02
+    m0[rng.rand(N, M) < NAN_RATIO] = np.nan
+    m1[rng.rand(N, M) < NAN_RATIO] = np.nan
+    m1[:200, :50] = np.nan  # some columns with too much missing data
+    return m0, m1
+
+
+def timeit(func, *args):
+    t0 = time.time()
+    for _ in range(REPEATS):
+        result = func(*args)
+    return result, (time.time() - t0) / REPEATS
+
+
+if __name__ == '__main__':
+    m0, m1 = make_data()
+
+    for name, legacy, new in [('fast_cov', legacy_fast_cov, fast_cov), ('fast_corr', legacy_fast_corr, fast_corr)]:
+        old_result, t_old = timeit(legacy, m0, m1)
+        new_result, t_new = timeit(new, m0, m1)
+        np.testing.assert_allclose(new_result, old_result, rtol=1e-10, atol=1e-14)
+        print('{} of two ({}, {}) matrices'.format(name, N, M))
+        print('  legacy: {:.1f}ms   new: {:.1f}ms'.format(t_old * 1e3, t_new * 1e3))
+
+    # one factor against every column, the legacy version needs it tiled
+    factor = m0[:, 0]
+    old_result, t_old = timeit(lambda: legacy_fast_corr(np.tile(factor[:, None], (1, M)), m1))
+    (_, new_result), t_new = timeit(nan_cov_corr, factor, m1)
+    np.testing.assert_allclose(new_result, old_result, rtol=1e-10, atol=1e-14)
+    print('correlation of one factor against ({}, {}) returns'.format(N, M))
+    print('  legacy (tiled): {:.1f}ms   nan_cov_corr(): {:.1f}ms'.format(t_old * 1e3, t_new * 1e3))
@@ -0,0 +1,55 @@
+"""
+Benchmark of the factor regressions of the risk model, one sm.OLS() per
+asset and per day as risk_factors used to do vs RollingOLS, which keeps the
+cross products of the 504 day window as running sums and solves all the
+assets at once.
+
+python benchmarks/bench_rolling_ols.py
+"""
+import time
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from alphacompiler.risk.regression import RollingOLS
+
+WINDOW = 504   # two years of days
+DAYS = 20      # days of loadings computed
+M = 1000       # assets
+LEGACY_DAYS = 2  # the per asset fits are timed on fewer days
+
+
+def legacy_fit(X, Y):
+    """One sm.OLS() per asset on the rows within 3 std, as calc_exposures_to_equities() did."""
+    params = []
+    for j in range(Y.shape[1]):
+        y = pd.Series(Y[:, j])
+        inlier = (np.abs(y - y.mean()) <= (3 * y.std())).values
+        params.append(sm.OLS(Y[inlier, j], X[inlier]).fit().params)
+    return np.array(params)
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    T = WINDOW + DAYS
+    X = sm.add_constant(rng.randn(T, 5) * 0.01)
+    Y = np.dot(X[:, 1:], rng.randn(5, M)) + rng.standard_t(3, (T, M)) * 0.01
+    Y[rng.rand(T, M) < 0.01] = np.nan
+    ends = range(WINDOW, T + 1)
+
+    t0 = time.time()
+    legacy = [legacy_fit(X[end - WINDOW:end], Y[end - WINDOW:end]) for end in ends[:LEGACY_DAYS]]
+    t_legacy = (time.time() - t0) / LEGACY_DAYS
+
+    ols = RollingOLS(X, Y, WINDOW)
+    t0 = time.time()
+    rolling = [ols.fit(end)[0] for end in ends]
+    t_rolling = (time.time() - t0) / len(ends)
+
+    for expected, params in zip(legacy, rolling):
+        assert np.allclose(params, expected, rtol=1e-7, atol=1e-12)
+    print('{} assets, {} day window'.format(M, WINDOW))
+    print('  sm.OLS() per asset: {:.3f}s per day'.format(t_legacy))
+    print('  RollingOLS:         {:.4f}s per day'.format(t_rolling))
+    print('  speedup: {:.0f}x, 5 years of days: {:.0f}min -> {:.1f}s'.format(
+        t_legacy / t_rolling, 1260 * t_legacy / 60, 1260 * t_rolling))
@@ -0,0 +1,74 @@
+"""
+Benchmark of the SparseDataFactor cold start, the per sid recursive binary
+search it used to run vs the vectorized sparse_time_index().
+
+python benchmarks/bench_sparse_cold_start.py
+"""
+import time
+import numpy as np
+
+from alphacompiler.util.sparse_data import PackedSparseData, sparse_time_index
+
+N = 15000  # roughly the number of sids in the sep bundle
+M = 120    # 30 years of quarterly filings
+
+
+def legacy_bs(arr, curr_date):
+    """Binary Search, as previously done by SparseDataFactor.bs()"""
+    if len(arr) == 1:
+        if curr_date < arr[0]:
+            return 0
+        else: return 1
+
+    mid = int(len(arr) / 2)
+    if curr_date < arr[mid]:
+        return legacy_bs(arr[:mid], curr_date)
+    else:
+        return mid + legacy_bs(arr[mid:], curr_date)
+
+
+def legacy_bs_sparse_time(dates, sid, curr_date):
+    """As previously done by SparseDataFactor.bs_sparse_time(), on the padded array."""
+    dates_for_sid = dates[sid]
+    if np.isnan(dates_for_sid[0]):
+        return 0
+    non_nan_dates = dates_for_sid[~np.isnan(dates_for_sid)]
+    return legacy_bs(non_nan_dates, curr_date) - 1
+
+
+def make_packed_data(N, M, seed=0):
+    """Synthetic padded recarray with a date field, rows have random lengths."""
+    rng = np.random.RandomState(seed)
+    buff = np.full((2, N, M), np.nan)
+    data = np.recarray(shape=(N, M), buf=buff, dtype=[('date', '<f8'), ('value', '<f8')])
+    lengths = rng.randint(0, M, N)
+    start = np.datetime64('1990-01-01', 'ns').astype('int64')
+    quarter = np.timedelta64(91, 'D').astype('timedelta64[ns]').astype('int64')
+    for sid in range(N):
+        offsets = rng.randint(0, 40, lengths[sid]) + np.arange(lengths[sid]) * quarter
+        data.date[sid, :lengths[sid]] = start + offsets * 1.0
+        data.value[sid, :lengths[sid]] = rng.randn(lengths[sid])
+    return data
+
+
+if __name__ == '__main__':
+    data = make_packed_data(N, M)
+    today = np.datetime64('2005-06-30', 'ns').astype('int64')
+    assets = np.arange(N)
+
+    packed = PackedSparseData.from_padded({'date': data.date, 'value': data.value})
+
+    t0 = time.time()
+    legacy = np.array([legacy_bs_sparse_time(data.date, sid, today) for sid in assets])
+    t_legacy = time.time() - t0
+
+    t0 = time.time()
+    vectorized = sparse_time_index(packed, today, assets)
+    t_vectorized = time.time() - t0
+
+    has_data = packed.lengths > 0  # sids without data used to get 0, now -1
+    assert np.array_equal(legacy[has_data], vectorized[has_data])
+    print('cold start for {} sids x {} dates'.format(N, M))
+    print('  per sid binary search: {:.4f}s'.format(t_legacy))
+    print('  sparse_time_index():   {:.4f}s'.format(t_vectorized))
+    print('  speedup: {:.0f}x'.format(t_legacy / t_vectorized))
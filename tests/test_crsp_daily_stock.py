@@ -0,0 +1,128 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+from alphacompiler.data.loaders.crsp_daily_stock import from_crsp_dump, calendar_gaps, parse_crsp_dates
+
+SESSIONS = pd.DatetimeIndex(['2018-01-02', '2018-01-03', '2018-01-04', '2018-01-05',
+                             '2018-01-08', '2018-01-09', '2018-01-10'])
+
+
+def write_crsp_dump(path):
+    """Small CRSP dump, the securities are not sorted by PERMNO."""
+    rows = []
+
+    def add(permno, ticker, exch, dates, facpr=None):
+        for i, date in enumerate(dates):
+            price = 20.0 + i
+            div = (None, None, None, None, None)
+            if facpr is not None and i == 1:
+                div = ('2017-12-20', '2018-01-20', '2018-01-05', 0.5, facpr)
+            rows.append((date, permno, permno + 1, ticker, exch, -price if i == 0 else price, 1000.0,
+                         price, price + 1, price - 1, 'C{}'.format(permno)) + div)
+
+    add(10002, 'BBB', 'Q', ['2018-01-02', '2018-01-03', '2018-01-04', '2018-01-05', '2018-01-08',
+                            '2018-01-10'], facpr=1.0)  # delisting pattern, 2 for 1 split
+    add(10001, 'AAA', 'N', [str(d.date()) for d in SESSIONS], facpr=0.0)
+    add(10003, 'CCC', 'N', ['2018-01-02', '2018-01-03', '2018-01-05', '2018-01-08', '2018-01-09',
+                            '2018-01-10'], facpr=0.0)  # gap in the middle
+    add(10004, 'DDD', 'X', ['2018-01-02', '2018-01-03'])
+    rows.insert(3, rows[8])  # a duplicate row of AAA, the first one is kept
+    pd.DataFrame(rows, columns=['date', 'PERMNO', 'PERMCO', 'TSYMBOL', 'PRIMEXCH', 'PRC', 'VOL', 'OPENPRC',
+                                'ASKHI', 'BIDLO', 'CUSIP', 'DCLRDT', 'PAYDT', 'RCRDDT', 'DIVAMT',
+                                'FACPR']).to_csv(path, index=False)
+
+
+class Test_Calendar_Gaps(unittest.TestCase):
+    def test_gaps(self):
+        dates = SESSIONS[[1, 2, 4, 6]]
+        this_cal, missing = calendar_gaps(dates, SESSIONS)
+        self.assertTrue(this_cal.equals(SESSIONS[1:]))
+        self.assertTrue(missing.equals(SESSIONS[[3, 5]]))
+
+    def test_date_off_the_calendar(self):
+        dates = pd.DatetimeIndex(['2018-01-03', '2018-01-06'])  # a Saturday
+        this_cal, missing = calendar_gaps(dates, SESSIONS)
+        self.assertTrue(this_cal.equals(SESSIONS[1:4]))
+        self.assertTrue(missing.equals(SESSIONS[2:4]))
+
+
+class Test_Parse_Crsp_Dates(unittest.TestCase):
+    def test_numbers_and_strings(self):
+        expected = [pd.Timestamp('2018-01-05'), pd.NaT]
+        self.assertEqual(parse_crsp_dates(pd.Series([20180105.0, np.nan])).tolist(), expected)
+        self.assertEqual(parse_crsp_dates(pd.Series(['2018-01-05', None])).tolist(), expected)
+
+
+class Test_From_Crsp_Dump(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dump_file = os.path.join(self.tmp_dir, 'CRSP.csv')
+        write_crsp_dump(self.dump_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ingest(self):
+        daily_bar_writer, asset_db_writer, adjustment_writer = mock.Mock(), mock.Mock(), mock.Mock()
+        report_file = os.path.join(self.tmp_dir, 'problems.csv')
+        ingest = from_crsp_dump(self.dump_file, report_file=report_file)
+        ingest(None, asset_db_writer, None, daily_bar_writer, adjustment_writer,
+               None, None, False, self.tmp_dir)
+
+        data_list = daily_bar_writer.write.call_args[0][0]
+        equities = asset_db_writer.write.call_args[1]['equities']
+        # sids follow the order of the dump, the delisted security loses its last two rows
+        self.assertEqual([sid for sid, _ in data_list], [0, 1])
+        self.assertEqual(equities['symbol'].tolist(), ['C10002-BBB', 'C10001-AAA'])
+        self.assertEqual(equities['end_date'].tolist(), [pd.Timestamp('2018-01-05'), pd.Timestamp('2018-01-10')])
+        df_aaa = data_list[1][1]
+        self.assertTrue(df_aaa.index.equals(SESSIONS))
+        self.assertEqual(sorted(df_aaa.columns), ['close', 'high', 'low', 'open', 'volume'])
+        self.assertEqual(df_aaa['close'].iloc[0], 20.0)  # abs() of the estimated price
+
+        # the gap in CCC no longer stops the ingest, it is in the report instead
+        report = pd.read_csv(report_file)
+        self.assertEqual(report['PERMNO'].tolist(), [10003, 10004])
+        self.assertEqual(report['reason'].tolist(), ['1 missing interstitial dates', 'exchange X'])
+
+        dividends = adjustment_writer.write.call_args[1]['dividends']
+        self.assertEqual(dividends['sid'].tolist(), [1])
+        np.testing.assert_array_equal(dividends['amount'], [0.5])
+        self.assertEqual(dividends['pay_date'].tolist(), [pd.Timestamp('2018-01-20')])
+        self.assertEqual(dividends['ex_date'].tolist(), [pd.Timestamp('2018-01-03')])
+
+        splits = adjustment_writer.write.call_args[1]['splits']
+        self.assertEqual(splits['sid'].tolist(), [0])
+        self.assertEqual(splits['effective_date'].tolist(), [pd.Timestamp('2018-01-03')])
+        np.testing.assert_array_equal(splits['ratio'], [0.5])
+
+    def test_rows_before_the_calendar(self):
+        # the NYSE calendar starts in 1990, older rows are dropped and reported
+        df = pd.read_csv(self.dump_file)
+        old = df[df['PERMNO'] == 10001].iloc[:2].copy()
+        old['date'] = ['1985-01-02', '1985-01-03']
+        gone = old.assign(PERMNO=10005, TSYMBOL='EEE')
+        pd.concat([old, gone, df]).to_csv(self.dump_file, index=False)
+
+        daily_bar_writer, asset_db_writer, adjustment_writer = mock.Mock(), mock.Mock(), mock.Mock()
+        report_file = os.path.join(self.tmp_dir, 'problems.csv')
+        ingest = from_crsp_dump(self.dump_file, report_file=report_file)
+        ingest(None, asset_db_writer, None, daily_bar_writer, adjustment_writer,
+               None, None, False, self.tmp_dir)
+
+        equities = asset_db_writer.write.call_args[1]['equities']
+        self.assertEqual(equities['symbol'].tolist(), ['C10002-BBB', 'C10001-AAA'])
+        self.assertTrue(daily_bar_writer.write.call_args[0][0][1][1].index.equals(SESSIONS))
+        report = pd.read_csv(report_file)
+        self.assertEqual(report['PERMNO'].tolist(), [10001, 10005, 10003, 10004])
+        self.assertEqual(report['reason'].tolist()[:2], ['2 rows outside the calendar dropped',
+                                                         'no dates on the calendar'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+from alphacompiler.data import crypto_scales
+from alphacompiler.data.crypto_scales import (uint32_scales, save_scales, CryptoScales, SCALES_FILE,
+                                              MAX_SCALED_PRICE, MAX_SCALED_VOLUME)
+
+
+def legacy_price_scale(low):
+    """Number of doublings the old while loop in scale_df_for_uint32() ran."""
+    scale = 1.0
+    while low * scale < 10:
+        scale *= 2.0
+    return scale
+
+
+def make_bars(low, high=None, volume=1e6):
+    high = low * 3 if high is None else high
+    return pd.DataFrame({'open': [low * 2, low * 2], 'high': [high, low * 2], 'low': [low, low * 1.5],
+                         'close': [low * 2, low * 2], 'volume': [volume, np.nan]})
+
+
+class Test_Uint32_Scales(unittest.TestCase):
+    def test_matches_doubling_loop(self):
+        for low in [1e-9, 3e-6, 0.00123, 0.5, 1.25, 2.5, 9.99, 10.0, 250.0]:
+            price_scale, volume_scale = uint32_scales(make_bars(low))
+            self.assertEqual(price_scale, legacy_price_scale(low))
+            # the volume scale does not depend on the prices
+            self.assertEqual(volume_scale, uint32_scales(make_bars(100.0))[1])
+
+    def test_prices_fit(self):
+        # a coin that went from a fraction of a cent to thousands cannot reach the low target
+        df = make_bars(1e-6, high=5000.0)
+        price_scale, _ = uint32_scales(df)
+        self.assertLess(df['high'].max() * price_scale, MAX_SCALED_PRICE)
+        self.assertGreater(df['high'].max() * price_scale * 2, MAX_SCALED_PRICE)
+
+    def test_volume_fits(self):
+        df = make_bars(100.0, volume=1e15)
+        price_scale, volume_scale = uint32_scales(df)
+        self.assertEqual(price_scale, 1.0)
+        self.assertLessEqual(1e15 * volume_scale, MAX_SCALED_VOLUME)
+        self.assertGreater(1e15 * volume_scale * 2, MAX_SCALED_VOLUME)
+
+    def test_small_volume_round_trip(self):
+        # a sub-cent coin with small volumes keeps them, the volume is scaled up
+        volumes = np.array([90000.0, 250000.0, 1234.5, 7.0])
+        df = pd.DataFrame({'open': 2e-4, 'high': 3e-4, 'low': 1e-4, 'close': 2e-4, 'volume': volumes})
+        price_scale, volume_scale = uint32_scales(df)
+        self.assertEqual(price_scale, 2.0 ** 17)
+        self.assertGreaterEqual(volume_scale, 1.0)
+        self.assertLessEqual(volumes.max() * volume_scale, MAX_SCALED_VOLUME)
+        self.assertGreater(volumes.max() * volume_scale * 2, MAX_SCALED_VOLUME)
+        stored = np.round(volumes * volume_scale).astype('uint32')
+        np.testing.assert_allclose(stored / volume_scale, volumes, rtol=1e-6)
+
+    def test_no_positive_lows(self):
+        self.assertEqual(uint32_scales(make_bars(0.0, high=1.0))[0], 1.0)
+
+    def test_no_volume(self):
+        self.assertEqual(uint32_scales(make_bars(1.0, volume=np.nan))[1], 1.0)
+
+
+class Test_Crypto_Scales_Factor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        save_scales([2.0, 4.0, 8.0], [0.5, 0.25, 0.125], os.path.join(self.tmp_dir, SCALES_FILE))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unknown_sids_are_nan(self):
+        with mock.patch.object(crypto_scales, 'ZIPLINE_DATA_DIR', self.tmp_dir + '/'):
+            factor = CryptoScales()
+        out = np.recarray(shape=3, dtype=[('price', '<f8'), ('volume', '<f8')])
+        factor.compute(pd.Timestamp('2021-01-04'), np.array([2, 5, 0]), out)  # sid 5 came after the scales
+
+        np.testing.assert_array_equal(out.price, [8.0, np.nan, 2.0])
+        np.testing.assert_array_equal(out.volume, [0.125, np.nan, 0.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from alphacompiler.util.dense_data import DenseDataFactor, PackedDenseData, fill_missing_sids
+
+
+class DenseTestFactor(DenseDataFactor):
+    outputs = ['mktdom', 'volume']
+
+
+def make_dense_frame(num_days, sids, seed=0):
+    """DataFrame indexed by (timestamp, sid) like the one written by pack_dense_data()."""
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2019-01-01', periods=num_days, freq='D', tz='UTC')
+    index = pd.MultiIndex.from_product([dates, sids], names=['timestamp', 'sid'])
+    df = pd.DataFrame({'mktdom': rng.rand(len(index)),
+                       'volume': rng.randint(0, 1000, len(index)).astype(float)}, index=index)
+    df.loc[df.sample(frac=0.1, random_state=seed).index, 'mktdom'] = np.nan
+    return df
+
+
+class Test_Dense_Data_Factor(unittest.TestCase):
+    def test_matches_multiindex_lookup(self):
+        df = make_dense_frame(30, [0, 1, 2, 5, 9])
+        factor = DenseTestFactor()
+        factor.data = PackedDenseData.from_frame(df)
+
+        assets = pd.Index([9, 0, 2, 5])
+        for today in df.index.levels[0]:
+            out = np.recarray(shape=len(assets), dtype=[('mktdom', '<f8'), ('volume', '<f8')])
+            factor.compute(today, assets, out)
+            for field in DenseTestFactor.outputs:
+                np.testing.assert_array_equal(out[field], df.loc[(today, assets), field].values)
+
+    def test_unknown_date(self):
+        factor = DenseTestFactor()
+        factor.data = PackedDenseData.from_frame(make_dense_frame(3, [0, 1]))
+        out = np.recarray(shape=2, dtype=[('mktdom', '<f8'), ('volume', '<f8')])
+        with self.assertRaises(KeyError):
+            factor.compute(pd.Timestamp('2030-01-01', tz='UTC'), pd.Index([0, 1]), out)
+
+
+class Test_Fill_Missing_Sids(unittest.TestCase):
+    def test_every_sid_on_every_date(self):
+        df = make_dense_frame(10, [0, 1, 2, 5])
+        df = df.drop(df.sample(frac=0.3, random_state=1).index)  # remove some (timestamp, sid) rows
+        filled = fill_missing_sids(df, [0, 1, 2, 3, 5, 7])
+
+        expected_index = pd.MultiIndex.from_product([df.index.levels[0], [0, 1, 2, 3, 5, 7]])
+        self.assertTrue(filled.index.equals(expected_index))
+        pd.testing.assert_frame_equal(filled.loc[df.index], df)
+        added = filled.index.difference(df.index)
+        self.assertTrue(filled.loc[added].isnull().all().all())
+
+
+if __name__ == '__main__':
+    unittest.main()
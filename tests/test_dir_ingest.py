@@ -0,0 +1,61 @@
+import unittest
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+from alphacompiler.data.loaders.dir_ingest import iter_dir_files, SkipFile
+
+
+def read_total(path):
+    """prepare function for the tests, module level so it can go to a process pool"""
+    try:
+        df = pd.read_csv(path)
+    except pd.errors.EmptyDataError:
+        raise SkipFile('no data')
+    return df['close'].sum()
+
+
+class Test_Iter_Dir_Files(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for i in range(20):
+            pd.DataFrame({'close': [i, 1.0]}).to_csv(os.path.join(self.tmp_dir, 'T{:02d}.csv'.format(19 - i)),
+                                                    index=False)
+        open(os.path.join(self.tmp_dir, 'EMPTY.csv'), 'w').close()
+        with open(os.path.join(self.tmp_dir, 'BROKEN.csv'), 'w') as f:
+            f.write('close\n1\n2,3,4\n')  # a row with too many fields
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check(self, **kwargs):
+        skipped = []
+        results = list(iter_dir_files(self.tmp_dir, read_total, skipped=skipped, **kwargs))
+
+        self.assertEqual([fn for fn, _ in results], ['T{:02d}.csv'.format(i) for i in range(20)])
+        self.assertEqual([total for _, total in results], [20.0 - i for i in range(20)])
+        self.assertEqual([fn for fn, _ in skipped], ['BROKEN.csv', 'EMPTY.csv'])
+        self.assertEqual(skipped[1][1], 'no data')
+        self.assertTrue(skipped[0][1].startswith('ParserError'))
+
+    def test_serial(self):
+        self.check()
+
+    def test_threads(self):
+        self.check(workers=3)
+
+    def test_processes(self):
+        self.check(workers=2, processes=True)
+
+    def test_bugs_are_not_skipped(self):
+        with open(os.path.join(self.tmp_dir, 'NO_CLOSE.csv'), 'w') as f:
+            f.write('open,high\n1,2\n')
+        with self.assertRaises(KeyError):
+            list(iter_dir_files(self.tmp_dir, read_total))
+        with self.assertRaises(KeyError):
+            list(iter_dir_files(self.tmp_dir, read_total, workers=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from alphacompiler.risk.factor_loadings import FactorLoadings, merge_factor_loadings
+
+FACTORS = ['SMB', 'HML', 'MOMENTUM', 'VOL', 'STREVERSAL']
+
+
+def make_exposures(sids, seed):
+    """A packed_exposures frame, as computed by calc_exposures_to_equities()."""
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame(rng.randn(len(sids), len(FACTORS) + 2), index=sids,
+                        columns=['const'] + FACTORS + ['rsquared'])
+
+
+class Test_Factor_Loadings(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dates = pd.date_range('2016-01-04', periods=10, freq='B', tz='UTC')
+        self.sids = [8, 3, 24, 5]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_days_and_slice(self):
+        cube = FactorLoadings.create(self.tmp_dir, FACTORS, self.dates, self.sids)
+        self.assertEqual(cube.shape, (5, 10, 4))
+        self.assertEqual(len(cube.missing_dates()), 10)
+
+        day2 = make_exposures([3, 8, 24, 99], seed=0)  # 99 is not in the cube, 5 is missing
+        cube.write_day(self.dates[2], day2)
+        cube.write_day(self.dates[5], make_exposures(self.sids, seed=1))
+
+        loadings = FactorLoadings.open(self.tmp_dir)
+        self.assertIsInstance(loadings.values, np.memmap)
+        self.assertEqual(loadings.factors, FACTORS)
+        pd.testing.assert_index_equal(loadings.dates, self.dates)
+        self.assertEqual(list(loadings.missing_dates()), [d for i, d in enumerate(self.dates) if i not in (2, 5)])
+
+        hml = loadings.factor('HML', start=self.dates[1], end=self.dates[5], assets=[24, 3])
+        self.assertEqual(list(hml.index), list(self.dates[1:6]))
+        self.assertEqual(list(hml.columns), [24, 3])
+        np.testing.assert_allclose(hml.loc[self.dates[2]].values, day2.loc[[24, 3], 'HML'].values, rtol=1e-6)
+        self.assertTrue(hml.loc[self.dates[1]].isnull().all())
+
+        on_day = loadings.loadings_on(self.dates[2])
+        self.assertTrue(on_day.loc[5].isnull().all())
+        np.testing.assert_allclose(on_day.loc[8].values, day2.loc[8, FACTORS].values, rtol=1e-6)
+
+        with self.assertRaises(KeyError):
+            loadings.factor('SMB', assets=[99])
+
+    def test_merge_shards(self):
+        paths = ['{}/shard{}'.format(self.tmp_dir, k) for k in range(2)]
+        blocks = [self.sids[:3], self.sids[3:]]
+        for k, (path, sids) in enumerate(zip(paths, blocks)):
+            shard = FactorLoadings.create(path, FACTORS, self.dates, sids)
+            for i in range(len(self.dates)):
+                if (k, i) != (1, 4):  # the second shard did not finish day 4
+                    shard.write_day(self.dates[i], make_exposures(sids, seed=10 * k + i))
+
+        merged = merge_factor_loadings(paths, '{}/merged'.format(self.tmp_dir), chunk_dates=3)
+        self.assertEqual(list(merged.sids), self.sids)
+        self.assertEqual(list(merged.missing_dates()), [self.dates[4]])
+        for k, (path, sids) in enumerate(zip(paths, blocks)):
+            np.testing.assert_array_equal(merged.factor('VOL', assets=sids).values,
+                                          FactorLoadings.open(path).factor('VOL').values)
+
+        other = '{}/other'.format(self.tmp_dir)
+        FactorLoadings.create(other, FACTORS, self.dates[1:], [77])
+        with self.assertRaises(ValueError):
+            merge_factor_loadings([paths[0], other], '{}/bad'.format(self.tmp_dir))
+        with self.assertRaises(ValueError):
+            merge_factor_loadings([paths[0], paths[0]], '{}/bad'.format(self.tmp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
 import os
-from alphacompiler.data.load_quandl_sf1 import populate_raw_data_from_dump
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from alphacompiler.data.load_quandl_sf1 import populate_raw_data_from_dump, read_dump_chunked
 
 from alphacompiler.util.zipline_data_tools import get_ticker_sid_dict_from_bundle
 
@@ -22,5 +26,46 @@ class Test_Populate_From_Dump(unittest.TestCase):
         self.assertEquals(True, True)
 
 
+class Test_Read_Dump_Chunked(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dump_file = os.path.join(self.tmp_dir, 'SF1.csv')
+        pd.DataFrame([['A', 'ARQ', '2010-01-01', 1.0, 0.1],
+                      ['A', 'ART', '2010-01-01', 4.0, 0.4],
+                      ['A', 'ARQ', '2010-04-01', 2.0, 0.2],
+                      ['B', 'ART', '2010-01-01', 5.0, 0.5],
+                      ['B', 'MRQ', '2010-02-01', 6.0, 0.6],
+                      ['ZZZ', 'ARQ', '2010-01-01', 7.0, 0.7]],
+                     columns=['ticker', 'dimension', 'datekey', 'netinc', 'roe']).to_csv(self.dump_file, index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pivots_fields_and_dimensions(self):
+        df = read_dump_chunked({'A': 0, 'B': 1}, ['netinc', 'roe', 'roe'], ['ARQ', 'ARQ', 'ART'],
+                               dump_file=self.dump_file, chunksize=2)  # small chunks split sid A
+
+        self.assertEqual(df.columns.tolist(), ['sid', 'Date', 'netinc_ARQ', 'roe_ARQ', 'roe_ART'])
+        self.assertEqual(df['sid'].tolist(), [0, 0, 1])
+        self.assertEqual(df['Date'].tolist(), [pd.Timestamp('2010-01-01'), pd.Timestamp('2010-04-01'),
+                                               pd.Timestamp('2010-01-01')])
+        np.testing.assert_array_equal(df['netinc_ARQ'], [1.0, 2.0, np.nan])
+        np.testing.assert_array_equal(df['roe_ARQ'], [0.1, 0.2, np.nan])
+        np.testing.assert_array_equal(df['roe_ART'], [0.4, np.nan, 0.5])
+
+    def test_duplicates_keep_the_last_row(self):
+        dump = pd.read_csv(self.dump_file)
+        restated = pd.DataFrame([['A', 'ARQ', '2010-01-01', 10.0, np.nan]], columns=dump.columns)
+        pd.concat([dump, restated]).to_csv(self.dump_file, index=False)
+
+        # the duplicate of A is in the same chunk, or across a chunk boundary
+        for chunksize in [7, 3, 2, 1]:
+            df = read_dump_chunked({'A': 0, 'B': 1}, ['netinc', 'roe', 'roe'], ['ARQ', 'ARQ', 'ART'],
+                                   dump_file=self.dump_file, chunksize=chunksize)
+            np.testing.assert_array_equal(df['netinc_ARQ'], [10.0, 2.0, np.nan])
+            np.testing.assert_array_equal(df['roe_ARQ'], [np.nan, 0.2, np.nan])
+            np.testing.assert_array_equal(df['roe_ART'], [0.4, np.nan, 0.5])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from alphacompiler.risk.regression import outlier_mask, masked_ols, RollingOLS
+
+
+def make_regression_data(T, M, seed=0):
+    """Factor returns with a constant and fat tailed asset returns, with some NaNs."""
+    rng = np.random.RandomState(seed)
+    F = rng.randn(T, 5) * 0.01
+    Y = np.dot(F, rng.randn(5, M)) + rng.standard_t(3, (T, M)) * 0.01
+    Y[rng.rand(T, M) < 0.03] = np.nan
+    Y[:T // 2, 0] = np.nan  # a column with only half the rows
+    return sm.add_constant(F), Y
+
+
+def statsmodels_fit(X, Y):
+    """One sm.OLS() per column on the rows within 3 std, as risk_factors used to do."""
+    params, rsquared = [], []
+    for j in range(Y.shape[1]):
+        y = pd.Series(Y[:, j])
+        inlier = (np.abs(y - y.mean()) <= (3 * y.std())).values
+        result = sm.OLS(Y[inlier, j], X[inlier]).fit()
+        params.append(result.params)
+        rsquared.append(result.rsquared)
+    return np.array(params), np.array(rsquared)
+
+
+class Test_Masked_OLS(unittest.TestCase):
+    def test_matches_statsmodels(self):
+        X, Y = make_regression_data(300, 40)
+        params, rsquared = masked_ols(X, Y, outlier_mask(Y))
+        expected_params, expected_rsquared = statsmodels_fit(X, Y)
+        np.testing.assert_allclose(params, expected_params, rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(rsquared, expected_rsquared, rtol=1e-8)
+
+    def test_too_few_rows(self):
+        X, Y = make_regression_data(50, 3)
+        Y[3:, 1] = np.nan
+        params, rsquared = masked_ols(X, Y)
+        self.assertTrue(np.isnan(params[1]).all())
+        self.assertTrue(np.isnan(rsquared[1]))
+        self.assertTrue(np.isfinite(params[[0, 2]]).all())
+
+
+class Test_Rolling_OLS(unittest.TestCase):
+    def test_matches_statsmodels_per_window(self):
+        X, Y = make_regression_data(320, 30, seed=1)
+        window = 200
+        ols = RollingOLS(X, Y, window)
+        # consecutive windows, a jump back (cold start) and a jump further than a window
+        for end in list(range(window, 260)) + [210, 211, 320]:
+            params, rsquared = ols.fit(end)
+            expected_params, expected_rsquared = statsmodels_fit(X[end - window:end], Y[end - window:end])
+            np.testing.assert_allclose(params, expected_params, rtol=1e-7, atol=1e-12)
+            np.testing.assert_allclose(rsquared, expected_rsquared, rtol=1e-7)
+
+    def test_window_out_of_range(self):
+        X, Y = make_regression_data(100, 2)
+        with self.assertRaises(ValueError):
+            RollingOLS(X, Y, 60).fit(50)
+
+    def test_rows_do_not_match(self):
+        X, Y = make_regression_data(100, 2)
+        with self.assertRaises(ValueError):
+            RollingOLS(X[1:], Y, 60)
+        with self.assertRaises(ValueError):
+            masked_ols(X[1:], Y)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from alphacompiler.risk import risk_factors
+from alphacompiler.risk.risk_factors import (rolling_exposures, calc_exposures_to_equities, remove_sector_returns,
+                                             get_style_returns, load_style_returns, build_factor_loadings,
+                                             asset_shards, shard_path, merge_loadings_shards,
+                                             save_exposure_inputs, load_exposure_inputs, get_sector_etfs,
+                                             align_exposure_inputs,
+                                             Volatility, EXPOSURE_COLUMNS, STYLE_FACTORS)
+from alphacompiler.risk.factor_loadings import FactorLoadings
+from alphacompiler.risk.regression import RollingOLS
+
+
+def make_exposure_inputs(T, M, seed=0):
+    """Factor returns (with a constant), asset returns and sector returns on the same dates."""
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2012-01-03', periods=T, freq='B', tz='UTC')
+    F = pd.DataFrame(rng.randn(T, 5) * 0.01, index=dates,
+                     columns=["SMB", "HML", "MOMENTUM", "VOL", "STREVERSAL"])
+    sector_returns = pd.DataFrame(rng.randn(T, 2) * 0.01, index=dates, columns=['XLE', 'XLK'])
+    assets = ['A{}'.format(i) for i in range(M)]
+    sectors = dict((asset, 'Energy' if i % 3 else 'Information Technology') for i, asset in enumerate(assets))
+    R = pd.DataFrame(np.dot(F.values, rng.randn(5, M)) + rng.standard_t(3, (T, M)) * 0.01,
+                     index=dates, columns=assets)
+    R += np.outer(sector_returns['XLE'].values, rng.rand(M))
+    R.iloc[0] = np.nan  # first row of pct_change()
+    return sm.add_constant(F), R, sector_returns, sectors
+
+
+def per_asset_exposures(x, R, sector_returns, asset):
+    """The params and rsquared of one asset, as calc_exposures_to_equities() used to compute them."""
+    eps_sector = remove_sector_returns(asset, R[asset], sector_returns)
+    inlier = (np.abs(eps_sector - eps_sector.mean()) <= (3 * eps_sector.std()))
+    result = sm.OLS(eps_sector[inlier], x[inlier]).fit()
+    return result.params.values, result.rsquared
+
+
+class Test_Calc_Exposures_To_Equities(unittest.TestCase):
+    def test_matches_per_asset_ols(self):
+        x, R, sector_returns, sectors = make_exposure_inputs(120, 15, seed=1)
+        equities_of_interest = list(R.columns[::2]) + ['NOT_IN_R']
+
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, sectors), \
+                mock.patch.object(risk_factors, 'get_exposure_inputs', return_value=(x, R, sector_returns)):
+            packed_exposures, _ = calc_exposures_to_equities(equities_of_interest, 'bundle', None, None)
+
+            self.assertEqual(list(packed_exposures.index), equities_of_interest)
+            self.assertTrue(packed_exposures.loc['NOT_IN_R'].isnull().all())
+            for asset in equities_of_interest[:-1]:
+                params, rsquared = per_asset_exposures(x, R, sector_returns, asset)
+                np.testing.assert_allclose(packed_exposures.loc[asset, EXPOSURE_COLUMNS[:-1]].values.astype(float),
+                                           params, rtol=1e-7, atol=1e-12)
+                self.assertAlmostEqual(packed_exposures.loc[asset, 'rsquared'], rsquared, places=10)
+
+
+class Test_Align_Exposure_Inputs(unittest.TestCase):
+    def test_same_dates(self):
+        x, R, sector_returns, _ = make_exposure_inputs(30, 4)
+        x = x.drop(x.index[10])  # a day missing from the style returns
+        R = R.tz_localize(None)  # naive dates are UTC
+        extra = pd.DataFrame(0.0, index=[R.index[-1].tz_localize('UTC') + pd.Timedelta(days=3)],
+                             columns=sector_returns.columns)
+        sector_returns = pd.concat([sector_returns, extra])
+
+        x_al, R_al, sector_al = align_exposure_inputs(x, R, sector_returns)
+        self.assertEqual(len(R_al), 29)
+        self.assertTrue(x_al.index.equals(R_al.index))
+        self.assertTrue(sector_al.index.equals(R_al.index))
+        pd.testing.assert_frame_equal(x_al, x)
+        np.testing.assert_array_equal(R_al.values, R.drop(R.index[10]).values)
+
+
+class Test_Rolling_Exposures(unittest.TestCase):
+    def test_matches_per_asset_ols(self):
+        x, R, sector_returns, sectors = make_exposure_inputs(160, 12)
+        window = 100
+        days = R.index[[window, window + 1, window + 2, 150]]
+
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, sectors):
+            results = list(rolling_exposures(x, R, sector_returns, days, window=window))
+
+            self.assertEqual([day for day, _ in results], list(days))
+            for day, exposures in results:
+                rows = slice(R.index.get_loc(day) - window, R.index.get_loc(day))
+                self.assertEqual(list(exposures.columns), EXPOSURE_COLUMNS)
+                for asset in R.columns:
+                    params, rsquared = per_asset_exposures(x.iloc[rows], R.iloc[rows], sector_returns.iloc[rows],
+                                                           asset)
+                    np.testing.assert_allclose(exposures.loc[asset, EXPOSURE_COLUMNS[:-1]].values,
+                                               params, rtol=1e-7, atol=1e-12)
+                    self.assertAlmostEqual(exposures.loc[asset, 'rsquared'], rsquared, places=10)
+
+    def test_dates_do_not_match(self):
+        x, R, sector_returns, sectors = make_exposure_inputs(120, 3)
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, sectors), self.assertRaises(ValueError):
+            list(rolling_exposures(x.drop(x.index[10]), R, sector_returns, R.index[[110]], window=100))
+
+
+def fake_pipeline_results(start, end):
+    """make_pipeline() output with 4 assets per day, the buckets alternate between them."""
+    days = pd.date_range(start, end, freq='B')
+    index = pd.MultiIndex.from_product([days, range(4)])
+    returns = np.array([d.dayofyear * 0.001 * (a + 1) for d, a in index])
+    top = np.array([a % 2 == 0 for _, a in index])
+    columns = {'returns': returns}
+    for high, low in [('smallest', 'biggest'), ('highpb', 'lowpb'), ('high_momentum', 'low_momentum'),
+                      ('highvol', 'lowvol'), ('high_streversal', 'low_streversal')]:
+        columns[high], columns[low] = top, ~top
+    return pd.DataFrame(columns, index=index)
+
+
+class Test_Style_Returns_Store(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sessions = pd.date_range('2016-01-04', '2016-03-31', freq='B')
+        bundle_data = mock.Mock()
+        bundle_data.equity_daily_bar_reader.sessions = self.sessions
+        self.engine = mock.Mock()
+        self.engine.run_pipeline.side_effect = lambda pipeline, start, end: fake_pipeline_results(start, end)
+        self.patches = [mock.patch.object(risk_factors, 'get_bundle_data', return_value=(bundle_data, None)),
+                        mock.patch.object(risk_factors, 'make_pipeline_engine', return_value=self.engine),
+                        mock.patch.object(risk_factors, 'make_pipeline')]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def get(self, start, end):
+        return get_style_returns('sep', None, (start, end), path=self.tmp_dir)
+
+    def test_only_missing_days_are_computed(self):
+        first = self.get('2016-02-01', '2016-02-29')
+        self.assertEqual(self.engine.run_pipeline.call_count, 1)
+        self.assertEqual(list(first.columns), STYLE_FACTORS)
+
+        # the same days come from the store
+        pd.testing.assert_frame_equal(self.get('2016-02-01', '2016-02-29'), first)
+        self.assertEqual(self.engine.run_pipeline.call_count, 1)
+
+        # days on both sides of the stored ones, UTC dates work too
+        both_sides = self.get(pd.Timestamp('2016-01-25', tz='UTC'), pd.Timestamp('2016-03-04', tz='UTC'))
+        runs = [call[0][1:] for call in self.engine.run_pipeline.call_args_list[1:]]
+        self.assertEqual(runs, [(pd.Timestamp('2016-01-25'), pd.Timestamp('2016-01-29')),
+                                (pd.Timestamp('2016-03-01'), pd.Timestamp('2016-03-04'))])
+
+        expected = fake_pipeline_results('2016-01-25', '2016-03-04')
+        smb = (expected[expected.smallest]['returns'].groupby(level=0).mean() -
+               expected[expected.biggest]['returns'].groupby(level=0).mean())
+        np.testing.assert_allclose(both_sides['SMB'].values, smb.values)
+        self.assertEqual(len(load_style_returns('sep', self.tmp_dir)), len(both_sides))
+        self.assertEqual(os.listdir(self.tmp_dir), ['sep.pkl'])  # no temp file is left behind
+
+
+class Test_Build_Factor_Loadings(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.x, R, self.sector_returns, sectors = make_exposure_inputs(130, 10, seed=2)
+        self.R = R.rename(columns=lambda asset: int(asset[1:]))  # sids, as the cube stores them
+        self.sectors = dict((int(asset[1:]), sector) for asset, sector in sectors.items())
+        self.days = self.R.index[60:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, name, workers, before=None):
+        path = '{}/{}'.format(self.tmp_dir, name)
+        cube = FactorLoadings.create(path, STYLE_FACTORS, self.days, self.R.columns)
+        if before is not None:
+            before(cube)
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, self.sectors):
+            build_factor_loadings(path, self.x, self.R, self.sector_returns, workers=workers, window=50)
+        return FactorLoadings.open(path)
+
+    def test_workers_match_serial(self):
+        serial = self.build('serial', workers=1)
+        parallel = self.build('parallel', workers=2)
+
+        self.assertEqual(len(serial.missing_dates()), 0)
+        self.assertEqual(len(parallel.missing_dates()), 0)
+        np.testing.assert_array_equal(parallel.values, serial.values)
+        self.assertFalse(np.isnan(serial.values).any())
+        self.assertFalse(os.path.exists(os.path.join(parallel.path, 'inputs')))
+
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, self.sectors):
+            (day, exposures), = rolling_exposures(self.x, self.R, self.sector_returns, self.days[[41]], window=50)
+        np.testing.assert_allclose(serial.loadings_on(day).values, exposures[STYLE_FACTORS].values, rtol=1e-6)
+
+    def test_resume_skips_filled_days(self):
+        filled = self.days[7]
+        zeros = pd.DataFrame(0.0, index=self.R.columns, columns=STYLE_FACTORS)
+        resumed = self.build('resumed', workers=2, before=lambda cube: cube.write_day(filled, zeros))
+        serial = self.build('serial', workers=1)
+
+        self.assertTrue((resumed.loadings_on(filled) == 0).all().all())
+        others = np.arange(len(self.days)) != 7
+        np.testing.assert_array_equal(resumed.values[:, others], serial.values[:, others])
+
+    def test_inputs_grouped_by_sector(self):
+        path = '{}/inputs'.format(self.tmp_dir)
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, self.sectors):
+            etfs = get_sector_etfs(self.R.columns)
+        save_exposure_inputs(path, self.x, self.R, self.sector_returns, etfs)
+        x, R, sector_returns, saved_etfs = load_exposure_inputs(path)
+
+        self.assertEqual(list(saved_etfs), sorted(etfs))
+        np.testing.assert_array_equal(R.values, self.R[list(R.columns)].values)
+        # a sector is a slice of the memory mapped returns, RollingOLS does not copy it
+        cols = np.flatnonzero(saved_etfs == 'XLK')
+        ols = RollingOLS(sm.add_constant(sector_returns['XLK'].values), R.values[:, cols[0]:cols[-1] + 1], 50)
+        self.assertTrue(np.shares_memory(ols.Y, R.values))
+
+    def test_asset_shards_merge(self):
+        serial = self.build('serial', workers=1)
+
+        path = '{}/sharded'.format(self.tmp_dir)
+        shards = asset_shards(self.R.columns[::-1], 3)
+        self.assertEqual([len(block) for block in shards], [4, 3, 3])
+        self.assertEqual(sum(shards, []), list(range(10)))
+        with mock.patch.dict(risk_factors._SECTOR_MAPPING, self.sectors):
+            for shard, block in enumerate(shards):
+                FactorLoadings.create(shard_path(path, shard), STYLE_FACTORS, self.days, block)
+                build_factor_loadings(shard_path(path, shard), self.x, self.R[block], self.sector_returns, window=50)
+        merged = merge_loadings_shards(path, 3)
+
+        self.assertEqual(len(merged.missing_dates()), 0)
+        np.testing.assert_allclose(merged.factor('HML').values, serial.factor('HML', assets=merged.sids).values,
+                                   rtol=1e-5)
+
+
+class Test_Volatility(unittest.TestCase):
+    def test_matches_pandas(self):
+        rng = np.random.RandomState(0)
+        volatility = Volatility()
+        for num_assets in [40, 25]:
+            close = 50 * np.exp(np.cumsum(rng.randn(252, num_assets) * 0.02, axis=0))
+            close[:100, :5] = np.nan
+            close[:, -2:] = np.nan
+            close[250:, -3] = np.nan  # a single return
+            out = np.empty(num_assets)
+            volatility.compute(pd.Timestamp('2016-06-30'), np.arange(num_assets), out, close)
+
+            expected = 1 / np.log(pd.DataFrame(close)).diff().std()
+            np.testing.assert_allclose(out, expected.values, rtol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
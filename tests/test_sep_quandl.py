@@ -0,0 +1,68 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import pandas as pd
+
+from alphacompiler.data.loaders.sep_quandl import from_sep_dump
+
+
+def write_sep_dump(path):
+    """Small SEP dump, ticker B is missing a session in the middle."""
+    rows = []
+    for tkr, dates in [('B', ['2018-01-02', '2018-01-03', '2018-01-05']),
+                       ('A', ['2018-01-02', '2018-01-03', '2018-01-04', '2018-01-05']),
+                       ('C', ['2018-01-04', '2018-01-05'])]:
+        for i, date in enumerate(dates):
+            price = 10.0 + i
+            rows.append([tkr, date, price, price + 1, price - 1, price, 1000.0 * (i + 1),
+                         0.5 if (tkr, i) == ('A', 1) else 0.0, price, '2018-02-01'])
+    pd.DataFrame(rows, columns=['ticker', 'date', 'open', 'high', 'low', 'close', 'volume',
+                                'dividends', 'closeunadj', 'lastupdated']).to_csv(path, index=False)
+
+
+class Test_From_Sep_Dump(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dump_file = os.path.join(self.tmp_dir, 'SEP.csv')
+        write_sep_dump(self.dump_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_ingest(self, workers):
+        daily_bar_writer, asset_db_writer, adjustment_writer = mock.Mock(), mock.Mock(), mock.Mock()
+        ingest = from_sep_dump(self.dump_file, workers=workers)
+        ingest(None, asset_db_writer, None, daily_bar_writer, adjustment_writer,
+               None, None, False, self.tmp_dir)
+        data_list = daily_bar_writer.write.call_args[0][0]
+        equities = asset_db_writer.write.call_args[1]['equities']
+        dividends = adjustment_writer.write.call_args[1]['dividends']
+        return data_list, equities, dividends
+
+    def test_serial(self):
+        data_list, equities, dividends = self.run_ingest(workers=1)
+
+        self.assertEqual([sid for sid, _ in data_list], [0, 1, 2])
+        self.assertEqual(equities['symbol'].tolist(), ['A', 'B', 'C'])
+        # the missing session of B is forward filled
+        df_b = data_list[1][1]
+        self.assertEqual(len(df_b), 4)
+        self.assertEqual(df_b.loc['2018-01-04', 'close'], 11.0)
+        self.assertEqual(dividends['sid'].tolist(), [0])
+
+    def test_workers_match_serial(self):
+        serial = self.run_ingest(workers=1)
+        parallel = self.run_ingest(workers=2)
+
+        self.assertEqual(len(serial[0]), len(parallel[0]))
+        for (sid_s, df_s), (sid_p, df_p) in zip(serial[0], parallel[0]):
+            self.assertEqual(sid_s, sid_p)
+            pd.testing.assert_frame_equal(df_s, df_p)
+        pd.testing.assert_frame_equal(serial[1], parallel[1])
+        pd.testing.assert_frame_equal(serial[2], parallel[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
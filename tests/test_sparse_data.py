@@ -0,0 +1,189 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from alphacompiler.util.sparse_data import (SparseDataFactor, PackedSparseData, sparse_time_index,
+                                            save_sparse_data, load_sparse_data, get_sparse_cursor,
+                                            clear_sparse_cursors, pack_sparse_frame, pack_sparse_data,
+                                            export_raw_csv)
+
+
+class SparseTestFactor(SparseDataFactor):
+    outputs = ['value']
+
+
+def make_packed_dates(N, M, seed=0):
+    """Creates a padded (N, M) date matrix like the one older versions of pack_sparse_data() wrote."""
+    rng = np.random.RandomState(seed)
+    dates = np.full((N, M), np.nan)
+    for sid in range(N):
+        num_rows = rng.randint(0, M)  # leave at least one NaN column, as pack_sparse_data() did
+        start = rng.randint(0, 100)
+        dates[sid, :num_rows] = np.cumsum(start + rng.randint(1, 120, num_rows)).astype(float)
+    return dates
+
+
+def expected_values(dates, values, curr_date):
+    """Value of the last row with a date <= curr_date for every sid, NaN if there is none."""
+    out = np.full(dates.shape[0], np.nan)
+    for sid in range(dates.shape[0]):
+        row_dates = dates[sid][~np.isnan(dates[sid])]
+        i = np.searchsorted(row_dates, curr_date, side='right') - 1
+        if i >= 0:
+            out[sid] = values[sid, i]
+    return out
+
+
+class Test_Sparse_Time_Index(unittest.TestCase):
+    def test_matches_searchsorted(self):
+        dates = make_packed_dates(200, 30)
+        data = PackedSparseData.from_padded({'date': dates})
+
+        for curr_date in [-1.0, 0.0, 50.0, 51.0, 700.0, 1500.0, 5000.0]:
+            expected = []
+            for sid in range(dates.shape[0]):
+                row_dates = dates[sid][~np.isnan(dates[sid])]
+                expected.append(np.searchsorted(row_dates, curr_date, side='right') - 1)
+            np.testing.assert_array_equal(sparse_time_index(data, curr_date), expected)
+
+    def test_subset_of_sids(self):
+        data = PackedSparseData.from_padded({'date': make_packed_dates(50, 10, seed=1)})
+        sids = np.array([3, 7, 7, 42])
+        full = sparse_time_index(data, 400.0)
+        np.testing.assert_array_equal(sparse_time_index(data, 400.0, sids), full[sids])
+
+
+class Test_Sparse_Data_Factor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dates = make_packed_dates(40, 12, seed=2)
+        self.values = np.where(np.isnan(self.dates), np.nan, np.random.RandomState(3).randn(*self.dates.shape))
+        save_sparse_data(PackedSparseData.from_padded({'date': self.dates, 'value': self.values}),
+                         self.tmp_dir)
+        clear_sparse_cursors()
+
+    def tearDown(self):
+        clear_sparse_cursors()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_factor(self, factor, days, assets):
+        factor.data_path = self.tmp_dir
+        for day in days:
+            out = np.recarray(shape=len(assets), dtype=[('value', '<f8')])
+            factor.compute(pd.Timestamp(day), assets, out)
+            expected = np.full(assets.max() + 1, np.nan)
+            expected[:self.dates.shape[0]] = expected_values(self.dates, self.values, day)
+            np.testing.assert_array_equal(out.value, expected[assets])
+
+    def test_compute_with_ratchet(self):
+        assets = np.arange(45)  # includes sids that are not in the packed data
+        days = list(range(300, 400)) + list(range(100, 130))  # jump backwards to force a cold start
+        self.run_factor(SparseTestFactor(), days, assets)
+
+    def test_compute_after_forward_jump(self):
+        class OtherFactor(SparseDataFactor):
+            outputs = ['value']
+
+        # the cursor outlives the first run, the second one starts much later
+        assets = np.arange(45)
+        self.run_factor(SparseTestFactor(), range(100, 130), assets)
+        self.run_factor(OtherFactor(), range(300, 330), assets)
+
+    def test_cursor_shared_by_factors(self):
+        class OtherFactor(SparseDataFactor):
+            outputs = ['value']
+
+        cursor = get_sparse_cursor(self.tmp_dir)
+        days = list(range(300, 350))
+        with mock.patch.object(cursor, 'cold_start', wraps=cursor.cold_start) as cold_start, \
+                mock.patch.object(cursor, 'update_time_index', wraps=cursor.update_time_index) as update:
+            self.run_factor(SparseTestFactor(), days, np.arange(40))
+            self.run_factor(OtherFactor(), days, np.arange(0, 40, 3))
+
+        self.assertEqual(cold_start.call_count, 1)
+        self.assertEqual(update.call_count, len(days) - 1)
+
+
+class Test_Packed_Storage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dates = make_packed_dates(20, 8)
+        self.data = PackedSparseData.from_padded({'date': self.dates, 'netinc': self.dates * 2.0,
+                                                  'bvps': self.dates + 1.0})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_memory_scales_with_rows(self):
+        self.assertEqual(self.data.num_rows, np.isfinite(self.dates).sum())
+        self.assertEqual(self.data.num_sids, self.dates.shape[0])
+        np.testing.assert_array_equal(self.data.lengths, np.isfinite(self.dates).sum(axis=1))
+
+    def test_round_trip_is_memory_mapped(self):
+        path = os.path.join(self.tmp_dir, 'SF1')
+        save_sparse_data(self.data, path)
+        loaded = load_sparse_data(path)
+
+        self.assertEqual(loaded.fields, ['netinc', 'bvps'])
+        self.assertIsInstance(loaded.date, np.memmap)
+        np.testing.assert_array_equal(loaded.offsets, self.data.offsets)
+        for field in ['date', 'netinc', 'bvps']:
+            np.testing.assert_array_equal(loaded[field], self.data[field])
+
+    def test_reads_pickled_recarray(self):
+        rec = np.recarray(shape=self.dates.shape, dtype=[('date', '<f8'), ('netinc', '<f8')])
+        rec.date[:] = self.dates
+        rec.netinc[:] = self.dates * 2.0
+        path = os.path.join(self.tmp_dir, 'SF1.npy')
+        rec.dump(path)
+
+        loaded = load_sparse_data(path)
+        self.assertEqual(loaded.fields, ['netinc'])
+        np.testing.assert_array_equal(loaded.offsets, self.data.offsets)
+        np.testing.assert_array_equal(loaded.date, self.data.date)
+        np.testing.assert_array_equal(loaded['netinc'], self.data['netinc'])
+
+    def test_pack_sparse_frame(self):
+        df = pd.DataFrame({'sid': [2, 0, 2, 0, 3],
+                           'Date': pd.to_datetime(['2011-02-01', '2010-05-01', '2010-02-01',
+                                                   '2010-02-01', '2012-01-01']),
+                           'netinc': [3.0, 2.0, 1.0, 0.0, 4.0]})
+        path = os.path.join(self.tmp_dir, 'SF1')
+        pack_sparse_frame(df, 5, ['netinc'], path)
+        loaded = load_sparse_data(path)
+
+        np.testing.assert_array_equal(loaded.offsets, [0, 2, 2, 4, 5, 5])
+        np.testing.assert_array_equal(loaded['netinc'], [0.0, 2.0, 1.0, 3.0, 4.0])
+        self.assertEqual(loaded.date[0], pd.Timestamp('2010-02-01').value)
+
+        # the per sid files are only a debug export, packing them gives the same data
+        raw_path = os.path.join(self.tmp_dir, 'raw')
+        os.makedirs(raw_path)
+        export_raw_csv(df, ['netinc'], raw_path)
+        pack_sparse_data(5, raw_path, ['netinc'], os.path.join(self.tmp_dir, 'SF1_raw'))
+        from_raw = load_sparse_data(os.path.join(self.tmp_dir, 'SF1_raw'))
+        for field in ['date', 'netinc']:
+            np.testing.assert_array_equal(from_raw[field], loaded[field])
+
+    def test_pack_sparse_frame_from_arrow_table(self):
+        df = pd.DataFrame({'ticker': ['C', 'A', 'C', 'A', 'D'], 'netinc': [3.0, 2.0, 1.0, 0.0, 4.0],
+                           'sid': [2, 0, 2, 0, 3],
+                           'Date': pd.to_datetime(['2011-02-01', '2010-05-01', '2010-02-01',
+                                                   '2010-02-01', '2012-01-01'])})
+        pack_sparse_frame(df, 5, ['netinc'], os.path.join(self.tmp_dir, 'SF1_df'))
+        pack_sparse_frame(pa.Table.from_pandas(df), 5, ['netinc'], os.path.join(self.tmp_dir, 'SF1_table'))
+        from_df = load_sparse_data(os.path.join(self.tmp_dir, 'SF1_df'))
+        from_table = load_sparse_data(os.path.join(self.tmp_dir, 'SF1_table'))
+
+        np.testing.assert_array_equal(from_table.offsets, from_df.offsets)
+        for field in ['date', 'netinc']:
+            np.testing.assert_array_equal(from_table[field], from_df[field])
+
+
+if __name__ == '__main__':
+    unittest.main()
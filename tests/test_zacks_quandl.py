@@ -0,0 +1,68 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+from alphacompiler.data.loaders.zacks_quandl import from_zacks_dump
+
+
+def write_zacks_dump(path, num_tickers=30):
+    """Small ZEP dump, rows are not grouped by ticker."""
+    rng = np.random.RandomState(0)
+    rows = []
+    for date in pd.bdate_range('2008-12-29', periods=10):
+        for i in range(num_tickers):
+            exchange = 'OTC' if i % 7 == 3 else 'NYSE'
+            close = np.nan if (i, date.day) == (5, 6) else rng.rand() * 100
+            rows.append(['M{:03d}'.format(i), 'T{:03d}'.format(i), 'COMP {}'.format(i), 'COMP',
+                         exchange, 'USD', date.strftime('%Y-%m-%d'), 1.0, 2.0, 0.5, close, 1000.0])
+    rng.shuffle(rows)
+    pd.DataFrame(rows, columns=['m_ticker', 'ticker', 'comp_name', 'comp_name_2', 'exchange', 'currency_code',
+                                'date', 'open', 'high', 'low', 'close', 'volume']).to_csv(path, index=False)
+
+
+class Test_From_Zacks_Dump(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dump_file = os.path.join(self.tmp_dir, 'ZEP.csv')
+        write_zacks_dump(self.dump_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_ingest(self, **kwargs):
+        daily_bar_writer, asset_db_writer, adjustment_writer = mock.Mock(), mock.Mock(), mock.Mock()
+        written = []
+        daily_bar_writer.write.side_effect = lambda data, show_progress: written.extend(data)
+        ingest = from_zacks_dump(self.dump_file, **kwargs)
+        ingest(None, asset_db_writer, None, daily_bar_writer, adjustment_writer,
+               None, None, False, self.tmp_dir)
+        equities = asset_db_writer.write.call_args[1]['equities']
+        return {symbol: df for symbol, (sid, df) in zip(equities['symbol'], written)}, equities
+
+    def test_filters_rows(self):
+        bars, equities = self.run_ingest()
+
+        self.assertEqual(len(bars), 30 - 4)  # the OTC tickers are dropped
+        self.assertNotIn('T003', bars)
+        df = bars['T000']
+        self.assertEqual(df.index[0], pd.Timestamp('2009-01-02'))  # rows before START_DATE are dropped
+        self.assertTrue(df.index.is_monotonic_increasing)
+        self.assertEqual(df.columns.tolist(), ['open', 'high', 'low', 'close', 'volume'])
+        self.assertEqual(bars['T005'].shape[0], df.shape[0] - 1)  # row with a NaN is dropped
+        self.assertEqual(equities.set_index('symbol').loc['T000', 'asset_name'], 'COMP 0')
+
+    def test_buckets_give_same_bars(self):
+        in_memory, _ = self.run_ingest()
+        spilled, _ = self.run_ingest(memory_budget_mb=0.001, chunksize=17)  # forces many buckets
+
+        self.assertEqual(sorted(in_memory), sorted(spilled))
+        for symbol in in_memory:
+            pd.testing.assert_frame_equal(in_memory[symbol], spilled[symbol])
+
+
+if __name__ == '__main__':
+    unittest.main()
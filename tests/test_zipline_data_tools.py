@@ -0,0 +1,148 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+from zipline.data.bundles.core import to_bundle_ingest_dirname
+from zipline.pipeline.data import USEquityPricing, DataSet, Column
+
+from alphacompiler.util import zipline_data_tools
+from alphacompiler.util.zipline_data_tools import (load_asset_map, get_ticker_sid_dict_from_bundle,
+                                                    make_pipeline_engine, register_pipeline_loader,
+                                                    clear_bundle_cache, nan_cov_corr, fast_cov, fast_corr)
+
+
+class SomeData(DataSet):
+    value = Column(float)
+
+
+class Test_Asset_Map_Cache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = {'ZIPLINE_ROOT': self.tmp_dir}
+        self.ingest('2021-01-04')
+        self.asset_map = {'ticker2sid': {'A': 0, 'B': 2}, 'max_sid': 2, 'num_assets': 2}
+        zipline_data_tools._ASSET_MAPS.clear()
+
+    def tearDown(self):
+        zipline_data_tools._ASSET_MAPS.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def ingest(self, date):
+        """Creates an (empty) ingestion folder for the bundle 'test'."""
+        os.makedirs(os.path.join(self.tmp_dir, 'data', 'test', to_bundle_ingest_dirname(pd.Timestamp(date))))
+
+    def test_built_once_per_ingestion(self):
+        with mock.patch.object(zipline_data_tools, 'build_asset_map', return_value=self.asset_map) as build:
+            self.assertEqual(load_asset_map('test', self.environ), self.asset_map)
+            load_asset_map('test', self.environ)
+            self.assertEqual(build.call_count, 1)
+
+            # a new process reads the .json file
+            zipline_data_tools._ASSET_MAPS.clear()
+            self.assertEqual(load_asset_map('test', self.environ), self.asset_map)
+            self.assertEqual(build.call_count, 1)
+
+            # re-ingesting invalidates the cache
+            self.ingest('2021-02-01')
+            load_asset_map('test', self.environ)
+            self.assertEqual(build.call_count, 2)
+
+    def test_not_ingested(self):
+        os.makedirs(os.path.join(self.tmp_dir, 'data', 'empty'))
+        for bundle in ['empty', 'missing']:
+            with self.assertRaisesRegex(ValueError, 'must be ingested first'):
+                load_asset_map(bundle, self.environ)
+
+    def test_ticker_sid_dict_is_a_copy(self):
+        zipline_data_tools._ASSET_MAPS[('test', to_bundle_ingest_dirname(pd.Timestamp('2021-01-04')))] = self.asset_map
+        with mock.patch.dict(os.environ, self.environ):
+            tickers = get_ticker_sid_dict_from_bundle('test')
+        tickers['C'] = 3
+        self.assertEqual(self.asset_map['ticker2sid'], {'A': 0, 'B': 2})
+
+
+class Test_Make_Pipeline_Engine(unittest.TestCase):
+    def setUp(self):
+        clear_bundle_cache()
+        bundle_data = mock.Mock()
+        bundle_data.equity_daily_bar_reader.trading_calendar = mock.Mock(spec=['sessions'])
+        self.load = mock.patch.object(zipline_data_tools, 'load', return_value=bundle_data).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        clear_bundle_cache()
+        zipline_data_tools._PIPELINE_LOADERS.clear()
+
+    def test_bundle_loaded_once(self):
+        for dates in [('2015-01-02', '2015-06-30'), ('2016-01-04', '2016-06-30')]:
+            make_pipeline_engine('test', (pd.Timestamp(dates[0]), pd.Timestamp(dates[1])))
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_custom_loaders(self):
+        registered, passed = mock.Mock(), mock.Mock()
+        register_pipeline_loader(SomeData, registered)
+        dates = (pd.Timestamp('2015-01-02'), pd.Timestamp('2015-06-30'))
+
+        choose_loader = make_pipeline_engine('test', dates)._get_loader
+        self.assertIs(choose_loader(SomeData.value), registered)
+        self.assertIsNot(choose_loader(USEquityPricing.close), registered)
+
+        choose_loader = make_pipeline_engine('test', dates, loaders={SomeData.value: passed})._get_loader
+        self.assertIs(choose_loader(SomeData.value), passed)
+        with self.assertRaises(ValueError):
+            choose_loader(Column(float))
+
+
+def column_cov_corr(x, y, allowed_missing_count):
+    """Per column reference: population cov over the joint rows, std over each own rows."""
+    both = ~np.isnan(x) & ~np.isnan(y)
+    if (~both).sum() > allowed_missing_count:
+        return np.nan, np.nan
+    cov = np.mean((x[both] - x[both].mean()) * (y[both] - y[both].mean()))
+    return cov, cov / np.nanstd(x) / np.nanstd(y)
+
+
+class Test_Nan_Cov_Corr(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.N, self.M = 60, 40
+        self.m0 = rng.randn(self.N, self.M)
+        self.m1 = 0.5 * self.m0 + rng.randn(self.N, self.M)
+        self.m0[rng.rand(self.N, self.M) < 0.05] = np.nan
+        self.m1[rng.rand(self.N, self.M) < 0.05] = np.nan
+        self.m1[:20, 3] = np.nan   # too many missing
+        self.m0[:int(0.25 * self.N), 5] = np.nan  # exactly the allowed count, after the other NaNs
+
+    def expected(self, m0, m1):
+        return np.array([column_cov_corr(m0[:, j], m1[:, j], int(0.25 * self.N))
+                         for j in range(m1.shape[1])]).T
+
+    def test_matches_per_column(self):
+        exp_cov, exp_corr = self.expected(self.m0, self.m1)
+        np.testing.assert_allclose(fast_cov(self.m0, self.m1), exp_cov, rtol=1e-10)
+        np.testing.assert_allclose(fast_corr(self.m0, self.m1), exp_corr, rtol=1e-10)
+        self.assertTrue(np.isnan(fast_corr(self.m0, self.m1)[3]))
+
+    def test_one_factor_against_matrix(self):
+        factor = self.m0[:, 0]
+        tiled = np.tile(factor[:, None], (1, self.M))
+        cov, corr = nan_cov_corr(factor, self.m1)
+        exp_cov, exp_corr = nan_cov_corr(tiled, self.m1)
+        np.testing.assert_allclose(cov, exp_cov, rtol=1e-12)
+        np.testing.assert_allclose(corr, exp_corr, rtol=1e-12)
+
+    def test_mostly_missing(self):
+        m1 = self.m1.copy()
+        m1[:30, :35] = np.nan  # most columns dropped before the work
+        exp_cov, exp_corr = self.expected(self.m0, m1)
+        cov, corr = nan_cov_corr(self.m0, m1)
+        np.testing.assert_allclose(cov, exp_cov, rtol=1e-10)
+        np.testing.assert_allclose(corr, exp_corr, rtol=1e-10)
+        self.assertIsNone(nan_cov_corr(self.m0, m1, corr=False)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()